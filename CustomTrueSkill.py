@@ -1,15 +1,55 @@
 import math
+
+import numpy as np
 import trueskill as ts
 from trueskill.backends import cdf
 
 
+def rate_two_teams(winners, losers, env=None):
+    """env.rate([winners, losers], ranks=[0, 1]) in closed form.
+
+    With two teams the factor graph has a single truncated team difference, so one
+    message pass is exact and the update can be written out directly. Falls back to
+    env.rate for empty teams and dynamic draw probabilities.
+    """
+    if env is None:
+        env = ts.global_env()
+    if not winners or not losers or callable(env.draw_probability):
+        return env.rate([winners, losers], ranks=[0, 1])
+    tau_sq, beta_sq = env.tau**2, env.beta**2
+    # player variances after the dynamics factor
+    w_var = {id: r.sigma**2 + tau_sq for id, r in winners.items()}
+    l_var = {id: r.sigma**2 + tau_sq for id, r in losers.items()}
+    size = len(winners) + len(losers)
+    c = math.sqrt(sum(w_var.values()) + sum(l_var.values()) + size * beta_sq)
+    diff = sum(r.mu for r in winners.values()) - sum(r.mu for r in losers.values())
+    draw_margin = ts.calc_draw_margin(env.draw_probability, size, env)
+    v = env.v_win(diff / c, draw_margin / c)
+    w = env.w_win(diff / c, draw_margin / c)
+    w_after = {
+        id: ts.Rating(
+            winners[id].mu + var / c * v, math.sqrt(var * (1 - var / c**2 * w))
+        )
+        for id, var in w_var.items()
+    }
+    l_after = {
+        id: ts.Rating(
+            losers[id].mu - var / c * v, math.sqrt(var * (1 - var / c**2 * w))
+        )
+        for id, var in l_var.items()
+    }
+    return w_after, l_after
+
+
 def rate_with_round_score(
-    winners, losers, winner_score: int, loser_score: int, factor=0.7
+    winners, losers, winner_score: int, loser_score: int, factor=0.7, env=None
 ):
     """Modified verison of TrueSkill rate for use in N v M matches with margin of victory."""
+    if env is None:
+        env = ts.global_env()
     score_diff = winner_score - loser_score
     weight_change = 1 + (score_diff / (winner_score) - 0.5) * factor
-    w_after, l_after = ts.rate([winners, losers], ranks=[0, 1])
+    w_after, l_after = rate_two_teams(winners, losers, env)
     w_diffs = {id: w_after[id].mu - winners[id].mu for id in winners}
     l_diffs = {id: l_after[id].mu - losers[id].mu for id in losers}
     w_after = {
@@ -27,6 +67,56 @@ def rate_with_round_score(
     return w_after, l_after
 
 
+def rate_match(
+    team_a, team_b, team_a_score: int, team_b_score: int, factor=0.7, env=None
+):
+    """Rate a result from team A's point of view. A draw is rated as a team B win."""
+    if team_a_score > team_b_score:
+        team_a_new, team_b_new = rate_with_round_score(
+            team_a, team_b, team_a_score, team_b_score, factor, env
+        )
+    else:
+        team_b_new, team_a_new = rate_with_round_score(
+            team_b, team_a, team_b_score, team_a_score, factor, env
+        )
+    return team_a_new, team_b_new
+
+
+# sigma grows by DECAY_RATE * (seconds without a match / DECAY_SECONDS) ** 2
+DECAY_RATE = 0.001
+DECAY_SECONDS = 50000
+
+
+def decay_curve(seconds):
+    """Returns how much sigma grows after seconds without a match."""
+    return DECAY_RATE * ((seconds / DECAY_SECONDS) ** 2)
+
+
+def decay_ratings(mu, sigma, elapsed, env=None):
+    """Decayed sigma and exposure of arrays of ratings, in one pass.
+
+    Gives the same values as adding decay_curve to each sigma, capping it at the default
+    sigma and calling env.expose, one rating at a time.
+
+    Args:
+        mu (array): rating means.
+        sigma (array): rating deviations before decay.
+        elapsed (array): seconds since each player's last match, NaN if they have none.
+
+    Returns:
+        Tuple[array, array]: decayed sigma and exposure.
+    """
+    if env is None:
+        env = ts.global_env()
+    # decay_curve on arrays. float_power calls the same pow as float ** does, where
+    # ndarray ** 2 multiplies, which can round the last bit differently.
+    growth = DECAY_RATE * np.float_power(np.nan_to_num(elapsed) / DECAY_SECONDS, 2)
+    growth[np.isnan(elapsed)] = 0.0
+    sigma = np.minimum(sigma + growth, env.sigma)
+    # same arithmetic as env.expose
+    return sigma, mu - (env.mu / env.sigma) * sigma
+
+
 def win_probability(a, b):
     """Returns the probability of a team_a victory."""
     deltaMu = sum([x.mu for x in a]) - sum([x.mu for x in b])
@@ -0,0 +1,429 @@
+import argparse
+import io
+import time
+
+import numpy as np
+
+from config import (
+    archive_horizon,
+    archive_segment_matches,
+    checkpoint_interval,
+    checkpoints_kept,
+)
+from storage import STATS_COLUMNS, SUM_STATS, bump_data_version, connect
+
+# archived tables and the dtype each column is stored as, in row order.
+# NULLs are stored as NaN, which never occurs as a real value in these columns.
+SEGMENT_TABLES = {
+    "matches": {"id": "i8", "time": "f8", "team_a_score": "i8", "team_b_score": "i8"},
+    "match_players": {
+        "match_id": "i8",
+        "user_id": "U",
+        "team": "i1",
+        "old_mu": "f8",
+        "old_sigma": "f8",
+        "new_mu": "f8",
+        "new_sigma": "f8",
+        "prev_sigma": "f8",
+        "prev_last_match_time": "f8",
+    },
+}
+
+CHECKPOINT_COLUMNS = ("mu", "sigma", "last_match_time", *STATS_COLUMNS)
+
+
+def to_columns(rows, dtypes):
+    """Turn a list of row tuples into {column: array}, with NULL as NaN."""
+    columns = {}
+    for i, (column, dtype) in enumerate(dtypes.items()):
+        values = [row[i] for row in rows]
+        if dtype == "f8":
+            values = [np.nan if value is None else value for value in values]
+        columns[column] = np.array(values, dtype=dtype)
+    return columns
+
+
+def from_column(array):
+    """Turn a stored column back into a list of Python values, with NaN as NULL."""
+    values = array.tolist()
+    if array.dtype.kind == "f":
+        return [None if value != value else value for value in values]
+    return values
+
+
+def latest_checkpoint(conn, at_or_before=None):
+    """Match id of the newest checkpoint, or of the newest at or before a match id. 0 if none."""
+    if at_or_before is None:
+        row = conn.execute("SELECT MAX(match_id) FROM checkpoints").fetchone()
+    else:
+        row = conn.execute(
+            "SELECT MAX(match_id) FROM checkpoints WHERE match_id <= ?",
+            (at_or_before,),
+        ).fetchone()
+    return row[0] or 0
+
+
+def read_checkpoint(conn, match_id):
+    """{userid: (mu, sigma, last_match_time, *STATS_COLUMNS)} as of after match_id."""
+    return {
+        userid: tuple(values)
+        for userid, *values in conn.execute(
+            f"SELECT user_id, {', '.join(CHECKPOINT_COLUMNS)} FROM checkpoint_players"
+            " WHERE match_id = ?",
+            (match_id,),
+        )
+    }
+
+
+def history_start(conn):
+    """{userid: [mu, sigma, last_match_time]} before the first live match.
+
+    Only meaningful while nothing is archived. Each player is as before their first
+    match, or as they are now if they haven't played.
+    """
+    ratings = {
+        userid: [mu, sigma, last]
+        for userid, mu, sigma, last in conn.execute(
+            "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+        )
+    }
+    # SQLite takes the other columns from the row that MIN picks
+    for userid, mu, sigma, last, _ in conn.execute(
+        "SELECT user_id, old_mu, prev_sigma, prev_last_match_time, MIN(match_id)"
+        " FROM match_players GROUP BY user_id"
+    ):
+        ratings[userid] = [mu, sigma, last]
+    return ratings
+
+
+def create_checkpoint(conn, match_id=None):
+    """Snapshot every player's rating, counters and last match time as of after a match.
+
+    Defaults to the latest match, which copies the current tables. An earlier match is
+    reached by replaying stored results forward from the nearest checkpoint before it,
+    or from the start of history if there is none, so the cost grows with the distance
+    walked.
+
+    Returns:
+        int: the checkpoint's match id, or None if there are no live matches.
+    """
+    head = conn.execute("SELECT MAX(id) FROM matches").fetchone()[0]
+    if head is None:
+        return None
+    if match_id is None:
+        match_id = head
+    if match_id <= archived_until(conn) or match_id > head:
+        raise ValueError(f"match {match_id} is not in live history")
+    found = conn.execute(
+        "SELECT time FROM matches WHERE id = ?", (match_id,)
+    ).fetchone()
+    if found is None:
+        raise ValueError(f"match {match_id} not found")
+    if latest_checkpoint(conn, match_id) == match_id:
+        return match_id
+
+    start = latest_checkpoint(conn, match_id)
+    if match_id == head:
+        ratings = {
+            userid: [mu, sigma, last]
+            for userid, mu, sigma, last in conn.execute(
+                "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+            )
+        }
+        counters = {
+            userid: list(values)
+            for userid, *values in conn.execute(
+                f"SELECT user_id, {', '.join(STATS_COLUMNS)} FROM player_stats"
+            )
+        }
+    else:
+        if start:
+            ratings, counters = {}, {}
+            for userid, values in read_checkpoint(conn, start).items():
+                ratings[userid], counters[userid] = list(values[:3]), list(values[3:])
+        else:
+            ratings, counters = history_start(conn), {}
+        # forward to match_id: each player's latest result up to it
+        for userid, mu, sigma, last in conn.execute(
+            "SELECT mp.user_id, mp.new_mu, mp.new_sigma, m.time"
+            " FROM match_players mp JOIN matches m ON m.id = mp.match_id"
+            " WHERE mp.match_id > ? AND mp.match_id <= ? ORDER BY mp.match_id",
+            (start, match_id),
+        ):
+            ratings[userid] = [mu, sigma, last]
+        for userid, *values in conn.execute(
+            SUM_STATS.format(where="mp.match_id > ? AND mp.match_id <= ?"),
+            (start, match_id),
+        ):
+            base = counters.get(userid, [0] * len(STATS_COLUMNS))
+            counters[userid] = [a + b for a, b in zip(base, values)]
+
+    conn.execute(
+        "INSERT INTO checkpoints (match_id, time) VALUES (?, ?)", (match_id, found[0])
+    )
+    conn.executemany(
+        f"INSERT INTO checkpoint_players (match_id, user_id, {', '.join(CHECKPOINT_COLUMNS)})"
+        f" VALUES (?, ?, {', '.join('?' * len(CHECKPOINT_COLUMNS))})",
+        [
+            (
+                match_id,
+                userid,
+                *values,
+                *counters.get(userid, [0] * len(STATS_COLUMNS)),
+            )
+            for userid, values in ratings.items()
+        ],
+    )
+    return match_id
+
+
+def prune_checkpoints(conn, keep=checkpoints_kept):
+    """Drop all but the newest keep checkpoints and the one at the archive boundary."""
+    conn.execute(
+        "DELETE FROM checkpoints WHERE match_id != ? AND match_id NOT IN"
+        " (SELECT match_id FROM checkpoints ORDER BY match_id DESC LIMIT ?)",
+        (archived_until(conn), keep),
+    )
+
+
+def archived_until(conn):
+    """Id of the newest archived match, or 0 if nothing is archived."""
+    return conn.execute(
+        "SELECT COALESCE(MAX(last_match), 0) FROM archive_segments"
+    ).fetchone()[0]
+
+
+def archive_matches(conn, until, segment_size=archive_segment_matches):
+    """Move live matches up to and including match id until into compressed segments.
+
+    until needs a checkpoint, which becomes the start for rebuilding counters, last match
+    times and replays; older checkpoints are dropped. Counters, ratings and rating series
+    are kept as they are.
+
+    Returns:
+        int: number of matches archived.
+    """
+    if latest_checkpoint(conn, until) != until:
+        raise ValueError(f"match {until} has no checkpoint")
+    archived = 0
+    while True:
+        matches = conn.execute(
+            "SELECT id, time, team_a_score, team_b_score FROM matches"
+            " WHERE id <= ? ORDER BY id LIMIT ?",
+            (until, segment_size),
+        ).fetchall()
+        if not matches:
+            break
+        first, last = matches[0][0], matches[-1][0]
+        players = conn.execute(
+            "SELECT match_id, user_id, team, old_mu, old_sigma, new_mu, new_sigma,"
+            " prev_sigma, prev_last_match_time FROM match_players"
+            " WHERE match_id BETWEEN ? AND ? ORDER BY match_id, rowid",
+            (first, last),
+        ).fetchall()
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            **{
+                f"{table}/{column}": array
+                for table, rows in (("matches", matches), ("match_players", players))
+                for column, array in to_columns(rows, SEGMENT_TABLES[table]).items()
+            },
+        )
+        conn.execute(
+            "INSERT INTO archive_segments"
+            " (first_match, last_match, first_time, last_time, match_count, data)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                first,
+                last,
+                matches[0][1],
+                matches[-1][1],
+                len(matches),
+                buffer.getvalue(),
+            ),
+        )
+        index_segment(conn, first, [player[1] for player in players])
+        # match_players rows go with them, ON DELETE CASCADE
+        conn.execute("DELETE FROM matches WHERE id BETWEEN ? AND ?", (first, last))
+        archived += len(matches)
+    conn.execute("DELETE FROM checkpoints WHERE match_id < ?", (until,))
+    bump_data_version(conn)
+    return archived
+
+
+def index_segment(conn, first_match, userids):
+    """Record which users played in a segment, so lookups by user skip the others."""
+    conn.executemany(
+        "INSERT INTO archive_segment_players (user_id, first_match) VALUES (?, ?)",
+        [(userid, first_match) for userid in sorted(set(userids))],
+    )
+
+
+def index_segments(conn):
+    """Index the players of segments archived before segments were indexed."""
+    segments = conn.execute(
+        "SELECT first_match FROM archive_segments WHERE first_match NOT IN"
+        " (SELECT first_match FROM archive_segment_players)"
+    ).fetchall()
+    for (first_match,) in segments:
+        segment = read_segment(conn, first_match)
+        index_segment(conn, first_match, segment["match_players"]["user_id"])
+
+
+def compact(conn, cutoff, limit=None):
+    """Archive the oldest live matches recorded before cutoff, a timestamp.
+
+    The last match archived is checkpointed first, walking forward from the archive
+    boundary (or the start of history), so each call costs about as much as the matches
+    it archives. limit caps how many are archived, leaving the rest for later calls.
+
+    Returns:
+        int: number of matches archived.
+    """
+    query = "SELECT id FROM matches WHERE time < ? ORDER BY id"
+    params = [cutoff]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    until = conn.execute(f"SELECT MAX(id) FROM ({query})", params).fetchone()[0]
+    if until is None:
+        return 0
+    create_checkpoint(conn, until)
+    return archive_matches(conn, until)
+
+
+def maintain(conn, match_id):
+    """Checkpoint after recording match_id, every checkpoint_interval matches.
+
+    Only the current state is copied here. Compaction can take far longer than recording
+    a result, so it runs separately: see compact.
+    """
+    if not checkpoint_interval or match_id % checkpoint_interval:
+        return
+    create_checkpoint(conn, match_id)
+    prune_checkpoints(conn)
+
+
+def read_segment(conn, first_match):
+    """{table: {column: list of values}} of one archive segment."""
+    (blob,) = conn.execute(
+        "SELECT data FROM archive_segments WHERE first_match = ?", (first_match,)
+    ).fetchone()
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        return {
+            table: {column: from_column(data[f"{table}/{column}"]) for column in dtypes}
+            for table, dtypes in SEGMENT_TABLES.items()
+        }
+
+
+def segment_rows(conn, first_match, table):
+    """Row tuples of one archived table in a segment, in SEGMENT_TABLES column order."""
+    return list(zip(*read_segment(conn, first_match)[table].values()))
+
+
+def archived_rows(conn, table):
+    """Yield every archived row of matches or match_players, oldest first."""
+    segments = conn.execute(
+        "SELECT first_match FROM archive_segments ORDER BY first_match"
+    ).fetchall()
+    for (first_match,) in segments:
+        yield from segment_rows(conn, first_match, table)
+
+
+def archived_matches(conn, match_ids):
+    """Look up archived matches, reading each segment involved once.
+
+    Returns:
+        Dict[int, Tuple]: match id : (matches row, [(user_id, team, old_mu, old_sigma,
+            new_mu, new_sigma)] in rowid order) for the ids found.
+    """
+    output = {}
+    segments = {}  # first_match : [match ids]
+    for match_id in match_ids:
+        row = conn.execute(
+            "SELECT first_match FROM archive_segments"
+            " WHERE first_match <= ? AND last_match >= ?",
+            (match_id, match_id),
+        ).fetchone()
+        if row:
+            segments.setdefault(row[0], []).append(match_id)
+    for first_match, wanted in segments.items():
+        segment = read_segment(conn, first_match)
+        wanted = set(wanted)
+        for row in zip(*segment["matches"].values()):
+            if row[0] in wanted:
+                output[row[0]] = (row, [])
+        for match_id, *player in zip(*segment["match_players"].values()):
+            if match_id in output:
+                output[match_id][1].append(tuple(player[:6]))
+    return output
+
+
+def iter_archived_ids(conn, userid=None, before=None):
+    """Yield archived match ids newest first, optionally only userid's or below before.
+
+    For a user, only the segments they played in are read.
+    """
+    if userid is None:
+        query = "SELECT first_match FROM archive_segments WHERE 1"
+        params = []
+    else:
+        query = "SELECT first_match FROM archive_segment_players WHERE user_id = ?"
+        params = [userid]
+    if before is not None:
+        query += " AND first_match < ?"
+        params.append(before)
+    segments = conn.execute(query + " ORDER BY first_match DESC", params).fetchall()
+    for (first_match,) in segments:
+        segment = read_segment(conn, first_match)
+        if userid is None:
+            match_ids = segment["matches"]["id"]
+        else:
+            match_ids = [
+                match_id
+                for match_id, player in zip(
+                    segment["match_players"]["match_id"],
+                    segment["match_players"]["user_id"],
+                )
+                if player == userid
+            ]
+        for match_id in reversed(match_ids):
+            if before is None or match_id < before:
+                yield match_id
+
+
+def count_archived(conn):
+    """Number of archived matches."""
+    return conn.execute(
+        "SELECT COALESCE(SUM(match_count), 0) FROM archive_segments"
+    ).fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Checkpoint a guild's history and archive its old matches."
+    )
+    parser.add_argument("guildid")
+    parser.add_argument(
+        "--horizon",
+        type=float,
+        default=archive_horizon,
+        help="archive matches older than this many days. Defaults to archive_horizon,"
+        " or only checkpoint if that is None",
+    )
+    args = parser.parse_args()
+
+    with connect(args.guildid) as db:
+        db.execute("BEGIN IMMEDIATE")
+        archived = 0
+        if args.horizon is not None:
+            archived = compact(db, time.time() - args.horizon * 86400)
+        checkpoint = create_checkpoint(db)
+        prune_checkpoints(db)
+        total = count_archived(db)
+    print(f"archived {archived} matches ({total} in total), checkpoint at {checkpoint}")
+
+
+if __name__ == "__main__":
+    main()
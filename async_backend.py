@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+import backend
+from config import backend_workers
+
+executor = ThreadPoolExecutor(max_workers=backend_workers, thread_name_prefix="backend")
+guild_write_locks = {}  # guild_id : asyncio.Lock held while a write for the guild runs
+
+
+async def run(func, *args, **kwargs):
+    """Run a blocking function in the backend thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+async def run_write(guildid, func, *args, **kwargs):
+    """Run a blocking function that writes to guildid's db, after earlier writes to it."""
+    # asyncio.Lock wakes waiters first come first served, keeping writes in order
+    lock = guild_write_locks.setdefault(str(guildid), asyncio.Lock())
+    async with lock:
+        return await run(func, *args, **kwargs)
+
+
+def reader(func):
+    """Wrap a backend function as a coroutine that runs in the thread pool."""
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def writer(func):
+    """Like reader, but ordered with the other writes to the same guild."""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        guildid = signature.bind(*args, **kwargs).arguments["guildid"]
+        return await run_write(guildid, func, *args, **kwargs)
+
+    return wrapper
+
+
+get_playerlist = reader(backend.get_playerlist)
+get_rating = reader(backend.get_rating)
+get_ratings = reader(backend.get_ratings)
+get_win_loss = reader(backend.get_win_loss)
+get_win_losses = reader(backend.get_win_losses)
+get_stats = reader(backend.get_stats)
+get_history = reader(backend.get_history)
+get_history_page = reader(backend.get_history_page)
+count_matches = reader(backend.count_matches)
+get_past_ratings = reader(backend.get_past_ratings)
+get_rating_series = reader(backend.get_rating_series)
+get_ranks = reader(backend.get_ranks)
+get_leaderboard = reader(backend.get_leaderboard)
+get_leaderboard_by_exposure = reader(backend.get_leaderboard_by_exposure)
+make_teams = reader(backend.make_teams)
+make_matches = reader(backend.make_matches)
+warm_up = reader(backend.warm_up)
+played_guilds = reader(backend.played_guilds)
+get_data_version = reader(backend.get_data_version)
+
+set_rating = writer(backend.set_rating)
+set_ratings = writer(backend.set_ratings)
+record_result = writer(backend.record_result)
+undo_last_match = writer(backend.undo_last_match)
+undo_last_matches = writer(backend.undo_last_matches)
+undo_match = writer(backend.undo_match)
+delete_db = writer(backend.delete_db)
+compact_history = writer(backend.compact_history)
@@ -1,38 +1,66 @@
 import os
-import random
 from datetime import datetime
-from math import isclose
+from itertools import chain, islice
 
 import trueskill as ts
-from sqlitedict import SqliteDict
 
-from CustomTrueSkill import rate_with_round_score, win_probability
+import archive
+import batch
+import metrics
+from CustomTrueSkill import rate_match
+from config import (
+    archive_horizon,
+    archive_segment_matches,
+    lobby_objective,
+    lobby_team_size,
+    warm_up_guilds,
+)
+from model import load_model
+from partition import find_matches, find_teams
+from replay import rerate_after
+from series import POINT_FIELDS, POINT_SIZE, read_series
+from storage import (
+    STATS_COLUMNS,
+    bump_data_version,
+    connect,
+    data_version,
+    db_path,
+    delete_match,
+    insert_match,
+    rebuild_last_match_times,
+    rebuild_stats,
+    remove_db,
+)
+
+
+def get_data_version(guildid):
+    """Version of the guild's data, for caching anything rendered from it."""
+    with connect(guildid) as db:
+        return data_version(db)
 
 
 def delete_db(guildid):
     """Delete the db belong to guildid."""
     guildid = str(guildid)
-    os.remove(f"{guildid}.db")
+    remove_db(guildid)
 
 
 def db_string(guildid):
     """Returns full db as string."""
     output = []
     guildid = str(guildid)
-    with SqliteDict(str(guildid) + ".db") as db:
-        for key in db.keys():
-            output.append(key)
-            output.append(str(db[key]))
+    with connect(guildid) as db:
+        for table in ("ratings", "matches", "match_players"):
+            output.append(table)
+            output.append(str(db.execute(f"SELECT * FROM {table}").fetchall()))
     return " ".join(output)
 
 
 def get_playerlist(guildid):
     """Get list of all userids in guild with ratings."""
-    players = []
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "ratings" not in db:
-            db["ratings"] = {}
-        players = [uid for uid in db["ratings"]]
+    with connect(guildid) as db:
+        model = load_model(db)
+        players = [model.ids[i] for i in model.rated().tolist()]
     return players
 
 
@@ -40,338 +68,537 @@ def get_rating(userid, guildid):
     """Returns the TrueSkill rating of a discord user. Will initialize skill if none is found."""
     userid = str(userid)
     guildid = str(guildid)
-    rating = None
-
-    with SqliteDict(str(guildid) + ".db", autocommit=True) as db:
-        if "ratings" not in db:
-            db["ratings"] = {}
-        ratings = db["ratings"]
-        if userid in ratings:
-            mu, sigma = ratings[userid]
-            current_rating = ts.Rating(float(mu), float(sigma))
-            rating = ts.Rating(
-                current_rating.mu,
-                min(
-                    current_rating.sigma + get_decay(userid, guildid, db),
-                    ts.global_env().sigma,
-                ),
-            )
-        else:
-            rating = ts.Rating()
-            ratings[userid] = rating.mu, rating.sigma
-
-    return rating
+    return get_ratings([userid], guildid)[userid]
 
 
 def get_ratings(users, guildid):
     """Returns dictionary of id to rating for users."""
-    output = {}
-    current_time = datetime.now()
-    with SqliteDict(str(guildid) + ".db", autocommit=True) as db:
-        if "ratings" not in db:
-            db["ratings"] = {}
-        ratings = db["ratings"]
-        for userid in users:
-            userid = str(userid)
-            if userid in ratings:
-                mu, sigma = ratings[userid]
-                current_rating = ts.Rating(float(mu), float(sigma))
-                rating = ts.Rating(
-                    current_rating.mu,
-                    min(
-                        current_rating.sigma
-                        + get_decay(userid, guildid, db, current_time=current_time),
-                        ts.global_env().sigma,
-                    ),
-                )
-                output[userid] = rating
-            else:
-                new_rating = ts.Rating()
-                ratings[userid] = new_rating.mu, new_rating.sigma
-                output[userid] = new_rating
-    return output
+    with connect(guildid) as db:
+        return read_ratings(db, users, datetime.now())
 
 
-def get_decay(userid, guildid, db, current_time=None):
-    """Returns the amount of decay for a user, based on time since last match."""
-    userid, guildid = str(userid), str(guildid)
-    if not current_time:
-        current_time = datetime.now()
-    last_match = time_since_last_match(userid, guildid, db, current_time=current_time)
-    if last_match:
-        return 0.001 * ((last_match / 50000) ** 2)
-    else:
-        return 0
+def read_ratings(db, users, current_time):
+    """Read decayed ratings for users inside an open transaction, creating missing ones."""
+    model = load_model(db)
+    output = {}
+    found = {}  # userid : model index
+    new_users = []
+    for userid in users:
+        userid = str(userid)
+        i = model.index.get(userid)
+        if i is not None and model.mu[i] == model.mu[i]:
+            output[userid] = None  # filled in below, keeping the order of users
+            found[userid] = i
+        else:
+            output[userid] = ts.Rating()
+            new_users.append(userid)
+    if found:
+        mu, sigma, _ = model.decayed(current_time, list(found.values()))
+        for userid, m, s in zip(found, mu.tolist(), sigma.tolist()):
+            output[userid] = ts.Rating(m, s)
+    write_ratings(db, {userid: output[userid] for userid in new_users})
+    return output
 
 
 def set_rating(userid, rating, guildid):
     """Set the rating of a user."""
-    userid = str(userid)
-    guildid = str(guildid)
-    # write to shelve persistent db
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "ratings" not in db:
-            db["ratings"] = {}
-        ratings = db["ratings"]
-        ratings[userid] = rating.mu, rating.sigma
-        db["ratings"] = ratings
-        db.commit()
+    set_ratings({userid: rating}, guildid)
 
 
 def set_ratings(user_ratings, guildid):
     """Set the rating of multiple users."""
     guildid = str(guildid)
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "ratings" not in db:
-            db["ratings"] = {}
-        ratings = db["ratings"]
-        for userid in user_ratings:
-            ratings[str(userid)] = user_ratings[userid].mu, user_ratings[userid].sigma
-        db["ratings"] = ratings
-        db.commit()
+    with connect(guildid) as db:
+        model = load_model(db)
+        write_ratings(db, user_ratings)
+        bump_data_version(db)
+        model.update(db, user_ratings, datetime.now())
+
+
+def write_ratings(db, user_ratings):
+    """Upsert {userid: rating} inside an open transaction."""
+    db.executemany(
+        "INSERT INTO ratings (user_id, mu, sigma) VALUES (?, ?, ?)"
+        " ON CONFLICT (user_id) DO UPDATE SET mu = excluded.mu, sigma = excluded.sigma",
+        [(str(uid), r.mu, r.sigma) for uid, r in user_ratings.items()],
+    )
 
 
 def record_result(team_a, team_b, team_a_score, team_b_score, guildid):
     """Updates the TrueSkill ratings given a result."""
-    # rate match with modified TrueSkill and record new ratings.
-    team_a_ratings = get_ratings(team_a, guildid)
-    team_b_ratings = get_ratings(team_b, guildid)
-    if team_a_score > team_b_score:
-        team_a_new, team_b_new = rate_with_round_score(
+    with connect(guildid) as db:
+        # take the write lock before reading so concurrent results can't interleave
+        db.execute("BEGIN IMMEDIATE")
+        current_time = datetime.now()
+        ratings = read_ratings(db, [*team_a, *team_b], current_time)
+        team_a_ratings = {str(uid): ratings[str(uid)] for uid in team_a}
+        team_b_ratings = {str(uid): ratings[str(uid)] for uid in team_b}
+
+        # rate match with modified TrueSkill and record new ratings.
+        team_a_new, team_b_new = rate_match(
             team_a_ratings, team_b_ratings, team_a_score, team_b_score
         )
-    else:
-        team_b_new, team_a_new = rate_with_round_score(
-            team_b_ratings, team_a_ratings, team_b_score, team_a_score
-        )
-    set_ratings(team_a_new, guildid)
-    set_ratings(team_b_new, guildid)
-
-    # record in match history
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "history" not in db:
-            db["history"] = []
-        history = db["history"]
-        history.append(
-            {
-                "team_a": team_a_new,
-                "team_b": team_b_new,
-                "team_a_score": team_a_score,
-                "team_b_score": team_b_score,
-                "time": datetime.now(),
-                "old_ratings": {**team_a_ratings, **team_b_ratings},
-            }
+        match_id = insert_match(
+            db,
+            current_time.timestamp(),
+            team_a_score,
+            team_b_score,
+            team_a_new,
+            team_b_new,
+            ratings,
         )
-        db["history"] = history
-        db.commit()
+        write_ratings(db, {**team_a_new, **team_b_new})
+        archive.maintain(db, match_id)
+        bump_data_version(db)
+        db.model.update(db, ratings, current_time)
 
     return team_a_ratings, team_b_ratings, team_a_new, team_b_new
 
 
-def make_teams(players, guildid, pool=25):
-    """Make teams based on rating."""
+def make_teams(players, guildid, team_size=None, max_evaluations=None, time_limit=None):
+    """Make teams based on rating.
+
+    Args:
+        players (List): userids of the players to split.
+        guildid: guild id.
+        team_size (int, optional): size of team A for N v M matches. Defaults to half.
+        max_evaluations (int, optional): cap on candidate splits scored. Defaults to config.
+        time_limit (float, optional): cap on search time in seconds. Defaults to config.
+
+    Returns:
+        Tuple: team_a, team_b, quality, team_a win probability, team_b win probability,
+            number of candidate splits evaluated.
+    """
     guildid = str(guildid)
     player_ratings = get_ratings(players, guildid)
-    team_a = team_b = []
-    best_quality = 0.0
-
-    # generate pool
-    for _ in range(pool):
-        random.shuffle(players)
-        team_size = len(players) // 2
-        t1 = {str(uid): player_ratings[str(uid)] for uid in players[:team_size]}
-        t2 = {str(uid): player_ratings[str(uid)] for uid in players[team_size:]}
-        quality = ts.quality([t1, t2])
-        if quality > best_quality:
-            team_a = list(t1.keys())
-            team_b = list(t2.keys())
-            best_quality = quality
-
-    # sort teams by rating
-    team_a, team_b = sorted(team_a, key=lambda x: player_ratings[x]), sorted(
-        team_b, key=lambda x: player_ratings[x]
+    ids = list(player_ratings)
+    a_idx, b_idx, best_quality, evaluated = find_teams(
+        [player_ratings[uid] for uid in ids],
+        team_size=team_size,
+        max_evaluations=max_evaluations,
+        time_limit=time_limit,
     )
-    a_win = win_probability(
-        [player_ratings[str(uid)] for uid in team_a],
-        [player_ratings[str(uid)] for uid in team_b],
+
+    team_a, team_b, a_win, b_win = order_teams(
+        [ids[i] for i in a_idx], [ids[i] for i in b_idx], player_ratings
     )
-    b_win = win_probability(
-        [player_ratings[str(uid)] for uid in team_b],
-        [player_ratings[str(uid)] for uid in team_a],
+    return team_a, team_b, best_quality, a_win, b_win, evaluated
+
+
+def make_matches(
+    players,
+    guildid,
+    match_count=None,
+    team_size=None,
+    objective=None,
+    max_evaluations=None,
+    time_limit=None,
+):
+    """Split a lobby into several concurrent matches.
+
+    Args:
+        players (List): userids of the players to split.
+        guildid: guild id.
+        match_count (int, optional): number of matches. Defaults to as many as give teams
+            closest to team_size, or one if team_size is None.
+        team_size (int, optional): target players per team. Defaults to config.
+        objective (str, optional): "worst" or "total", see partition.find_matches.
+            Defaults to config.
+        max_evaluations (int, optional): cap on candidates scored. Defaults to config.
+        time_limit (float, optional): cap on search time in seconds. Defaults to config.
+
+    Returns:
+        Tuple[List[Tuple], int]: team_a, team_b, quality, team_a win probability and
+            team_b win probability of each match, number of candidates evaluated.
+    """
+    guildid = str(guildid)
+    if team_size is None:
+        team_size = lobby_team_size
+    if match_count is None and team_size:
+        match_count = max(int(len(players) / (2 * team_size) + 0.5), 1)
+    elif match_count is None:
+        match_count = 1
+    if objective is None:
+        objective = lobby_objective
+    player_ratings = get_ratings(players, guildid)
+    ids = list(player_ratings)
+    found, evaluated = find_matches(
+        [player_ratings[uid] for uid in ids],
+        match_count,
+        objective=objective,
+        max_evaluations=max_evaluations,
+        time_limit=time_limit,
     )
-    return team_a, team_b, best_quality, a_win, b_win
+    matches = []
+    for a_idx, b_idx, quality in found:
+        team_a, team_b, a_win, b_win = order_teams(
+            [ids[i] for i in a_idx], [ids[i] for i in b_idx], player_ratings
+        )
+        matches.append((team_a, team_b, quality, a_win, b_win))
+    return matches, evaluated
+
+
+def order_teams(team_a, team_b, player_ratings):
+    """Sort both teams by rating and get each team's win probability."""
+    team_a = sorted(team_a, key=lambda x: player_ratings[x])
+    team_b = sorted(team_b, key=lambda x: player_ratings[x])
+    mu = [player_ratings[uid].mu for uid in team_a + team_b]
+    sigma = [player_ratings[uid].sigma for uid in team_a + team_b]
+    a_side = [True] * len(team_a) + [False] * len(team_b)
+    a_win, b_win = batch.win_probability(mu, sigma, [a_side, [not a for a in a_side]])
+    return team_a, team_b, float(a_win), float(b_win)
 
 
 def get_win_loss(userid, guildid):
     """Get win/loss counts for a user."""
     userid = str(userid)
-    guildid = str(guildid)
-    wins, losses = 0, 0
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "history" in db:
-            for match in db["history"]:
-                if userid in match["team_a"]:
-                    if match["team_a_score"] > match["team_b_score"]:
-                        wins += 1
-                    elif match["team_a_score"] < match["team_b_score"]:
-                        losses += 1
-                    else:
-                        wins += 0.5
-                        losses += 0.5
-                elif userid in match["team_b"]:
-                    if match["team_b_score"] > match["team_a_score"]:
-                        wins += 1
-                    elif match["team_b_score"] < match["team_a_score"]:
-                        losses += 1
-                    else:
-                        wins += 0.5
-                        losses += 0.5
-    return wins, losses
-
-
-def time_since_last_match(userid, guildid, db, current_time=datetime.now()):
-    """Returns the time in seconds since user's last match."""
-    userid, guildid = str(userid), str(guildid)
-    output = None
-    if "history" in db:
-        history = db["history"]
-        for _, match in enumerate(reversed(history)):
-            if userid in match["team_a"] or userid in match["team_b"]:
-                output = (current_time - match["time"]).total_seconds()
-                break
+    return get_win_losses([userid], guildid)[userid]
+
+
+def get_win_losses(users, guildid):
+    """Get win/loss counts for multiple users. Draws count as half a win and half a loss."""
+    output = {}
+    for userid, stats in get_stats(users, guildid).items():
+        wins, losses, draws = stats["wins"], stats["losses"], stats["draws"]
+        if draws:
+            wins, losses = wins + draws / 2, losses + draws / 2
+        output[userid] = wins, losses
     return output
 
 
+def get_stats(users, guildid):
+    """Returns dictionary of id to match counters (wins, losses, draws, games, rounds) for users."""
+    users = [str(userid) for userid in users]
+    output = {userid: dict.fromkeys(STATS_COLUMNS, 0) for userid in users}
+    with connect(guildid) as db:
+        for userid in users:
+            row = db.execute(
+                f"SELECT {', '.join(STATS_COLUMNS)} FROM player_stats WHERE user_id = ?",
+                (userid,),
+            ).fetchone()
+            if row:
+                output[userid] = dict(zip(STATS_COLUMNS, row))
+    return output
+
+
+def rebuild_player_stats(guildid):
+    """Rebuild every user's match counters from match history."""
+    with connect(guildid) as db:
+        rebuild_stats(db)
+        bump_data_version(db)
+
+
+def rebuild_last_played(guildid):
+    """Rebuild every user's last match time from match history."""
+    with connect(guildid) as db:
+        rebuild_last_match_times(db)
+        bump_data_version(db)
+
+
+def load_matches(db, match_ids, archived=False):
+    """Build MatchRecords for match_ids, in the order given. Missing ids are skipped.
+
+    Archived matches are only looked up with archived, as they can't be undone.
+    """
+    model = load_model(db)
+    found = {}
+    for match_id in match_ids:
+        row = db.execute(
+            "SELECT id, time, team_a_score, team_b_score FROM matches WHERE id = ?",
+            (match_id,),
+        ).fetchone()
+        if row is None:
+            continue
+        players = db.execute(
+            "SELECT user_id, team, old_mu, old_sigma, new_mu, new_sigma"
+            " FROM match_players WHERE match_id = ? ORDER BY rowid",
+            (match_id,),
+        )
+        found[match_id] = model.record(row, players)
+    missing = [match_id for match_id in match_ids if match_id not in found]
+    if archived and missing:
+        for match_id, (row, players) in archive.archived_matches(db, missing).items():
+            found[match_id] = model.record(row, players)
+    return [found[match_id] for match_id in match_ids if match_id in found]
+
+
+def _history_ids(db, userid=None, before=None):
+    """Yield the guild's or userid's match ids newest first, below before if given.
+
+    Live matches come from the db lazily, then archived ones as far as they are read.
+    """
+    if userid:
+        query = "SELECT match_id FROM match_players WHERE user_id = ?"
+        params = [str(userid)]
+        id_column = "match_id"
+    else:
+        query = "SELECT id FROM matches WHERE 1"
+        params = []
+        id_column = "id"
+    if before is not None:
+        query += f" AND {id_column} < ?"
+        params.append(before)
+    live = db.execute(query + f" ORDER BY {id_column} DESC", params)
+    return chain(
+        (match_id for match_id, in live),
+        archive.iter_archived_ids(db, str(userid) if userid else None, before=before),
+    )
+
+
 def get_history(guildid, userid=None):
     """Fetch list of matches for guild or specified user in guild."""
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "history" not in db or not db["history"]:
-            history = None
-        elif userid:
-            userid = str(userid)
-            history = list(
-                filter(
-                    lambda x: (userid) in x["team_a"] or (userid) in x["team_b"],
-                    db["history"],
-                )
-            )
-            history.reverse()
-        else:
-            # guild-wide match history
-            history = db["history"]
-            history.reverse()
+    with connect(guildid) as db:
+        history = load_matches(db, list(_history_ids(db, userid)), archived=True)
     if not history:
         return None
     return history
 
 
+def get_history_page(guildid, userid=None, before=None, limit=5, offset=0):
+    """Fetch one page of match history, newest first.
+
+    Args:
+        guildid: guild id.
+        userid (optional): only include matches this user played in.
+        before (int, optional): cursor from the previous page. Starts from the newest match.
+        limit (int, optional): matches per page. Defaults to 5.
+        offset (int, optional): matches to skip first, for jumping to a page without a
+            cursor. Costs O(offset), so prefer cursors.
+
+    Returns:
+        Tuple[List[MatchRecord], Optional[int]]: matches, and the cursor for the next (older) page
+            or None if this is the last one.
+    """
+    with connect(guildid) as db:
+        match_ids = list(
+            islice(_history_ids(db, userid, before), offset, offset + limit + 1)
+        )
+        history = load_matches(db, match_ids[:limit], archived=True)
+    cursor = match_ids[limit - 1] if len(match_ids) > limit else None
+    return history, cursor
+
+
+def count_matches(guildid, userid=None):
+    """Number of matches in the guild, or that userid played in."""
+    with connect(guildid) as db:
+        if userid:
+            row = db.execute(
+                "SELECT games FROM player_stats WHERE user_id = ?", (str(userid),)
+            ).fetchone()
+            return row[0] if row else 0
+        (live,) = db.execute("SELECT COUNT(*) FROM matches").fetchone()
+        return live + archive.count_archived(db)
+
+
+def get_rating_series(userid, guildid, start=None, end=None):
+    """Get a user's rating after each of their matches, oldest first.
+
+    Args:
+        userid: user id.
+        guildid: guild id.
+        start (datetime, optional): only include matches at or after start.
+        end (datetime, optional): only include matches at or before end.
+
+    Returns:
+        Dict[str, array]: array of each point field (match_id, time, old_mu, mu, sigma),
+            where time is a timestamp and old_mu is the user's mu going into the match.
+    """
+    with connect(guildid) as db:
+        values = read_series(
+            db,
+            str(userid),
+            start=start.timestamp() if start else None,
+            end=end.timestamp() if end else None,
+        )
+    return {field: values[i::POINT_SIZE] for i, field in enumerate(POINT_FIELDS)}
+
+
 def get_past_ratings(userid, guildid, pad=False):
-    """Get a list of past ratings(mu) for a user."""
+    """Get a list of past ratings(mu) for a user. pad only counts live matches."""
+    userid = str(userid)
     guildid = str(guildid)
-    past_ratings = []
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "history" in db:
-            if pad:
-                history = db["history"]
-            else:
-                history = list(
-                    filter(
-                        lambda x: (userid) in x["team_a"] or (userid) in x["team_b"],
-                        db["history"],
-                    )
-                )
-            for match in history:
-                if userid in match["old_ratings"]:
-                    past_ratings.append(match["old_ratings"][userid].mu)
+    if pad:
+        # one value per guild match, so this has to walk the whole history
+        past_ratings = []
+        with connect(guildid) as db:
+            rows = db.execute(
+                "SELECT mp.old_mu FROM matches m LEFT JOIN match_players mp"
+                " ON mp.match_id = m.id AND mp.user_id = ? ORDER BY m.id",
+                (userid,),
+            )
+            for (old_mu,) in rows:
+                if old_mu is not None:
+                    past_ratings.append(old_mu)
                 else:
                     if past_ratings:
                         past_ratings.append(past_ratings[-1])
                     else:
                         past_ratings.append(ts.global_env().mu)
-            past_ratings.append(get_rating(userid, guildid).mu)
+    else:
+        past_ratings = list(get_rating_series(userid, guildid)["old_mu"])
+    past_ratings.append(get_rating(userid, guildid).mu)
     return past_ratings
 
 
+def ranked_ratings(guildid, metric="exposure", limit=None):
+    """Decayed ratings of the top players who have played, best first.
+
+    Args:
+        guildid: guild id.
+        metric (str, optional): "exposure", or "mean" to sort by mu then lowest sigma.
+        limit (int, optional): how many players to return, all if None.
+
+    Returns:
+        List[Tuple[str, ts.Rating]]: (user id, decayed rating) pairs. None if the guild
+            has no players.
+    """
+    with connect(guildid) as db:
+        model = load_model(db)
+        if not len(model.rated()):
+            return None
+        current_time = datetime.now()
+        index = model.rank_index(metric, current_time)
+        rows = index.ordered(current_time, limit)
+        return [(model.ids[i], ts.Rating(mu, sigma)) for i, mu, sigma, _ in rows]
+
+
 def get_ranks(players, guildid, metric="exposure"):
     """Get the leaderboard position of a list of players. Returns a {userid: position} dict."""
-    if metric == "exposure":
-        leaderboard = get_leaderboard_by_exposure(guildid)
-    elif metric == "mean":
-        leaderboard = get_leaderboard(guildid)
-    if leaderboard:
-        rank = 0
-        last = 0
-        last_rank = 0
-        output = {}
-        for item in leaderboard:
-            rank += 1
-            if metric == "exposure" and not isclose(
-                ts.expose(item[1]), last, abs_tol=0.0001
-            ):
-                last = ts.expose(item[1])
-                last_rank = rank
-            elif metric == "mean" and not isclose(item[1].mu, last, abs_tol=0.0001):
-                last = item[1].mu
-                last_rank = rank
-            if item[0] in players:
-                output[item[0]] = last_rank
-        return output
-
-
-def get_leaderboard(guildid):
+    with connect(guildid) as db:
+        model = load_model(db)
+        current_time = datetime.now()
+        index = model.rank_index(metric, current_time)
+        if not index.ordered(current_time, 1):
+            return None
+        players = {
+            model.index[str(userid)] for userid in players if str(userid) in model.index
+        }
+        ranks = index.ranks(sorted(players), current_time)
+        return {model.ids[i]: rank for i, rank in ranks.items()}
+
+
+def get_leaderboard(guildid, limit=None):
     """Gets list of userids and TrueSkill ratings, sorted by current rating."""
-    guildid = str(guildid)
-    with SqliteDict(str(guildid) + ".db") as db:
-        if "ratings" in db:
-            ratings = {
-                str(id): get_rating(str(id), guildid) for id in db["ratings"].keys()
-            }
-            ratings = {id: ratings[id] for id in ratings if ratings[id] != ts.Rating()}
-            leaderboard = sorted(
-                ratings.items(), key=lambda x: (x[1].mu, -x[1].sigma), reverse=True
-            )
-            return leaderboard
-    return None
+    return ranked_ratings(guildid, "mean", limit)
 
 
-def get_leaderboard_by_exposure(guildid):
+def get_leaderboard_by_exposure(guildid, limit=None):
     """Get leaderboard sorted by exposure (see trueskill.org for more info)."""
-    guildid = str(guildid)
-    ids = get_playerlist(guildid)
-    if not ids:
-        return None
-    ratings = get_ratings(ids, guildid)
-    ratings = {id: ratings[id] for id in ratings if ratings[id] != ts.Rating()}
-    leaderboard = sorted(ratings.items(), key=lambda x: ts.expose(x[1]), reverse=True)
-    return leaderboard
+    return ranked_ratings(guildid, "exposure", limit)
+
+
+def played_guilds(guildids):
+    """The guilds that have a database, most recently played first."""
+    played = []
+    for guildid in map(str, guildids):
+        # recent writes may only have reached the WAL file
+        paths = [db_path(guildid), db_path(guildid) + "-wal"]
+        times = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+        if os.path.exists(paths[0]):
+            played.append((max(times), guildid))
+    return [guildid for _, guildid in sorted(played, reverse=True)]
+
+
+def warm_up(guildids, limit=warm_up_guilds):
+    """Load the ratings model and rank indexes of the guilds played in most recently.
+
+    Run at startup, so the first leaderboard or rank lookup in an active guild doesn't
+    pay for loading them. Guilds without a database are skipped rather than created.
+
+    Args:
+        guildids (Iterable): guilds to choose from.
+        limit (int, optional): most guilds to load.
+
+    Returns:
+        List[str]: the guilds loaded, most recently played first.
+    """
+    guildids = played_guilds(guildids)[:limit]
+    for guildid in guildids:
+        with connect(guildid) as db:
+            model = load_model(db)
+            current_time = datetime.now()
+            for metric in ("exposure", "mean"):
+                model.rank_index(metric, current_time)
+    return guildids
+
+
+def compact_history(guildid, limit=archive_segment_matches):
+    """Archive up to limit of the guild's matches older than archive_horizon days.
+
+    Run from a background task, a segment at a time, so a result recorded meanwhile
+    only waits for one segment. Archived matches still show in history, but can no
+    longer be undone or replayed.
+
+    Returns:
+        int: number of matches archived, 0 once there are none left to archive.
+    """
+    if archive_horizon is None:
+        return 0
+    with connect(guildid) as db:
+        db.execute("BEGIN IMMEDIATE")
+        cutoff = datetime.now().timestamp() - archive_horizon * 86400
+        archived = archive.compact(db, cutoff, limit)
+        archive.prune_checkpoints(db)
+    return archived
 
 
 def undo_last_match(guildid):
     """Rollback to before the last recorded result."""
+    matches = undo_last_matches(guildid, 1)
+    if not matches:
+        return None
+    return matches[0]
+
+
+def undo_last_matches(guildid, count):
+    """Rollback the last count recorded results.
+
+    Returns:
+        List[MatchRecord]: the undone matches, newest first. None if there is no history.
+    """
     guildid = str(guildid)
-    match = None
-    with SqliteDict(guildid + ".db") as db:
-        if "history" not in db or not db["history"]:
-            print("history not found in db")
+    with connect(guildid) as db:
+        db.execute("BEGIN IMMEDIATE")
+        match_ids = [
+            match_id
+            for match_id, in db.execute(
+                "SELECT id FROM matches ORDER BY id DESC LIMIT ?", (count,)
+            )
+        ]
+        if not match_ids:
             return None
-        history = db["history"]
-        match = history[-1]
-        # delete from match history
-        del history[-1]
-        db["history"] = history
-        db.commit()
-    for player in match["team_a"]:
-        set_rating(str(player), match["old_ratings"][player], guildid)
-    for player in match["team_b"]:
-        set_rating(str(player), match["old_ratings"][player], guildid)
-    return match
+        matches = load_matches(db, match_ids)
+        # delete from match history and restore ratings from before each match
+        for match_id in match_ids:
+            delete_match(db, match_id)
+        bump_data_version(db)
+    return matches
+
+
+def undo_match(guildid, match_id):
+    """Remove any recorded result, re-rating only the later matches it affected.
+
+    Returns:
+        Tuple[MatchRecord, int]: the removed match (None if not found) and the number of later
+            matches that were re-rated.
+    """
+    guildid = str(guildid)
+    with connect(guildid) as db:
+        db.execute("BEGIN IMMEDIATE")
+        matches = load_matches(db, [match_id])
+        if not matches:
+            return None, 0
+        users = delete_match(db, match_id)
+        rerated = rerate_after(db, match_id, users)
+        bump_data_version(db)
+    return matches[0], rerated
 
 
 def get_match_summary(match, timestamps=True, names=True):
     """Gets summary string for match.
 
     Args:
-        match (Dict): match dictionary from db match-history
+        match (MatchRecord): match from get_history or get_history_page
         timestamps (bool, optional): option to include timestamp in output. Defaults to True.
         names (bool, optional): option to include names (mentions) in output. Defaults to True.
 
@@ -380,10 +607,14 @@ def get_match_summary(match, timestamps=True, names=True):
     """
     output = []
     if timestamps:
-        output.append(f"{match['time'].strftime('%a %b %d %I:%M %p')}:\n")
+        output.append(f"{match.time.strftime('%a %b %d %I:%M %p')}:\n")
     if names:
-        output.append(", ".join([f"<@!{uid}>" for uid in match["team_a"]]))
-    output.append(f" { match['team_a_score']} - {match['team_b_score']} ")
+        output.append(", ".join([f"<@!{uid}>" for uid in match.team_a]))
+    output.append(f" { match.team_a_score} - {match.team_b_score} ")
     if names:
-        output.append(", ".join([f"<@!{uid}>" for uid in match["team_b"]]))
+        output.append(", ".join([f"<@!{uid}>" for uid in match.team_b]))
     return "".join(output)
+
+
+# time every public function above, see metrics.py
+metrics.instrument(globals(), "backend")
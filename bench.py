@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import trueskill as ts
+
+import backend
+import storage
+from config import draw_probability
+from storage import TEAM_A, TEAM_B, connect, rebuild_last_match_times, rebuild_stats
+
+# (players, matches) of each synthetic guild, smallest first
+DEFAULT_SIZES = "100x1000,1000x20000,10000x200000"
+TEAM_SIZE = 5
+# seconds between synthetic matches
+MATCH_INTERVAL = 600
+
+
+def parse_sizes(text):
+    """Parse "PLAYERSxMATCHES,..." into a list of (players, matches)."""
+    sizes = []
+    for size in text.split(","):
+        players, matches = size.lower().split("x")
+        sizes.append((int(players), int(matches)))
+    return sizes
+
+
+def generate_guild(guildid, players, matches, seed=0):
+    """Fill guildid's db with players and matches of synthetic history.
+
+    Ratings follow a random walk rather than TrueSkill, so thousands of matches can be
+    written per second; every table the backend reads is populated consistently.
+    """
+    rng = np.random.default_rng(seed)
+    env = ts.global_env()
+    ids = [str(10**17 + i) for i in range(players)]
+    mu = np.full(players, env.mu)
+    sigma = np.full(players, env.sigma)
+    last = np.full(players, np.nan)
+    start = time.time() - matches * MATCH_INTERVAL
+
+    with connect(guildid) as db:
+        db.execute("BEGIN")
+        match_rows, player_rows = [], []
+        for match_id in range(1, matches + 1):
+            match_time = start + match_id * MATCH_INTERVAL
+            lobby = rng.choice(players, 2 * TEAM_SIZE, replace=False)
+            loser_score = int(rng.integers(0, 12))
+            a_wins = bool(rng.integers(0, 2))
+            match_rows.append(
+                (
+                    match_id,
+                    match_time,
+                    13 if a_wins else loser_score,
+                    loser_score if a_wins else 13,
+                )
+            )
+            steps = rng.normal(0, 1, len(lobby))
+            for slot, i in enumerate(lobby):
+                team = TEAM_A if slot < TEAM_SIZE else TEAM_B
+                won = (team == TEAM_A) == a_wins
+                new_mu = mu[i] + abs(steps[slot]) * (1 if won else -1)
+                new_sigma = max(sigma[i] * 0.97, 0.8)
+                player_rows.append(
+                    (
+                        match_id,
+                        ids[i],
+                        team,
+                        float(mu[i]),
+                        float(sigma[i]),
+                        float(new_mu),
+                        float(new_sigma),
+                        float(sigma[i]),
+                        None if np.isnan(last[i]) else float(last[i]),
+                    )
+                )
+                mu[i], sigma[i], last[i] = new_mu, new_sigma, match_time
+        db.executemany(
+            "INSERT INTO matches (id, time, team_a_score, team_b_score)"
+            " VALUES (?, ?, ?, ?)",
+            match_rows,
+        )
+        db.executemany(
+            "INSERT INTO match_players (match_id, user_id, team, old_mu, old_sigma,"
+            " new_mu, new_sigma, prev_sigma, prev_last_match_time)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            player_rows,
+        )
+        db.executemany(
+            "INSERT INTO ratings (user_id, mu, sigma) VALUES (?, ?, ?)",
+            [(uid, float(mu[i]), float(sigma[i])) for i, uid in enumerate(ids)],
+        )
+        rebuild_last_match_times(db)
+        rebuild_stats(db)
+        storage.rebuild_series(db)
+    return ids
+
+
+def benchmarks(guildid, ids, rng):
+    """{name: callable} of the hot paths, each drawing fresh random players per call."""
+
+    def lobby():
+        return [ids[i] for i in rng.choice(len(ids), 2 * TEAM_SIZE, replace=False)]
+
+    def player():
+        return ids[int(rng.integers(len(ids)))]
+
+    def record_result():
+        players = lobby()
+        backend.record_result(
+            players[:TEAM_SIZE],
+            players[TEAM_SIZE:],
+            13,
+            int(rng.integers(0, 12)),
+            guildid,
+        )
+
+    return {
+        "make_teams": lambda: backend.make_teams(lobby(), guildid),
+        "record_result": record_result,
+        "get_leaderboard_by_exposure": lambda: backend.get_leaderboard_by_exposure(
+            guildid
+        ),
+        "get_ranks": lambda: backend.get_ranks(lobby(), guildid),
+        "get_win_loss": lambda: backend.get_win_loss(player(), guildid),
+        "get_history": lambda: backend.get_history(guildid, player()),
+        "get_history_page": lambda: backend.get_history_page(guildid),
+        "get_past_ratings": lambda: backend.get_past_ratings(player(), guildid),
+    }
+
+
+def measure(func, repeat, warmup=1):
+    """Time func repeat times, then run it once more under tracemalloc for peak memory."""
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings = np.array(timings) * 1000
+    return {
+        "runs": repeat,
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p99_ms": float(np.percentile(timings, 99)),
+        "mean_ms": float(timings.mean()),
+        "peak_kib": peak / 1024,
+    }
+
+
+def run(sizes, repeat, only=None, seed=0, workdir=None):
+    """Benchmark every size in a scratch directory and return the results as a dict."""
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "trueskill": ts.__version__,
+            "repeat": repeat,
+            "seed": seed,
+        },
+        "sizes": [],
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(dir=workdir) as scratch:
+        # guild dbs are opened relative to the working directory
+        os.chdir(scratch)
+        try:
+            for players, matches in sizes:
+                guildid = f"bench_{players}x{matches}"
+                start = time.perf_counter()
+                ids = generate_guild(guildid, players, matches, seed)
+                setup = time.perf_counter() - start
+                print(
+                    f"{players} players, {matches} matches (setup {setup:.1f}s)",
+                    file=sys.stderr,
+                )
+                rng = np.random.default_rng(seed)
+                timings = {}
+                for name, func in benchmarks(guildid, ids, rng).items():
+                    if only and name not in only:
+                        continue
+                    timings[name] = measure(func, repeat)
+                    print(
+                        f"  {name:<28} p50 {timings[name]['p50_ms']:9.2f}ms"
+                        f"  p99 {timings[name]['p99_ms']:9.2f}ms"
+                        f"  peak {timings[name]['peak_kib']:9.0f}KiB",
+                        file=sys.stderr,
+                    )
+                results["sizes"].append(
+                    {
+                        "players": players,
+                        "matches": matches,
+                        "setup_seconds": setup,
+                        "benchmarks": timings,
+                    }
+                )
+                storage.pool.close(guildid)
+        finally:
+            os.chdir(cwd)
+    results["meta"]["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def compare(results, baseline):
+    """Print the p50 of each benchmark relative to a baseline run."""
+    old = {
+        (size["players"], size["matches"], name): timing["p50_ms"]
+        for size in baseline["sizes"]
+        for name, timing in size["benchmarks"].items()
+    }
+    for size in results["sizes"]:
+        for name, timing in size["benchmarks"].items():
+            key = (size["players"], size["matches"], name)
+            if key in old:
+                print(
+                    f"{size['players']}x{size['matches']} {name:<28}"
+                    f" {old[key]:9.2f}ms -> {timing['p50_ms']:9.2f}ms"
+                    f" ({old[key] / timing['p50_ms']:.2f}x)"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark backend hot paths on synthetic guilds."
+    )
+    parser.add_argument(
+        "--sizes", default=DEFAULT_SIZES, help="PLAYERSxMATCHES,... to generate"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=50, help="timed runs per benchmark"
+    )
+    parser.add_argument("--only", nargs="*", help="benchmark names to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare")
+    parser.add_argument("--workdir", help="directory for the scratch guild dbs")
+    args = parser.parse_args()
+
+    ts.TrueSkill(draw_probability=draw_probability).make_as_global()
+    results = run(
+        parse_sizes(args.sizes), args.repeat, args.only, args.seed, args.workdir
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
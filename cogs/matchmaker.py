@@ -1,31 +1,38 @@
+import json
 import logging
+import time
+from math import ceil
 
 import discord
-import trueskill as ts
-from asciichartpy import plot
-from backend import (
-    get_history,
-    get_match_summary,
-    get_past_ratings,
+import metrics
+from async_backend import (
+    compact_history,
+    count_matches,
+    get_data_version,
+    get_history_page,
+    get_rating_series,
     get_playerlist,
     get_ranks,
     get_rating,
+    get_ratings,
     get_win_loss,
+    get_win_losses,
+    played_guilds,
+    run,
+    run_write,
+    warm_up,
 )
-from discord.ext import commands, pages
-from match import Match
-from tabulate import tabulate
+from backend import get_match_summary
+from config import archive_horizon, compaction_interval, warm_up_guilds
+from discord.ext import commands, pages, tasks
+from match import Match, make_matches
+from render_cache import cache
 
 guild_to_players = {}  # guild_id : set of users that have clicked Join
-guild_to_match = {}  # guild_id : Match
+guild_to_matches = {}  # guild_id : list of Matches in progress
 
+# handlers are set up by main.setup_logging
 logger = logging.getLogger("matchmaker")
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename="matchmaker.log", encoding="utf-8", mode="w")
-handler.setFormatter(
-    logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
-)
-logger.addHandler(handler)
 
 
 class Matchmaker(commands.Cog):
@@ -33,6 +40,41 @@ class Matchmaker(commands.Cog):
 
     def __init__(self, bot) -> None:
         self.bot = bot
+        self.warmed_up = False
+
+    def cog_unload(self):
+        """Stop the compaction task."""
+        self.compaction.cancel()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Warm up the most recently played guilds and start compaction, once per process."""
+        if archive_horizon is not None and not self.compaction.is_running():
+            self.compaction.start()
+        if self.warmed_up or not warm_up_guilds:
+            return
+        self.warmed_up = True
+        start = time.perf_counter()
+        guilds = await warm_up([guild.id for guild in self.bot.guilds])
+        seconds = time.perf_counter() - start
+        metrics.observe_startup("warm-up", seconds)
+        logger.info(f"warmed up {len(guilds)} guilds in {seconds:.3f}s")
+
+    @tasks.loop(seconds=compaction_interval)
+    async def compaction(self):
+        """Archive old matches, a segment per write so results never wait long."""
+        if archive_horizon is None:
+            return
+        for guild_id in await played_guilds([guild.id for guild in self.bot.guilds]):
+            archived = 0
+            try:
+                while count := await compact_history(guild_id):
+                    archived += count
+            except Exception:
+                # keep the loop going for other guilds and later passes
+                logger.exception(f"compacting guild {guild_id} failed")
+            if archived:
+                logger.info(f"archived {archived} matches in guild {guild_id}")
 
     @staticmethod
     def get_match_embed(match: Match):
@@ -82,6 +124,7 @@ class Matchmaker(commands.Cog):
         return embed
 
     @discord.slash_command(name="start", description="Start a match.")
+    @metrics.timed("command")
     async def start(self, ctx):
         """Discord slash command to start matchmaking with view to allow players to join."""
 
@@ -99,6 +142,7 @@ class Matchmaker(commands.Cog):
             """Discord view for starting games."""
 
             @discord.ui.button(label="Join", style=discord.ButtonStyle.success)
+            @metrics.timed("button", "join")
             async def join_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Join in guild {interaction.guild.name}"
@@ -111,6 +155,7 @@ class Matchmaker(commands.Cog):
                 )
 
             @discord.ui.button(label="Leave", style=discord.ButtonStyle.danger)
+            @metrics.timed("button", "leave")
             async def leave_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Leave in guild {interaction.guild.name}"
@@ -124,40 +169,60 @@ class Matchmaker(commands.Cog):
                 )
 
             @discord.ui.button(label="Start Game", style=discord.ButtonStyle.primary)
+            @metrics.timed("button", "start_game")
             async def make_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Start Game in guild {interaction.guild.name}"
                 )
                 guild_id = interaction.guild_id
-                players = guild_to_players[guild_id]
+                # a copy, since Join and Leave change the lobby while matches are made
+                players = set(guild_to_players[guild_id])
                 if len(players) < 2:
                     await interaction.response.send_message(
                         "Requires 2+ players.", ephemeral=True, delete_after=3
                     )
                     return
 
-                guild_to_match[guild_id] = Match(
-                    players=guild_to_players[guild_id], guild_id=guild_id
-                )
+                # splitting a large lobby can outlast the 3s to respond to an interaction
+                await interaction.response.defer()
+                # large lobbies are split into several matches, each with its own message
+                matches = await run(make_matches, players=players, guild_id=guild_id)
+                guild_to_matches.setdefault(guild_id, []).extend(matches)
 
-                await interaction.response.edit_message(
-                    content="",
-                    embed=Matchmaker.get_match_embed(guild_to_match[guild_id]),
-                    view=MatchView(timeout=None),
+                def get_match_msg(match):
+                    return f"Match {match.number}" if len(matches) > 1 else ""
+
+                await interaction.edit_original_response(
+                    content=get_match_msg(matches[0]),
+                    embed=Matchmaker.get_match_embed(matches[0]),
+                    view=MatchView(matches[0], timeout=None),
                 )
+                for match in matches[1:]:
+                    await interaction.followup.send(
+                        content=get_match_msg(match),
+                        embed=Matchmaker.get_match_embed(match),
+                        view=MatchView(match, timeout=None),
+                    )
 
-                guild_to_players[guild_id] = set()
+                # anyone who joined meanwhile stays in the lobby
+                guild_to_players[guild_id] -= players
 
         class MatchView(discord.ui.View):
             """Discord view for match in-progress."""
 
+            def __init__(self, match, *args, **kwargs) -> None:
+                super().__init__(*args, **kwargs)
+                self.match = match
+
             @discord.ui.button(label="Move🎤", style=discord.ButtonStyle.blurple)
+            @metrics.timed("button", "move")
             async def move_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Move in guild {interaction.guild.name}"
                 )
                 if button.label == "Move🎤":
                     gd = interaction.guild
+                    a_name, b_name = self.match.get_channel_names()
                     # find team voice channels
                     a_vc, b_vc = None, None
                     # check if category exists
@@ -172,22 +237,22 @@ class Matchmaker(commands.Cog):
                         # ignore voice channels outside of category
                         if vc.category != game_category:
                             continue
-                        if vc.name == "Team A":
+                        if vc.name == a_name:
                             a_vc = vc
-                        elif vc.name == "Team B":
+                        elif vc.name == b_name:
                             b_vc = vc
                     # create vc if necessary
                     if a_vc is None:
                         a_vc = await gd.create_voice_channel(
-                            "Team A", category=game_category
+                            a_name, category=game_category
                         )
                     if b_vc is None:
                         b_vc = await gd.create_voice_channel(
-                            "Team B", category=game_category
+                            b_name, category=game_category
                         )
                     # move members to right channel
-                    team_a = guild_to_match[gd.id].team_a
-                    team_b = guild_to_match[gd.id].team_b
+                    team_a = self.match.team_a
+                    team_b = self.match.team_b
                     count = 0
                     for a in team_a:
                         member = gd.get_member(int(a))
@@ -205,35 +270,42 @@ class Matchmaker(commands.Cog):
                 else:
                     # find voice channels
                     gd = interaction.guild
+                    a_name, b_name = self.match.get_channel_names()
                     for vc in gd.voice_channels:
                         # ignore voice channels outside of game category
                         if vc.category is not None and vc.category.name != "beep boop":
                             continue
-                        elif vc.name == "Team A":
+                        elif vc.name == a_name:
                             for vc2 in gd.voice_channels:
-                                if vc2.name == "Team B":
+                                if vc2.name == b_name:
                                     for player in vc.members:
                                         await player.move_to(vc2)
                     button.label = "Move🎤"
                     await interaction.response.edit_message(view=self)
 
             @discord.ui.button(label="Record Result", style=discord.ButtonStyle.success)
+            @metrics.timed("button", "record_result")
             async def record_result_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Record Result in guild {interaction.guild.name}"
                 )
-                match = guild_to_match[guild_id]
                 await interaction.response.send_modal(
-                    RecordModal(parent_interaction=interaction, title=match.get_title())
+                    RecordModal(
+                        self.match,
+                        parent_interaction=interaction,
+                        title=self.match.get_title(),
+                    )
                 )
 
             @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
+            @metrics.timed("button", "cancel")
             async def cancel_button_cb(self, button, interaction):
                 logger.debug(
                     f"{interaction.user.name} pressed Cancel in guild {interaction.guild.name}"
                 )
                 guild_id = interaction.guild_id
-                guild_to_match[guild_id] = None
+                if self.match in guild_to_matches.get(guild_id, []):
+                    guild_to_matches[guild_id].remove(self.match)
                 await interaction.response.edit_message(
                     content="Match cancelled.", view=None
                 )
@@ -241,8 +313,9 @@ class Matchmaker(commands.Cog):
         class RecordModal(discord.ui.Modal):
             """Modal for entering results of matches."""
 
-            def __init__(self, parent_interaction, *args, **kwargs) -> None:
+            def __init__(self, match, parent_interaction, *args, **kwargs) -> None:
                 super().__init__(*args, **kwargs)
+                self.match = match
                 self.parent_interaction = parent_interaction
                 self.add_item(
                     discord.ui.InputText(label="Team A Score", placeholder="0")
@@ -251,14 +324,22 @@ class Matchmaker(commands.Cog):
                     discord.ui.InputText(label="Team B Score", placeholder="0")
                 )
 
+            @metrics.timed("modal", "record_result")
             async def callback(self, interaction: discord.Interaction):
                 logger.debug(
                     f"{interaction.user.name} submitted Result in guild {interaction.guild.name}"
                 )
                 team_a_score = int(self.children[0].value)
                 team_b_score = int(self.children[1].value)
-                match = guild_to_match[guild_id]
-                match.record_result(a_score=team_a_score, b_score=team_b_score)
+                match = self.match
+                await run_write(
+                    match.guild_id,
+                    match.record_result,
+                    a_score=team_a_score,
+                    b_score=team_b_score,
+                )
+                if match in guild_to_matches.get(match.guild_id, []):
+                    guild_to_matches[match.guild_id].remove(match)
                 await self.parent_interaction.message.edit(
                     content="", embed=Matchmaker.get_post_match_embed(match), view=None
                 )
@@ -274,24 +355,43 @@ class Matchmaker(commands.Cog):
         await ctx.respond(start_msg, view=StartView(timeout=None))
 
     @discord.slash_command(name="leaderboard", description="Display the leaderboard.")
+    @metrics.timed("command")
     async def leaderboard(self, ctx):
         """Discord slash command to show leaderboard."""
         await ctx.defer()
-        ranks = get_ranks(get_playerlist(ctx.guild.id), ctx.guild.id, metric="exposure")
+        # read the version first, so a result recorded while rendering invalidates it
+        version = await get_data_version(ctx.guild.id)
+        text = cache.get(ctx.guild.id, "leaderboard", version)
+        if text is None:
+            text = await self.render_leaderboard(ctx.guild)
+            cache.put(ctx.guild.id, "leaderboard", version, text)
+        await ctx.respond(text)
+
+    @staticmethod
+    async def render_leaderboard(guild):
+        """Get the leaderboard table as message text."""
+        # only needed to render, so kept out of startup
+        import trueskill as ts
+        from tabulate import tabulate
+
+        ranks = await get_ranks(
+            await get_playerlist(guild.id), guild.id, metric="exposure"
+        )
         if not ranks:
-            await ctx.respond("No Ranked Players.")
-            return
+            return "No Ranked Players."
         leaderboard = sorted(ranks.keys(), key=lambda x: ranks[x])
+        ratings = await get_ratings(leaderboard, guild.id)
+        win_losses = await get_win_losses(leaderboard, guild.id)
         output = []
         headers = ["Rank", "Name", "Rating", "Score", "Win/Loss"]
         for item in leaderboard:
-            member = ctx.guild.get_member(int(item))
+            member = guild.get_member(int(item))
             if member:
                 rank = ranks[item]
                 name = member.name
-                rating = get_rating(item, ctx.guild.id)
+                rating = ratings[item]
                 exposure = ts.expose(rating)
-                w, l = get_win_loss(item, ctx.guild.id)
+                w, l = win_losses[item]
                 output.append(
                     [
                         rank,
@@ -301,49 +401,56 @@ class Matchmaker(commands.Cog):
                         f"{w}W {l}L",
                     ]
                 )
-        await ctx.respond(
-            f"`{tabulate(output, headers=headers, tablefmt='psql', floatfmt='.4f')}`"
-        )
+        return f"`{tabulate(output, headers=headers, tablefmt='psql', floatfmt='.4f')}`"
 
     @discord.slash_command(name="history", description="Display match history")
+    @metrics.timed("command")
     async def history(self, ctx):
         """Discord slash command for showing guild-wide match history."""
 
-        def get_pages(history):
-            output = []
-            for i in range(0, len(history), 5):
-                chunk = history[i : i + 5]
-                embeds = []
-                for match in chunk:
-                    match = Match(players=None, guild_id=ctx.guild.id, db_match=match)
-                    embed = Matchmaker.get_post_match_embed(match)
-                    embeds.append(embed)
-                output.append(pages.Page(title=f"History", embeds=embeds))
-            return output
-
         await ctx.defer()
-        history = get_history(ctx.guild.id)
-        if history:
-            paginator = pages.Paginator(pages=get_pages(history))
+        match_count = await count_matches(ctx.guild.id)
+        if match_count:
+            paginator = HistoryPaginator(guild_id=ctx.guild.id, match_count=match_count)
             await paginator.respond(ctx.interaction)
         else:
             await ctx.respond("No Matches Found.")
 
     @discord.user_command(name="Rating and History")
+    @metrics.timed("command")
     async def user_rating_history(self, ctx, member: discord.Member):
         """Discord user command for showing user's profile, incl. rating, rank, w/l, recent matches, graph."""
         await ctx.defer()
+        version = await get_data_version(ctx.guild.id)
+        # name and avatar are part of the embed but not of the guild's data
+        key = ("profile", member.id, member.name, str(member.display_avatar.url))
+        text = cache.get(ctx.guild.id, key, version)
+        if text is None:
+            embed = await self.render_profile(ctx.guild, member)
+            cache.put(ctx.guild.id, key, version, json.dumps(embed.to_dict()))
+        else:
+            embed = discord.Embed.from_dict(json.loads(text))
+        await ctx.respond(embed=embed)
+
+    @staticmethod
+    async def render_profile(guild, member):
+        """Get the embed for a user's profile."""
+        # only needed to render, so kept out of startup
+        import trueskill as ts
+        from asciichartpy import plot
+
         user_id = str(member.id)
         pfp = member.display_avatar
-        rating = get_rating(user_id, ctx.guild.id)
-        history = get_history(ctx.guild.id, user_id)
-        win, loss = get_win_loss(user_id, ctx.guild.id)
+        rating = await get_rating(user_id, guild.id)
+        history, _ = await get_history_page(guild.id, user_id, limit=5)
+        win, loss = await get_win_loss(user_id, guild.id)
         win_rate = win / (win + loss) if history else 0
         if history:
-            rank = get_ranks(players=[user_id], guildid=ctx.guild.id)[user_id]
+            rank = (await get_ranks(players=[user_id], guildid=guild.id))[user_id]
         else:
             rank = "N/A"
-        past_ratings = get_past_ratings(user_id, ctx.guild.id)
+        series = await get_rating_series(user_id, guild.id)
+        past_ratings = [*series["old_mu"], rating.mu]
 
         # plot rating history
         # scaling
@@ -359,19 +466,11 @@ class Matchmaker(commands.Cog):
         if history:
             match_history = []
             short_history = []
-            for match in history[:5]:
+            for match in history:
                 summary = get_match_summary(match, timestamps=False, names=True)
-                old = match["old_ratings"][user_id].mu
-                if user_id in match["team_a"]:
-                    new = match["team_a"][user_id].mu
-                    delta = new - old
-                    short_history.append(f"{'✅' if delta > 0 else '❌'}")
-                    match_history.append(f"{summary} ({delta:+.2f})")
-                else:
-                    new = match["team_b"][user_id].mu
-                    delta = new - old
-                    short_history.append(f"{'✅' if delta > 0 else '❌'}")
-                    match_history.append(f"{summary} ({delta:+.2f})")
+                delta = match.delta(user_id)
+                short_history.append(f"{'✅' if delta > 0 else '❌'}")
+                match_history.append(f"{summary} ({delta:+.2f})")
             match_history = "\n".join(match_history[:3])
             short_history = "".join(short_history)
         else:
@@ -393,7 +492,56 @@ class Matchmaker(commands.Cog):
             embed.add_field(
                 name="Graph", value=f"```\n{rating_graph}\n```", inline=False
             )
-        await ctx.respond(embed=embed)
+        return embed
+
+
+class HistoryPaginator(pages.Paginator):
+    """Paginator over match history that only fetches and renders the page being shown."""
+
+    page_size = 5
+
+    def __init__(self, guild_id, match_count, user_id=None, **kwargs):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.cursors = {0: None}  # page number : get_history_page cursor, once known
+        page_count = max(ceil(match_count / self.page_size), 1)
+        super().__init__(pages=[None] * page_count, **kwargs)
+
+    async def load_page(self, page_number):
+        """Fetch and render a page the first time it is shown."""
+        if self.pages[page_number] is not None:
+            return
+        if page_number in self.cursors:
+            history, cursor = await get_history_page(
+                self.guild_id,
+                self.user_id,
+                before=self.cursors[page_number],
+                limit=self.page_size,
+            )
+        else:
+            # jumped past pages we haven't seen, e.g. with the last page button
+            history, cursor = await get_history_page(
+                self.guild_id,
+                self.user_id,
+                limit=self.page_size,
+                offset=page_number * self.page_size,
+            )
+        self.cursors[page_number + 1] = cursor
+        embeds = [
+            Matchmaker.get_post_match_embed(
+                Match(players=None, guild_id=self.guild_id, db_match=match)
+            )
+            for match in history
+        ]
+        self.pages[page_number] = pages.Page(title="History", embeds=embeds)
+
+    async def goto_page(self, page_number=0, *, interaction=None):
+        await self.load_page(page_number)
+        return await super().goto_page(page_number, interaction=interaction)
+
+    async def respond(self, *args, **kwargs):
+        await self.load_page(self.current_page)
+        return await super().respond(*args, **kwargs)
 
 
 def setup(bot):
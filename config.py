@@ -1,3 +1,75 @@
-show_test_commands = True
 time_format = "%a %b %d %I:%M %p"
 
+# TrueSkill Rating Settings
+draw_probability = 0.01
+
+
+# team search budget for make_teams: lobbies with at most this many distinct splits are
+# searched exhaustively, larger ones by local search capped at the same number of evaluations
+team_search_max_evaluations = 50000
+team_search_time_limit = 0.5  # seconds
+
+# target players per team when a /start lobby is split into several matches, and whether
+# to maximize the "worst" match quality or the "total". None always makes one match.
+lobby_team_size = 5
+lobby_objective = "worst"
+
+# per-guild sqlite connections kept open, and seconds before an unused one is closed
+storage_max_connections = 64
+storage_idle_timeout = 600
+# seconds to wait for another process's write lock on a guild db before giving up
+storage_busy_timeout = 30
+
+# characters of rendered leaderboards and profiles kept in memory, see render_cache.py
+render_cache_max_bytes = 4 * 1024 * 1024
+# seconds a cached render stays valid without a write, since sigma decay changes ratings
+render_cache_max_age = 600
+
+# seconds between full re-keys of a guild's rank index (see rank_index.py). Ranks are exact
+# either way; decay since the last re-key only widens the part of each query recomputed.
+rank_index_max_age = 60
+
+# guilds whose ratings and rank indexes are loaded in the background once the bot is ready,
+# most recently played first. Keep it within storage_max_connections, since they live on
+# the pooled connections. 0 disables warm-up.
+warm_up_guilds = 32
+
+# threads running blocking backend work off the discord event loop
+backend_workers = 4
+
+# prometheus metrics served at http://metrics_host:metrics_port/metrics. None disables it.
+metrics_host = "127.0.0.1"
+metrics_port = 9100
+# upper bounds in seconds of the call latency histogram buckets
+metrics_buckets = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# sharded mode (python main.py --workers N): shards per worker process when --shards isn't
+# given, and seconds a worker must stay up before its restart backoff resets
+shards_per_worker = 1
+worker_restart_reset = 300
+
+# history compaction: every checkpoint_interval matches, every player's rating, counters and
+# last match time are snapshotted and the newest checkpoints_kept snapshots are kept. Every
+# compaction_interval seconds, a background task moves matches older than archive_horizon
+# days into compressed segments of at most archive_segment_matches matches, one segment per
+# write. Archived matches still show in /history but can't be undone or replayed, so
+# compaction is opt-in: None, the default, keeps all history live and the task does nothing.
+checkpoint_interval = 1000
+checkpoints_kept = 4
+archive_horizon = None
+archive_segment_matches = 5000
+compaction_interval = 3600
@@ -0,0 +1,167 @@
+import argparse
+import json
+import zipfile
+from itertools import chain, islice
+
+import numpy as np
+
+from archive import archived_rows, from_column, to_columns
+from series import rebuild_series
+from storage import MIGRATIONS, bump_data_version, connect, rebuild_stats
+
+FORMAT_VERSION = 1
+# rows per chunk, the most held in memory at once while exporting or importing
+CHUNK_SIZE = 50000
+
+# exported tables: (name, query in export order, insert statement, column dtypes)
+# player_stats and rating_series are derived, so they are rebuilt on import instead.
+# Archived matches are exported ahead of live ones and come back live, without checkpoints.
+# NULLs are written as NaN, which never occurs as a real value in these columns.
+TABLES = [
+    (
+        # rowid order is kept, since the guild model breaks rank ties in that order
+        "ratings",
+        "SELECT user_id, mu, sigma, last_match_time FROM ratings ORDER BY rowid",
+        "INSERT INTO ratings (user_id, mu, sigma, last_match_time) VALUES (?, ?, ?, ?)",
+        {"user_id": "U", "mu": "f8", "sigma": "f8", "last_match_time": "f8"},
+    ),
+    (
+        "matches",
+        "SELECT id, time, team_a_score, team_b_score FROM matches ORDER BY id",
+        "INSERT INTO matches (id, time, team_a_score, team_b_score) VALUES (?, ?, ?, ?)",
+        {"id": "i8", "time": "f8", "team_a_score": "i8", "team_b_score": "i8"},
+    ),
+    (
+        # rowid order is kept, since replay rates players in that order
+        "match_players",
+        "SELECT match_id, user_id, team, old_mu, old_sigma, new_mu, new_sigma,"
+        " prev_sigma, prev_last_match_time FROM match_players ORDER BY match_id, rowid",
+        "INSERT INTO match_players (match_id, user_id, team, old_mu, old_sigma, new_mu,"
+        " new_sigma, prev_sigma, prev_last_match_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        {
+            "match_id": "i8",
+            "user_id": "U",
+            "team": "i1",
+            "old_mu": "f8",
+            "old_sigma": "f8",
+            "new_mu": "f8",
+            "new_sigma": "f8",
+            "prev_sigma": "f8",
+            "prev_last_match_time": "f8",
+        },
+    ),
+]
+
+
+def write_array(archive, name, array):
+    """Write one array into the zip as name.npy, streamed rather than built in memory."""
+    with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, array, allow_pickle=False)
+
+
+def export_guild(guildid, path, chunk_size=CHUNK_SIZE):
+    """Write the guild's ratings and match history to a compressed .npz file.
+
+    Each table is written in chunks of chunk_size rows as table/chunk/column arrays, so
+    memory use doesn't grow with history size. Readable with np.load. Every table is read
+    in one transaction, so results recorded meanwhile can't leave them inconsistent.
+
+    Checkpoints aren't exported, and archived matches are written like live ones: an
+    imported guild has its whole history live, as it was before compaction.
+
+    Returns:
+        Dict[str, int]: rows written per table.
+    """
+    counts = {}
+    with connect(guildid) as db, zipfile.ZipFile(
+        path, "w", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        # one snapshot for every table. WAL lets results be recorded while it's open.
+        db.execute("BEGIN")
+        for table, query, _, dtypes in TABLES:
+            source = db.execute(query)
+            if table != "ratings":
+                source = chain(archived_rows(db, table), source)
+            chunk = 0
+            counts[table] = 0
+            while True:
+                rows = list(islice(source, chunk_size))
+                if not rows:
+                    break
+                for column, array in to_columns(rows, dtypes).items():
+                    write_array(archive, f"{table}/{chunk:06d}/{column}", array)
+                counts[table] += len(rows)
+                chunk += 1
+        meta = {
+            "format": FORMAT_VERSION,
+            "schema": len(MIGRATIONS),
+            "guild": str(guildid),
+            "rows": counts,
+        }
+        write_array(archive, "meta", np.array(json.dumps(meta)))
+    return counts
+
+
+def read_meta(path):
+    """The metadata of an export: format and schema version, source guild, row counts."""
+    with np.load(path, allow_pickle=False) as data:
+        return json.loads(str(data["meta"]))
+
+
+def import_guild(guildid, path):
+    """Load an export into a guild with no ratings or matches yet.
+
+    Chunks are inserted one at a time in a single transaction, then player_stats and
+    rating_series are rebuilt.
+
+    Returns:
+        Dict[str, int]: rows read per table.
+    """
+    meta = read_meta(path)
+    if meta["format"] != FORMAT_VERSION:
+        raise ValueError(f"unsupported export format {meta['format']}")
+    counts = {}
+    with np.load(path, allow_pickle=False) as data, connect(guildid) as db:
+        db.execute("BEGIN IMMEDIATE")
+        for table in ("ratings", "matches", "archive_segments"):
+            if db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]:
+                raise ValueError(f"guild {guildid} already has {table}")
+        chunks = {}  # table : {chunk name : [column names]}
+        for name in data.files:
+            if name.count("/") == 2:
+                table, chunk, column = name.split("/")
+                chunks.setdefault(table, {}).setdefault(chunk, []).append(column)
+        for table, _, insert, dtypes in TABLES:
+            counts[table] = 0
+            for chunk in sorted(chunks.get(table, {})):
+                columns = [
+                    from_column(data[f"{table}/{chunk}/{column}"]) for column in dtypes
+                ]
+                rows = list(zip(*columns))
+                db.executemany(insert, rows)
+                counts[table] += len(rows)
+        rebuild_stats(db)
+        rebuild_series(db)
+        bump_data_version(db)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export or import a guild's ratings and match history."
+    )
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("guildid")
+    parser.add_argument("path", help=".npz file to write or read")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.action == "export":
+        counts = export_guild(args.guildid, args.path, args.chunk_size)
+    else:
+        counts = import_guild(args.guildid, args.path)
+    print(", ".join(f"{count} {table}" for table, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,119 @@
+import argparse
 import logging
 import os
+import time
 
-import discord
 import dotenv
-import trueskill as ts
 
-from config import show_test_commands
+import metrics
+import supervisor
+from config import draw_probability, metrics_port, shards_per_worker
 
 # load env
 if os.path.isfile(".env"):
     dotenv.load_dotenv(".env")
 
-# set up logging
-logger = logging.getLogger("discord")
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename="discord.log", encoding="utf-8", mode="w")
-handler.setFormatter(
-    logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
-)
-logger.addHandler(handler)
 
-# discord py client
-intents = discord.Intents.default()
-intents.members = True
-bot = discord.Bot(intents=intents)
+def setup_logging(suffix=""):
+    """Log the discord and matchmaker loggers to discord{suffix}.log and matchmaker{suffix}.log."""
+    formatter = logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s")
+    for name in ("discord", "matchmaker"):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        handler = logging.FileHandler(
+            filename=f"{name}{suffix}.log", encoding="utf-8", mode="w"
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    # the metrics server would otherwise log every scrape
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
-# TrueSkill Rating Settings
-env = ts.TrueSkill(draw_probability=0.01)
-env.make_as_global()
 
+def create_bot(shard_ids=None, shard_count=None):
+    """Create the bot with its cogs loaded. With shard_ids, it runs only those shards."""
+    import discord
 
-@bot.event
-async def on_ready():
-    print(f"Logged in as {bot.user}")
+    # discord py client
+    intents = discord.Intents.default()
+    intents.members = True
+    if shard_ids is None:
+        bot = discord.Bot(intents=intents)
+    else:
+        bot = discord.AutoShardedBot(
+            intents=intents, shard_ids=shard_ids, shard_count=shard_count
+        )
 
+    logged_in = False
 
-bot.load_extension("cogs.matchmaker")
-if show_test_commands:
-    bot.load_extension("cogs.test")
-bot.run(os.getenv("TOKEN"))
+    @bot.event
+    async def on_ready():
+        nonlocal logged_in
+        shards = f" (shards {shard_ids} of {shard_count})" if shard_ids else ""
+        print(f"Logged in as {bot.user}{shards}")
+        if not logged_in:
+            # on_ready fires again after reconnects
+            logged_in = True
+            metrics.observe_startup("login", time.perf_counter() - created)
+            logging.getLogger("matchmaker").info(metrics.startup_report())
+
+    bot.load_extension("cogs.matchmaker")
+    created = time.perf_counter()
+    return bot
+
+
+def run(shard_ids=None, shard_count=None, worker=None):
+    """Run the bot until it disconnects.
+
+    Args:
+        shard_ids (List[int], optional): shards to run. Defaults to all of them, unsharded.
+        shard_count (int, optional): total shards across all workers.
+        worker (int, optional): worker number in sharded mode. Keeps each worker's log
+            files and metrics port apart.
+    """
+    setup_logging("" if worker is None else f"-{worker}")
+    with metrics.startup_phase("imports"):
+        # imported here, so the supervisor process, which only starts workers, skips them
+        import trueskill as ts
+
+        import async_backend
+        import storage
+
+    # TrueSkill Rating Settings
+    env = ts.TrueSkill(draw_probability=draw_probability)
+    env.make_as_global()
+
+    if metrics_port:
+        with metrics.startup_phase("metrics server"):
+            metrics.start_server(port=metrics_port + (worker or 0))
+    with metrics.startup_phase("bot"):
+        bot = create_bot(shard_ids, shard_count)
+    try:
+        bot.run(os.getenv("TOKEN"))
+    finally:
+        async_backend.executor.shutdown()
+        storage.pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the matchmaker bot.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="run sharded, with this many worker processes under a supervisor",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="total shards in sharded mode. Defaults to workers * shards_per_worker.",
+    )
+    args = parser.parse_args()
+
+    if args.workers:
+        shards = args.shards or args.workers * shards_per_worker
+        supervisor.supervise(run, args.workers, shards)
+    else:
+        run()
+
+
+if __name__ == "__main__":
+    main()
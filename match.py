@@ -1,7 +1,10 @@
 from datetime import datetime
 import discord
-from typing import Dict, Optional, Set
+from typing import List, Optional, Set, Tuple
+from backend import make_matches as backend_make_matches
 from backend import make_teams, record_result
+from model import MatchRecord
+from storage import TEAM_A, TEAM_B
 
 
 class Match:
@@ -9,28 +12,36 @@ class Match:
         self,
         players: Optional[Set[discord.User]],
         guild_id: int,
-        db_match: Optional[Dict] = None,
+        db_match: Optional[MatchRecord] = None,
+        teams: Optional[Tuple] = None,
+        number: int = 1,
     ):
         """Initialize and matchmake an object representing a single match.
 
         Args:
             players (Set[discord.User]): players in the match.
             guild_id (int): guild id of the match.
-            db_match (Dict, optional): match history dictionary from db. Defaults to None.
+            db_match (MatchRecord, optional): match from history. Defaults to None.
+            teams (Tuple, optional): make_teams result to use instead of matchmaking.
+            number (int, optional): position among matches made from the same lobby.
         """
+        self.number = number
         if db_match:
             self.load_match(db_match, guild_id)
         else:
             self.players = players
             self.guild_id = guild_id
             player_ids = [player.id for player in self.players]
+            if teams is None:
+                teams = make_teams(player_ids, self.guild_id)
             (
                 self.team_a,
                 self.team_b,
                 self.quality,
                 self.a_win_prob,
                 self.b_win_prob,
-            ) = make_teams(player_ids, self.guild_id)
+                self.evaluated,
+            ) = teams
             self.team_a_score = 0
             self.team_b_score = 0
             self.start_time = datetime.now()
@@ -59,25 +70,44 @@ class Match:
             return f"{','.join([f'<@!{id}>' for id in self.team_a])} {self.team_a_score}-{self.team_b_score} {','.join([f'<@!{id}>' for id in self.team_b])}"
         return None
 
+    def get_channel_names(self):
+        """Get names of the voice channels for team A and team B."""
+        if self.number == 1:
+            return "Team A", "Team B"
+        return f"Team A ({self.number})", f"Team B ({self.number})"
+
     def get_time_string(self):
         """Get formatted full timestamp for match."""
         time_format = "%A, %b %d @ %I:%M %p"
         return self.start_time.strftime(time_format)
 
-    def load_match(self, match: Dict, guild_id: int):
-        """Load a match from db dict.
+    def load_match(self, match: MatchRecord, guild_id: int):
+        """Load a match from history.
 
         Args:
-            match (Dict): match history dictionary from db.
+            match (MatchRecord): match from get_history or get_history_page.
         """
         self.guild_id = guild_id
-        self.start_time = match["time"]
-        self.team_a = [id for id in match["team_a"]]
-        self.team_b = [id for id in match["team_b"]]
-        self.team_a_new, self.team_b_new = match["team_a"], match["team_b"]
-        self.team_a_old = {k: match["old_ratings"][k] for k in self.team_a_new}
-        self.team_b_old = {k: match["old_ratings"][k] for k in self.team_b_new}
-        self.team_a_score, self.team_b_score = (
-            match["team_a_score"],
-            match["team_b_score"],
+        self.start_time = match.time
+        self.team_a = match.team_a
+        self.team_b = match.team_b
+        self.team_a_new = match.team_ratings(TEAM_A)
+        self.team_b_new = match.team_ratings(TEAM_B)
+        self.team_a_old = match.team_ratings(TEAM_A, new=False)
+        self.team_b_old = match.team_ratings(TEAM_B, new=False)
+        self.team_a_score, self.team_b_score = match.team_a_score, match.team_b_score
+
+
+def make_matches(players: Set[discord.User], guild_id: int) -> List[Match]:
+    """Matchmake a lobby into one or more matches, numbered from 1."""
+    by_id = {str(player.id): player for player in players}
+    found, evaluated = backend_make_matches(list(by_id), guild_id)
+    return [
+        Match(
+            {by_id[uid] for uid in [*teams[0], *teams[1]]},
+            guild_id,
+            teams=(*teams, evaluated),
+            number=number,
         )
+        for number, teams in enumerate(found, 1)
+    ]
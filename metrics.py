@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+import functools
+import inspect
+import threading
+import time
+from bisect import bisect_left
+
+from config import metrics_buckets, metrics_host, metrics_port
+
+
+class CallStats:
+    """Latency histogram and error count of one instrumented callable."""
+
+    def __init__(self):
+        self.counts = [0] * (len(metrics_buckets) + 1)  # per bucket, last one is +Inf
+        self.total = 0.0
+        self.errors = 0
+
+
+stats = {}  # (kind, name) : CallStats
+stats_lock = threading.Lock()
+startup = []  # (phase, seconds) of this process's startup steps, in order
+
+
+def observe(kind, name, seconds, error=False):
+    """Record one call. Cheap enough to run on every call; rendering happens on scrape."""
+    bucket = bisect_left(metrics_buckets, seconds)
+    with stats_lock:
+        entry = stats.get((kind, name))
+        if entry is None:
+            entry = stats[(kind, name)] = CallStats()
+        entry.counts[bucket] += 1
+        entry.total += seconds
+        entry.errors += error
+
+
+def observe_startup(phase, seconds):
+    """Record one step of process startup, for startup_report and as a metric."""
+    startup.append((phase, seconds))
+    observe("startup", phase, seconds)
+
+
+@contextlib.contextmanager
+def startup_phase(phase):
+    """Time the body of a with statement as a step of process startup."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_startup(phase, time.perf_counter() - start)
+
+
+def startup_report():
+    """The startup steps recorded so far, as one log line."""
+    total = sum(seconds for _, seconds in startup)
+    steps = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup)
+    return f"startup took {total:.3f}s: {steps}"
+
+
+def timed(kind, name=None):
+    """Decorator recording the duration and errors of a function or coroutine function."""
+
+    def decorator(func):
+        label = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = False
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    observe(kind, label, time.perf_counter() - start, error)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                error = False
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    error = True
+                    raise
+                finally:
+                    observe(kind, label, time.perf_counter() - start, error)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(namespace, kind, exclude=()):
+    """Wrap every public function defined in a module's namespace (pass globals())."""
+    for name, obj in list(namespace.items()):
+        if (
+            not name.startswith("_")
+            and name not in exclude
+            and inspect.isfunction(obj)
+            and obj.__module__ == namespace["__name__"]
+        ):
+            namespace[name] = timed(kind, name)(obj)
+
+
+def render():
+    """All stats in the Prometheus text exposition format."""
+    with stats_lock:
+        snapshot = [
+            (kind, name, list(entry.counts), entry.total, entry.errors)
+            for (kind, name), entry in sorted(stats.items())
+        ]
+    lines = [
+        "# HELP matchmaker_call_seconds Duration of instrumented calls.",
+        "# TYPE matchmaker_call_seconds histogram",
+    ]
+    for kind, name, counts, total, _ in snapshot:
+        labels = f'kind="{kind}",name="{name}"'
+        cumulative = 0
+        for bound, count in zip([*metrics_buckets, "+Inf"], counts):
+            cumulative += count
+            lines.append(
+                f'matchmaker_call_seconds_bucket{{{labels},le="{bound}"}} {cumulative}'
+            )
+        lines.append(f"matchmaker_call_seconds_sum{{{labels}}} {total}")
+        lines.append(f"matchmaker_call_seconds_count{{{labels}}} {cumulative}")
+    lines += [
+        "# HELP matchmaker_call_errors_total Instrumented calls that raised.",
+        "# TYPE matchmaker_call_errors_total counter",
+    ]
+    for kind, name, _, _, errors in snapshot:
+        lines.append(
+            f'matchmaker_call_errors_total{{kind="{kind}",name="{name}"}} {errors}'
+        )
+    return "\n".join(lines) + "\n"
+
+
+def start_server(host=metrics_host, port=metrics_port):
+    """Serve render() at /metrics from a daemon thread."""
+    # only the bot process serves metrics, so keep flask out of backend imports
+    from flask import Flask, Response
+
+    app = Flask("metrics")
+
+    @app.route("/metrics")
+    def scrape():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    thread = threading.Thread(
+        target=app.run,
+        kwargs={"host": host, "port": port, "use_reloader": False},
+        name="metrics",
+        daemon=True,
+    )
+    thread.start()
+    return thread
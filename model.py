@@ -0,0 +1,225 @@
+from array import array
+from datetime import datetime
+
+import numpy as np
+import trueskill as ts
+
+from config import rank_index_max_age
+from CustomTrueSkill import decay_ratings
+from rank_index import RankIndex
+from storage import TEAM_A
+
+# each player's ratings in a MatchRecord, stored as consecutive doubles
+RATING_FIELDS = ("old_mu", "old_sigma", "new_mu", "new_sigma")
+RATING_SIZE = len(RATING_FIELDS)
+# ids per "IN (...)" query, under sqlite's default limit on bound parameters
+QUERY_CHUNK = 500
+
+
+class MatchRecord:
+    """A recorded match, with players as indices into their guild model's id list.
+
+    Players are stored team A first, and their ratings packed RATING_SIZE doubles per
+    player, so a match costs a few small objects instead of dicts of Ratings.
+    """
+
+    __slots__ = (
+        "id",
+        "timestamp",
+        "team_a_score",
+        "team_b_score",
+        "ids",
+        "players",
+        "team_a_size",
+        "ratings",
+    )
+
+    def __init__(self, match_id, timestamp, team_a_score, team_b_score, ids):
+        self.id = match_id
+        self.timestamp = timestamp
+        self.team_a_score = team_a_score
+        self.team_b_score = team_b_score
+        self.ids = ids  # the model's index : user id list, shared by its records
+        self.players = array("i")
+        self.team_a_size = 0
+        self.ratings = array("d")
+
+    @property
+    def time(self):
+        """When the match was recorded, as a datetime."""
+        return datetime.fromtimestamp(self.timestamp)
+
+    @property
+    def team_a(self):
+        """User ids on team A."""
+        return [self.ids[i] for i in self.players[: self.team_a_size]]
+
+    @property
+    def team_b(self):
+        """User ids on team B."""
+        return [self.ids[i] for i in self.players[self.team_a_size :]]
+
+    def position(self, userid):
+        """Position of userid among the match's players, or None if they didn't play."""
+        for position, index in enumerate(self.players):
+            if self.ids[index] == userid:
+                return position
+        return None
+
+    def old_rating(self, userid):
+        """The user's rating going into the match."""
+        base = self.position(userid) * RATING_SIZE
+        return ts.Rating(self.ratings[base], self.ratings[base + 1])
+
+    def new_rating(self, userid):
+        """The user's rating after the match."""
+        base = self.position(userid) * RATING_SIZE
+        return ts.Rating(self.ratings[base + 2], self.ratings[base + 3])
+
+    def delta(self, userid):
+        """Change in the user's mu from the match."""
+        base = self.position(userid) * RATING_SIZE
+        return self.ratings[base + 2] - self.ratings[base]
+
+    def team_ratings(self, team, new=True):
+        """{userid: rating} for a team's players (TEAM_A or TEAM_B), after or before."""
+        if team == TEAM_A:
+            positions = range(self.team_a_size)
+        else:
+            positions = range(self.team_a_size, len(self.players))
+        offset = 2 if new else 0
+        return {
+            self.ids[self.players[p]]: ts.Rating(
+                self.ratings[p * RATING_SIZE + offset],
+                self.ratings[p * RATING_SIZE + offset + 1],
+            )
+            for p in positions
+        }
+
+
+class GuildModel:
+    """A guild's ratings as arrays over a dense player index.
+
+    Player i has user id ids[i] and rating mu[i], sigma[i], last played at last[i] (NaN
+    if never). Players only seen in history, without a row in the ratings table, have
+    NaN ratings.
+
+    A model is a snapshot of the db, valid while the connection it was loaded on has made
+    no changes and seen no commits from other connections (see load_model), or until
+    update is called after writing ratings.
+    """
+
+    def __init__(self, ids, mu, sigma, last, state):
+        self.ids = ids
+        self.index = {userid: i for i, userid in enumerate(ids)}
+        self.mu = mu
+        self.sigma = sigma
+        self.last = last
+        self.state = state
+        self.rank_indexes = {}  # metric : RankIndex, built on first use
+
+    def rated(self):
+        """Indices of the players in the ratings table."""
+        return np.flatnonzero(~np.isnan(self.mu))
+
+    def intern(self, userid):
+        """Dense index of userid, adding it without a rating if it's new."""
+        index = self.index.get(userid)
+        if index is None:
+            index = self.index[userid] = len(self.ids)
+            self.ids.append(userid)
+            self.mu = np.append(self.mu, np.nan)
+            self.sigma = np.append(self.sigma, np.nan)
+            self.last = np.append(self.last, np.nan)
+        return index
+
+    def decayed(self, current_time, players):
+        """mu, decayed sigma and exposure arrays of players (rated indices)."""
+        mu = self.mu[players]
+        elapsed = current_time.timestamp() - self.last[players]
+        return (mu, *decay_ratings(mu, self.sigma[players], elapsed))
+
+    def rank_index(self, metric, current_time):
+        """The RankIndex of metric, re-keyed every rank_index_max_age seconds."""
+        index = self.rank_indexes.get(metric)
+        if index is None:
+            index = self.rank_indexes[metric] = RankIndex(self, metric, current_time)
+        elif (current_time - index.time).total_seconds() > rank_index_max_age:
+            # keeps drift, and with it the work per query, small
+            index.rebuild(current_time)
+        return index
+
+    def update(self, db, users, current_time):
+        """Re-read users' ratings after writing them on db, keeping the model current.
+
+        Only valid if the model was current before the writes. If another connection
+        committed meanwhile, the model is dropped and reloads on next use.
+        """
+        if state(db)[0] != self.state[0]:
+            db.model = None
+            return
+        users = [str(userid) for userid in users]
+        rows = [
+            row
+            for i in range(0, len(users), QUERY_CHUNK)
+            for row in db.execute(
+                "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+                f" WHERE user_id IN ({', '.join('?' * len(users[i : i + QUERY_CHUNK]))})",
+                users[i : i + QUERY_CHUNK],
+            )
+        ]
+        for userid, mu, sigma, last in rows:
+            i = self.intern(userid)
+            self.mu[i], self.sigma[i] = mu, sigma
+            self.last[i] = np.nan if last is None else last
+            for index in self.rank_indexes.values():
+                index.update(i, current_time)
+        self.state = state(db)
+
+    def record(self, row, players):
+        """Build a MatchRecord from a matches row and its match_players rows.
+
+        Args:
+            row (Tuple): (id, time, team_a_score, team_b_score).
+            players (Iterable[Tuple]): (user_id, team, old_mu, old_sigma, new_mu,
+                new_sigma) rows in rowid order.
+        """
+        record = MatchRecord(*row, self.ids)
+        team_b = []
+        for userid, team, *ratings in players:
+            if team == TEAM_A:
+                record.players.append(self.intern(userid))
+                record.ratings.extend(ratings)
+                record.team_a_size += 1
+            else:
+                team_b.append((userid, ratings))
+        for userid, ratings in team_b:
+            record.players.append(self.intern(userid))
+            record.ratings.extend(ratings)
+        return record
+
+
+def state(db):
+    """What a loaded model must match to still be current on connection db."""
+    # data_version changes on commits by other connections, total_changes on our own
+    return db.execute("PRAGMA data_version").fetchone()[0], db.total_changes
+
+
+def load_model(db):
+    """The guild model of connection db, reloaded from the ratings table if stale."""
+    current = state(db)
+    if db.model is None or db.model.state != current:
+        rows = db.execute(
+            "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+        ).fetchall()
+        columns = list(zip(*rows)) or [(), (), (), ()]
+        db.model = GuildModel(
+            list(columns[0]),
+            np.array(columns[1], dtype=float),
+            np.array(columns[2], dtype=float),
+            np.array(
+                [np.nan if last is None else last for last in columns[3]], dtype=float
+            ),
+            current,
+        )
+    return db.model
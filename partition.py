@@ -0,0 +1,266 @@
+import time
+from itertools import combinations, islice
+from math import comb
+
+import numpy as np
+
+from batch import match_quality, quality_from_sums
+from config import team_search_max_evaluations, team_search_time_limit
+
+
+def split_count(n, team_size):
+    """Number of distinct ways to split n players into teams of team_size and n - team_size."""
+    if 2 * team_size == n:
+        # (A, B) and (B, A) are the same match
+        return comb(n - 1, team_size - 1)
+    return comb(n, team_size)
+
+
+# candidate splits scored per match_quality call
+CHUNK_SIZE = 4096
+
+
+def find_teams(ratings, team_size=None, max_evaluations=None, time_limit=None):
+    """Split players into two teams with the best match quality found within budget.
+
+    Lobbies with few enough distinct splits are searched exhaustively, larger ones with
+    greedy seeding followed by a pairwise swap local search. Candidates are scored in
+    batches with batch.match_quality.
+
+    Args:
+        ratings (List[ts.Rating]): ratings of the players to split.
+        team_size (int, optional): size of team A. Defaults to half the players, rounded down.
+        max_evaluations (int, optional): cap on candidate splits scored. Defaults to config.
+        time_limit (float, optional): cap on search time in seconds. Defaults to config.
+
+    Returns:
+        Tuple[List[int], List[int], float, int]: team A indices, team B indices,
+            quality, number of candidate splits evaluated.
+    """
+    n = len(ratings)
+    if team_size is None:
+        team_size = n // 2
+    if not 0 < team_size < n:
+        raise ValueError(f"cannot split {n} players into a team of {team_size}")
+    if max_evaluations is None:
+        max_evaluations = team_search_max_evaluations
+    if time_limit is None:
+        time_limit = team_search_time_limit
+    deadline = time.perf_counter() + time_limit
+
+    if split_count(n, team_size) <= max_evaluations:
+        return exhaustive_search(ratings, team_size, deadline)
+    return local_search(ratings, team_size, max_evaluations, deadline)
+
+
+def exhaustive_search(ratings, team_size, deadline):
+    """Score every distinct split and return the best one."""
+    n = len(ratings)
+    mu = np.array([r.mu for r in ratings])
+    sigma = np.array([r.sigma for r in ratings])
+    if 2 * team_size == n:
+        # pin player 0 to team A to skip mirrored splits
+        candidates = ((0, *rest) for rest in combinations(range(1, n), team_size - 1))
+    else:
+        candidates = combinations(range(n), team_size)
+    best_a, best_quality, evaluated = None, -1.0, 0
+    while best_a is None or time.perf_counter() <= deadline:
+        chunk = list(islice(candidates, CHUNK_SIZE))
+        if not chunk:
+            break
+        assignment = np.zeros((len(chunk), n), dtype=bool)
+        assignment[np.arange(len(chunk))[:, None], chunk] = True
+        quality = match_quality(mu, sigma, assignment)
+        evaluated += len(chunk)
+        best = int(np.argmax(quality))
+        if quality[best] > best_quality:
+            best_a, best_quality = chunk[best], float(quality[best])
+    in_a = set(best_a)
+    return list(best_a), [i for i in range(n) if i not in in_a], best_quality, evaluated
+
+
+def greedy_split(ratings, team_size):
+    """Deal players strongest first to whichever team with room has the lower total mu."""
+    team_a, team_b = [], []
+    sum_a = sum_b = 0.0
+    for i in sorted(range(len(ratings)), key=lambda i: -ratings[i].mu):
+        room_a = len(team_a) < team_size
+        room_b = len(team_b) < len(ratings) - team_size
+        if room_a and (not room_b or sum_a <= sum_b):
+            team_a.append(i)
+            sum_a += ratings[i].mu
+        else:
+            team_b.append(i)
+            sum_b += ratings[i].mu
+    return team_a, team_b
+
+
+def local_search(ratings, team_size, max_evaluations, deadline):
+    """Improve a greedy split by taking the best pairwise swap until no swap helps."""
+    n = len(ratings)
+    mu = np.array([r.mu for r in ratings])
+    sigma = np.array([r.sigma for r in ratings])
+    team_a, team_b = greedy_split(ratings, team_size)
+    current = np.zeros(n, dtype=bool)
+    current[team_a] = True
+    best_quality = float(match_quality(mu, sigma, current)[0])
+    evaluated = 1
+    while evaluated < max_evaluations and time.perf_counter() <= deadline:
+        # every (x in A, y in B) swap of the current split, up to the remaining budget
+        xs, ys = np.meshgrid(np.flatnonzero(current), np.flatnonzero(~current))
+        xs, ys = xs.ravel(), ys.ravel()
+        xs, ys = xs[: max_evaluations - evaluated], ys[: max_evaluations - evaluated]
+        assignment = np.tile(current, (len(xs), 1))
+        rows = np.arange(len(xs))
+        assignment[rows, xs] = False
+        assignment[rows, ys] = True
+        quality = match_quality(mu, sigma, assignment)
+        evaluated += len(xs)
+        best = int(np.argmax(quality))
+        if quality[best] <= best_quality:
+            break
+        current, best_quality = assignment[best], float(quality[best])
+    return (
+        np.flatnonzero(current).tolist(),
+        np.flatnonzero(~current).tolist(),
+        best_quality,
+        evaluated,
+    )
+
+
+def find_matches(
+    ratings, match_count, objective="worst", max_evaluations=None, time_limit=None
+):
+    """Split players into match_count matches of two teams with balanced quality.
+
+    Team sizes differ by at most one. A snake draft seeds the teams, then a local search
+    swaps players between any two teams while it improves the objective, and finally
+    each match is rebalanced on its own with find_teams.
+
+    Args:
+        ratings (List[ts.Rating]): ratings of the players to split.
+        match_count (int): number of matches to make.
+        objective (str, optional): "worst" maximizes the lowest match quality (ties broken
+            by the total), "total" maximizes the sum of match qualities.
+        max_evaluations (int, optional): cap on candidate swaps scored. Defaults to config.
+        time_limit (float, optional): cap on search time in seconds. Defaults to config.
+
+    Returns:
+        Tuple[List[Tuple[List[int], List[int], float]], int]: team A indices, team B
+            indices and quality of each match, number of candidates evaluated.
+    """
+    n = len(ratings)
+    team_count = 2 * match_count
+    if match_count < 1 or n < team_count:
+        raise ValueError(f"cannot split {n} players into {match_count} matches")
+    if objective not in ("worst", "total"):
+        raise ValueError(f"unknown objective {objective!r}")
+    if max_evaluations is None:
+        max_evaluations = team_search_max_evaluations
+    if time_limit is None:
+        time_limit = team_search_time_limit
+    deadline = time.perf_counter() + time_limit
+    if match_count == 1:
+        a_idx, b_idx, quality, evaluated = find_teams(
+            ratings, max_evaluations=max_evaluations, time_limit=time_limit
+        )
+        return [(a_idx, b_idx, quality)], evaluated
+
+    team = snake_draft(ratings, team_count)
+    team, evaluated = swap_search(
+        ratings, team, match_count, objective, max_evaluations, deadline
+    )
+    matches = []
+    for match in range(match_count):
+        a_idx = np.flatnonzero(team == 2 * match).tolist()
+        b_idx = np.flatnonzero(team == 2 * match + 1).tolist()
+        players = a_idx + b_idx
+        sub_a, sub_b, quality, sub_evaluated = find_teams(
+            [ratings[i] for i in players],
+            team_size=len(a_idx),
+            max_evaluations=max(max_evaluations - evaluated, 1),
+            time_limit=max(deadline - time.perf_counter(), 0),
+        )
+        evaluated += sub_evaluated
+        matches.append(
+            ([players[i] for i in sub_a], [players[i] for i in sub_b], quality)
+        )
+    return matches, evaluated
+
+
+def snake_draft(ratings, team_count):
+    """Deal players strongest first to teams 0, 1, ..., team_count - 1, then back down.
+
+    Returns the team index of each player. Teams 2k and 2k + 1 form match k, and team
+    sizes differ by at most one with the larger teams first.
+    """
+    n = len(ratings)
+    sizes = [n // team_count + (t < n % team_count) for t in range(team_count)]
+    order = list(range(team_count)) + list(range(team_count - 1, -1, -1))
+    team = np.zeros(n, dtype=int)
+    turn = 0
+    for i in sorted(range(n), key=lambda i: -ratings[i].mu):
+        while sizes[order[turn % len(order)]] == 0:
+            turn += 1
+        t = order[turn % len(order)]
+        team[i] = t
+        sizes[t] -= 1
+        turn += 1
+    return team
+
+
+def swap_search(ratings, team, match_count, objective, max_evaluations, deadline):
+    """Take the best swap of two players on different teams until no swap helps.
+
+    Returns the improved team array and the number of swaps evaluated.
+    """
+    mu = np.array([r.mu for r in ratings])
+    var = np.array([r.sigma for r in ratings]) ** 2
+    xs, ys = np.triu_indices(len(ratings), 1)
+    sizes = np.bincount(team // 2, minlength=match_count)
+    evaluated = 0
+    while evaluated < max_evaluations and time.perf_counter() <= deadline:
+        match, side = team // 2, np.where(team % 2 == 0, 1.0, -1.0)
+        delta = np.bincount(match, side * mu, minlength=match_count)
+        variance = np.bincount(match, var, minlength=match_count)
+        quality = quality_from_sums(delta, variance, sizes)
+
+        movable = team[xs] != team[ys]
+        x, y = xs[movable], ys[movable]
+        x, y = x[: max_evaluations - evaluated], y[: max_evaluations - evaluated]
+        if not len(x):
+            break
+        mx, my = match[x], match[y]
+        same = mx == my
+        # x moves to y's team and y to x's
+        gain = mu[y] - mu[x]
+        delta_x = delta[mx] + side[x] * gain - same * side[y] * gain
+        delta_y = delta[my] - side[y] * gain + same * side[x] * gain
+        variance_x = variance[mx] + ~same * (var[y] - var[x])
+        variance_y = variance[my] - ~same * (var[y] - var[x])
+        quality_x = quality_from_sums(delta_x, variance_x, sizes[mx])
+        quality_y = quality_from_sums(delta_y, variance_y, sizes[my])
+        total = quality.sum() - quality[mx] + quality_x
+        total += ~same * (quality_y - quality[my])
+        evaluated += len(x)
+
+        if objective == "total":
+            best = int(np.argmax(total))
+            if total[best] <= quality.sum() + 1e-12:
+                break
+        else:
+            # lowest quality among the untouched matches: the first of the three lowest
+            # overall that isn't mx or my
+            lowest = np.argsort(quality)[:3]
+            others = np.full(len(x), np.inf)
+            for m in lowest[::-1]:
+                others = np.where((mx != m) & (my != m), quality[m], others)
+            worst = np.minimum(np.minimum(quality_x, quality_y), others)
+            best = int(np.lexsort((total, worst))[-1])
+            current = quality.min()
+            if worst[best] < current - 1e-12 or (
+                worst[best] <= current + 1e-12 and total[best] <= quality.sum() + 1e-12
+            ):
+                break
+        team[x[best]], team[y[best]] = team[y[best]], team[x[best]]
+    return team, evaluated
@@ -0,0 +1,239 @@
+from math import inf, isclose
+
+import numpy as np
+import trueskill as ts
+from sortedcontainers import SortedList
+
+from CustomTrueSkill import decay_curve
+
+# consecutive leaderboard values within this of the first of their run share its rank
+RANK_TOLERANCE = 0.0001
+
+
+class RankIndex:
+    """A guild model's rated players sorted by exposure or mean, kept up to date on writes.
+
+    Entries are (-key, player index), where the key is the player's value when they were
+    last indexed. Decay only ever raises sigma, so a player's current exposure is at most
+    their key, and at least their key minus drift(). Queries recompute current values
+    only where that uncertainty matters, so ranks and leaderboards match sorting every
+    current rating, without doing it.
+
+    Players whose mu is the default are kept aside in `volatile`: their rating counts as
+    unranked whenever decay brings sigma back to the default too.
+    """
+
+    def __init__(self, model, metric, current_time):
+        """Index model's rated players.
+
+        Args:
+            model (GuildModel): the model to index. It calls update on writes.
+            metric (str): "exposure", or "mean" for mu with lowest sigma first on ties.
+            current_time (datetime): time to take the keys at.
+        """
+        self.model = model
+        self.metric = metric
+        self.rebuild(current_time)
+
+    def rebuild(self, current_time):
+        """Re-key every player at current_time, resetting drift."""
+        self.time = current_time
+        # longest time since the last match of any player whose sigma can still grow
+        self.elapsed = 0.0
+        self.keys = {}  # player index : entry
+        self.volatile = set()
+        env = ts.global_env()
+        players = np.flatnonzero(~np.isnan(self.model.mu))
+        entries = []
+        columns = (column.tolist() for column in self.current(players, current_time))
+        for i, (mu, sigma, value) in zip(players.tolist(), zip(*columns)):
+            if mu == env.mu:
+                self.volatile.add(i)
+                continue
+            self.keys[i] = (-value, i)
+            entries.append(self.keys[i])
+            self.grow_elapsed(i, sigma, current_time)
+        self.entries = SortedList(entries)
+
+    def grow_elapsed(self, i, sigma, current_time):
+        """Account for player i, keyed at current_time with decayed sigma, in drift()."""
+        last = self.model.last[i]
+        if last == last and sigma < ts.global_env().sigma:
+            # drift() measures from self.time. Keyed later, the player's sigma grows
+            # no faster than one keyed then with their last match as long ago.
+            self.elapsed = max(self.elapsed, self.time.timestamp() - last)
+
+    def current(self, players, current_time):
+        """mu, decayed sigma and metric value arrays of players at current_time."""
+        mu, sigma, exposure = self.model.decayed(
+            current_time, np.asarray(players, dtype=int)
+        )
+        return mu, sigma, exposure if self.metric == "exposure" else mu
+
+    def drift(self, current_time):
+        """Upper bound on how far any indexed value has dropped below its key since."""
+        if self.metric == "mean":
+            return 0.0
+        env = ts.global_env()
+        # decay_curve is convex, so no player's sigma grew more than the longest idle one's
+        growth = decay_curve(
+            current_time.timestamp() - self.time.timestamp() + self.elapsed
+        ) - decay_curve(self.elapsed)
+        # a little slack for rounding in the keys
+        return (env.mu / env.sigma) * growth + 1e-9
+
+    def update(self, i, current_time):
+        """Re-key player i after their rating or last match time changed."""
+        entry = self.keys.pop(i, None)
+        if entry is not None:
+            self.entries.remove(entry)
+        self.volatile.discard(i)
+        if self.model.mu[i] != self.model.mu[i]:
+            return
+        if self.model.mu[i] == ts.global_env().mu:
+            self.volatile.add(i)
+            return
+        (mu,), (sigma,), (value,) = (
+            column.tolist() for column in self.current([i], current_time)
+        )
+        self.keys[i] = (-value, i)
+        self.entries.add(self.keys[i])
+        self.grow_elapsed(i, sigma, current_time)
+
+    def rows(self, players, current_time):
+        """(sort key, player index, mu, sigma, value) of players with a non-default rating.
+
+        Sorting by the sort key gives leaderboard order: best value first, then lowest
+        sigma for mean, then the order players were first rated in.
+        """
+        env = ts.global_env()
+        output = []
+        columns = (column.tolist() for column in self.current(players, current_time))
+        for i, mu, sigma, value in zip(players, *columns):
+            if mu == env.mu and sigma == env.sigma:
+                continue
+            if self.metric == "exposure":
+                key = (-value, i)
+            else:
+                key = (-mu, sigma, i)
+            output.append((key, i, mu, sigma, value))
+        return output
+
+    def ordered(self, current_time, limit=None):
+        """(player index, mu, sigma, value) of the top limit players, best first.
+
+        Without a limit, every player with a non-default rating, in leaderboard order.
+        """
+        if limit is None:
+            return self.ordered_all(current_time)
+        output = self.rows(sorted(self.volatile), current_time)
+        # walk down the keys until no later player can make the top limit
+        batch_size = max(limit, 64)
+        position = 0
+        while position < len(self.entries):
+            batch = [i for _, i in self.entries[position : position + batch_size]]
+            output += self.rows(batch, current_time)
+            position += len(batch)
+            if len(output) >= limit and position < len(self.entries):
+                output.sort()
+                # keys are upper bounds on values
+                if -self.entries[position][0] < output[limit - 1][4]:
+                    break
+        output.sort()
+        return [row[1:] for row in output[:limit]]
+
+    def ordered_all(self, current_time):
+        """ordered() without a limit, sorting every player at once."""
+        players = np.array(sorted([*self.keys, *self.volatile]), dtype=int)
+        mu, sigma, values = self.current(players, current_time)
+        env = ts.global_env()
+        played = (mu != env.mu) | (sigma != env.sigma)
+        players, mu, sigma, values = (
+            players[played],
+            mu[played],
+            sigma[played],
+            values[played],
+        )
+        if self.metric == "exposure":
+            order = np.lexsort((players, -values))
+        else:
+            order = np.lexsort((players, sigma, -mu))
+        return list(
+            zip(
+                players[order].tolist(),
+                mu[order].tolist(),
+                sigma[order].tolist(),
+                values[order].tolist(),
+            )
+        )
+
+    def rank(self, i, current_time):
+        """Leaderboard rank of player i at current_time, or None if unranked."""
+        if i not in self.keys and i not in self.volatile:
+            return None
+        found = self.rows([i], current_time)
+        if not found:
+            return None
+        value = found[0][4]
+        drift = self.drift(current_time)
+        width = 4 * RANK_TOLERANCE
+        while True:
+            # keys above high are now above value + width, keys below value are below it
+            high = value + width + drift
+            above = self.entries.bisect_left((-high, -1))
+            window = [j for _, j in self.entries.irange((-high, -1), (-value, inf))]
+            candidates = sorted(self.rows(window + sorted(self.volatile), current_time))
+            position = next(p for p, row in enumerate(candidates) if row[1] == i)
+            rank = self.run_leader(candidates, position, above, value + width)
+            if rank is not None:
+                return rank
+            width *= 4
+
+    @staticmethod
+    def run_leader(candidates, position, above, safe):
+        """Rank of candidates[position], the first of its run of close values.
+
+        candidates are in order and exact down to position. Exactly `above` players
+        precede them, all with values above safe. Returns None if the run may start
+        before the candidates, above safe.
+        """
+        for start in range(position, -1, -1):
+            start_value = candidates[start][4]
+            if start_value > safe:
+                return None
+            if start == 0 and above == 0:
+                # the top of the leaderboard, where get_ranks always started from 0
+                leader, leader_rank = 0, 0
+                break
+            previous = safe if start == 0 else min(candidates[start - 1][4], safe)
+            if previous - start_value > RANK_TOLERANCE:
+                leader, leader_rank = start_value, above + start + 1
+                start += 1
+                break
+        else:
+            return None
+        for p in range(start, position + 1):
+            if not isclose(candidates[p][4], leader, abs_tol=RANK_TOLERANCE):
+                leader, leader_rank = candidates[p][4], above + p + 1
+        return leader_rank
+
+    def ranks(self, players, current_time):
+        """{player index: rank} for the ranked ones among players."""
+        if len(players) > 32:
+            ordered = self.ordered(current_time)
+            wanted = set(players)
+            output = {}
+            # one pass down the whole leaderboard
+            leader, leader_rank = 0, 0
+            for p, (i, _, _, value) in enumerate(ordered):
+                if not isclose(value, leader, abs_tol=RANK_TOLERANCE):
+                    leader, leader_rank = value, p + 1
+                if i in wanted:
+                    output[i] = leader_rank
+            return output
+        output = {}
+        for i in players:
+            rank = self.rank(i, current_time)
+            if rank is not None:
+                output[i] = rank
+        return output
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+from config import render_cache_max_age, render_cache_max_bytes
+
+
+class RenderCache:
+    """LRU cache of rendered text per guild, valid while the guild's data version holds.
+
+    Entries are keyed on (guild id, key) and remember the data version they were rendered
+    at, so any write to the guild's db invalidates every entry of that guild. Entries
+    also expire after max_age seconds, since rating decay changes output without a
+    write. Sizes are counted in characters and the least recently used entries are
+    evicted beyond max_bytes.
+    """
+
+    def __init__(self, max_bytes=render_cache_max_bytes, max_age=render_cache_max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.size = 0
+        # (guild_id, key) : (version, time rendered, text), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, guildid, key, version):
+        """Cached text for key, or None if missing or rendered at another version."""
+        with self.lock:
+            entry = self.entries.get((str(guildid), key))
+            if (
+                entry is None
+                or entry[0] != version
+                or time.monotonic() - entry[1] > self.max_age
+            ):
+                self.misses += 1
+                return None
+            self.entries.move_to_end((str(guildid), key))
+            self.hits += 1
+            return entry[2]
+
+    def put(self, guildid, key, version, text):
+        """Cache text rendered from the guild's data at version."""
+        if len(text) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((str(guildid), key), None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[(str(guildid), key)] = (version, time.monotonic(), text)
+            self.size += len(text)
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self, guildid=None):
+        """Drop every entry, or only the guild's."""
+        with self.lock:
+            for entry_key in list(self.entries):
+                if guildid is None or entry_key[0] == str(guildid):
+                    self.size -= len(self.entries.pop(entry_key)[2])
+
+
+cache = RenderCache()
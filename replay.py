@@ -0,0 +1,517 @@
+import argparse
+import math
+import time
+
+import numpy as np
+import trueskill as ts
+
+import batch
+import config
+from archive import archived_until, latest_checkpoint, read_checkpoint
+from CustomTrueSkill import decay_curve, rate_match
+from series import rebuild_series
+from storage import TEAM_A, TEAM_B, bump_data_version, connect
+
+# matches read (and rewritten) per round trip to the db
+BATCH_SIZE = 5000
+
+UPDATE_PLAYER = (
+    "UPDATE match_players SET old_mu = ?, old_sigma = ?, new_mu = ?, new_sigma = ?,"
+    " prev_sigma = ?, prev_last_match_time = ? WHERE match_id = ? AND user_id = ?"
+)
+# UPDATE_PLAYER for a row found by rowid, as replay writes every row it reads
+UPDATE_ROW = (
+    "UPDATE match_players SET old_mu = ?, old_sigma = ?, new_mu = ?, new_sigma = ?,"
+    " prev_sigma = ?, prev_last_match_time = ? WHERE rowid = ?"
+)
+
+
+def iter_matches(db, batch_size=BATCH_SIZE, after=0):
+    """Yield lists of (match_id, time, team_a_score, team_b_score, players).
+
+    Matches with an id above after come in the order they were recorded, batch_size at
+    a time. players is a list of (userid, team, old_mu, prev_sigma, prev_last_match_time).
+    """
+    last_id = after
+    while True:
+        matches = db.execute(
+            "SELECT id, time, team_a_score, team_b_score FROM matches"
+            " WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        ).fetchall()
+        if not matches:
+            return
+        players = {}
+        rows = db.execute(
+            "SELECT match_id, user_id, team, old_mu, prev_sigma, prev_last_match_time"
+            " FROM match_players WHERE match_id BETWEEN ? AND ?"
+            " ORDER BY match_id, rowid",
+            (matches[0][0], matches[-1][0]),
+        )
+        for match_id, *player in rows:
+            players.setdefault(match_id, []).append(tuple(player))
+        yield [(*match, players.get(match[0], [])) for match in matches]
+        last_id = matches[-1][0]
+
+
+def decayed_rating(mu, sigma, last_match_time, match_time, decay, env):
+    """The rating a match is rated from: stored sigma plus decay since the last match."""
+    if last_match_time is not None and match_time != last_match_time:
+        sigma += decay(match_time - last_match_time)
+    return ts.Rating(mu, min(sigma, env.sigma))
+
+
+def replay(
+    guildid,
+    factor=0.7,
+    draw_probability=config.draw_probability,
+    decay=decay_curve,
+    batch_size=BATCH_SIZE,
+    dry_run=False,
+    start=None,
+):
+    """Recompute ratings and old rating snapshots from match history.
+
+    Replays from a checkpoint's state rather than from the first match when there is
+    one: the archive boundary by default, since archived matches can't be re-rated.
+
+    Args:
+        guildid: guild to replay.
+        factor (float, optional): margin of victory factor for rate_with_round_score.
+        draw_probability (float, optional): TrueSkill draw probability.
+        decay (Callable[[np.ndarray], np.ndarray], optional): sigma growth after a number
+            of seconds without a match, applied elementwise.
+        batch_size (int, optional): matches read and written per round trip.
+        dry_run (bool, optional): compute the new ratings without writing them.
+        start (int, optional): only replay the matches after the nearest checkpoint at
+            or before this match id.
+
+    Returns:
+        Tuple[int, Dict[str, Tuple[ts.Rating, ts.Rating]]]: number of matches replayed,
+            {userid: (stored rating, replayed rating)} for every player with a replayed
+            match.
+    """
+    env = ts.TrueSkill(draw_probability=draw_probability)
+    count = 0
+    with connect(guildid) as db:
+        checkpoint = archived_until(db)
+        if start is not None:
+            checkpoint = max(latest_checkpoint(db, start), checkpoint)
+        initial = read_checkpoint(db, checkpoint) if checkpoint else {}
+        ids = list(initial)
+        ids += [
+            uid
+            for uid, in db.execute(
+                "SELECT DISTINCT user_id FROM match_players WHERE match_id > ?",
+                (checkpoint,),
+            )
+            if uid not in initial
+        ]
+        index = {uid: i for i, uid in enumerate(ids)}
+        # player state, indexed like ids. last is the time of the previous match.
+        mu = np.full(len(ids), env.mu)
+        sigma = np.full(len(ids), env.sigma)
+        last = np.full(len(ids), np.nan)
+        for uid, (start_mu, start_sigma, start_last, *_) in initial.items():
+            mu[index[uid]], sigma[index[uid]] = start_mu, start_sigma
+            if start_last is not None:
+                last[index[uid]] = start_last
+        played = np.zeros(len(ids), dtype=bool)
+
+        after = checkpoint
+        while True:
+            matches = db.execute(
+                "SELECT id, time, team_a_score, team_b_score FROM matches"
+                " WHERE id > ? ORDER BY id LIMIT ?",
+                (after, batch_size),
+            ).fetchall()
+            if not matches:
+                break
+            rows = db.execute(
+                "SELECT rowid, match_id, user_id, team FROM match_players"
+                " WHERE match_id BETWEEN ? AND ? ORDER BY match_id, rowid",
+                (matches[0][0], matches[-1][0]),
+            ).fetchall()
+            after = matches[-1][0]
+            count += len(matches)
+            if not rows:
+                continue
+            rows = read_batch(matches, rows, index, last, factor, decay, env)
+            played[rows["player"]] = True
+            rate_batch(rows, mu, sigma, factor, env)
+            if not dry_run:
+                prev_last = rows["prev_last"]
+                db.executemany(
+                    UPDATE_ROW,
+                    zip(
+                        rows["old_mu"].tolist(),
+                        rows["old_sigma"].tolist(),
+                        rows["new_mu"].tolist(),
+                        rows["new_sigma"].tolist(),
+                        rows["prev_sigma"].tolist(),
+                        np.where(np.isnan(prev_last), None, prev_last).tolist(),
+                        rows["rowid"].tolist(),
+                    ),
+                )
+
+        stored = {
+            uid: ts.Rating(stored_mu, stored_sigma)
+            for uid, stored_mu, stored_sigma in db.execute(
+                "SELECT user_id, mu, sigma FROM ratings"
+            )
+        }
+        deltas = {
+            uid: (
+                stored.get(uid, ts.Rating()),
+                ts.Rating(float(mu[i]), float(sigma[i])),
+            )
+            for uid, i in index.items()
+            if played[i]
+        }
+        if not dry_run:
+            db.executemany(
+                "UPDATE ratings SET mu = ?, sigma = ? WHERE user_id = ?",
+                [(new.mu, new.sigma, uid) for uid, (_, new) in deltas.items()],
+            )
+            # later checkpoints hold the old ratings
+            db.execute("DELETE FROM checkpoints WHERE match_id > ?", (checkpoint,))
+            rebuild_series(db)
+            bump_data_version(db)
+    return count, deltas
+
+
+def read_batch(matches, rows, index, last, factor, decay, env):
+    """Lay out a batch of matches as arrays with one entry per player row.
+
+    Everything that doesn't depend on ratings is worked out here for the whole batch:
+    teams, scores, draw margins and sigma growth since each player's previous match.
+    Matches are grouped into levels, each one after every earlier match of its players,
+    so the matches of a level share no players and can be rated together. Rows and
+    matches come out ordered by level, then as recorded.
+
+    Args:
+        matches (List[Tuple]): (id, time, team_a_score, team_b_score) rows, by id.
+        rows (List[Tuple]): (rowid, match_id, user_id, team) rows of those matches,
+            ordered by match_id and rowid.
+        index (Dict[str, int]): userid : index into the state arrays.
+        last (np.ndarray): time of each player's previous match, NaN if none. Moved on
+            to the end of the batch in place.
+        factor (float): margin of victory factor for rate_with_round_score.
+        decay (Callable[[np.ndarray], np.ndarray]): sigma growth after seconds.
+        env (ts.TrueSkill): environment with a static draw probability.
+
+    Returns:
+        Dict[str, np.ndarray]: per row arrays, and per match ones under "match_"
+            names. "levels" holds the first match of each level, then the match count.
+    """
+    match_id, match_time, team_a_score, team_b_score = map(np.array, zip(*matches))
+    rowid, row_match, userids, team = zip(*rows)
+    player = np.array([index[userid] for userid in userids])
+    slot = np.searchsorted(match_id, row_match)
+    # matches without players have nothing to rate
+    keep = np.zeros(len(matches), dtype=bool)
+    keep[slot] = True
+    slot = np.cumsum(keep)[slot] - 1
+    match_time = match_time[keep].astype(float)
+    team_a_score, team_b_score = team_a_score[keep], team_b_score[keep]
+    size = np.bincount(slot)
+    starts = np.concatenate(([0], np.cumsum(size)))
+
+    # previous match time of each row's player: the row before in player order, or the
+    # time the batch started from
+    time = match_time[slot]
+    order = np.argsort(player, kind="stable")
+    by_player = player[order]
+    first = np.concatenate(([True], by_player[1:] != by_player[:-1]))
+    prev = np.concatenate(([np.nan], time[order][:-1]))
+    prev[first] = last[by_player[first]]
+    prev_last = np.empty(len(rows))
+    prev_last[order] = prev
+    final = np.concatenate((first[1:], [True]))
+    last[by_player[final]] = time[order][final]
+    # decayed_rating, elementwise
+    elapsed = time - prev_last
+    grows = ~np.isnan(elapsed) & (elapsed != 0)
+    growth = np.zeros(len(rows))
+    growth[grows] = decay(elapsed[grows])
+
+    level = []
+    player_level = {}  # player : level of their latest match so far
+    players = player.tolist()
+    for start, end in zip(starts[:-1].tolist(), starts[1:].tolist()):
+        match_players = players[start:end]
+        match_level = 1 + max(player_level.get(i, 0) for i in match_players)
+        level.append(match_level)
+        player_level.update(dict.fromkeys(match_players, match_level))
+    level = np.array(level)
+    match_order = np.argsort(level, kind="stable")
+    row_order = np.argsort(level[slot], kind="stable")
+    # slot of each match in match_order
+    new_slot = np.empty(len(level), dtype=int)
+    new_slot[match_order] = np.arange(len(level))
+
+    # a draw is rated as a team B win, as in rate_match
+    a_won = team_a_score > team_b_score
+    winner_score = np.where(a_won, team_a_score, team_b_score).astype(float)
+    loser_score = np.where(a_won, team_b_score, team_a_score).astype(float)
+    team = np.array(team)
+    won = (team == TEAM_A) == a_won[slot]
+    size = size[match_order]
+    return {
+        "rowid": np.array(rowid)[row_order],
+        "player": player[row_order],
+        "team": team[row_order],
+        "slot": new_slot[slot][row_order],
+        "sign": np.where(won, 1.0, -1.0)[row_order],
+        "growth": growth[row_order],
+        "prev_last": prev_last[row_order],
+        "match_starts": np.concatenate(([0], np.cumsum(size))),
+        "match_size": size,
+        "match_draw_margin": env.ppf((env.draw_probability + 1) / 2.0)
+        * np.sqrt(size)
+        * env.beta,
+        "match_weight": (
+            1 + ((winner_score - loser_score) / winner_score - 0.5) * factor
+        )[match_order],
+        "match_a_score": team_a_score[match_order].tolist(),
+        "match_b_score": team_b_score[match_order].tolist(),
+        "levels": np.searchsorted(level[match_order], np.arange(1, level.max() + 2)),
+    }
+
+
+def rate_batch(rows, mu, sigma, factor, env):
+    """Rate a batch laid out by read_batch, one level at a time.
+
+    Updates the mu and sigma state arrays in place, and adds the old_mu, old_sigma,
+    new_mu, new_sigma and prev_sigma of each row to rows.
+    """
+    for name in ("old_mu", "old_sigma", "new_mu", "new_sigma", "prev_sigma"):
+        rows[name] = np.empty(len(rows["player"]))
+    levels = rows["levels"].tolist()
+    starts = rows["match_starts"].tolist()
+    draw_margin = rows["match_draw_margin"].tolist()
+    weight = rows["match_weight"].tolist()
+    for first, end in zip(levels[:-1], levels[1:]):
+        try:
+            if end - first == 1:
+                rate_single(
+                    rows,
+                    starts[first],
+                    starts[end],
+                    draw_margin[first],
+                    weight[first],
+                    mu,
+                    sigma,
+                    env,
+                )
+            else:
+                rate_rows(rows, first, end, mu, sigma, env)
+        except FloatingPointError:
+            rate_rows_scalar(rows, first, end, mu, sigma, factor, env)
+
+
+def rate_rows(rows, first, end, mu, sigma, env):
+    """Rate matches first to end (exclusive) of a batch, which share no players.
+
+    The batch.rate_with_round_score arithmetic, on slices of the batch's arrays.
+    """
+    starts = rows["match_starts"]
+    r0, r1 = starts[first], starts[end]
+    i = rows["player"][r0:r1]
+    prev_sigma = sigma[i]
+    old_sigma = np.minimum(prev_sigma + rows["growth"][r0:r1], env.sigma)
+    old_mu = mu[i]
+    sign = rows["sign"][r0:r1]
+    variance = old_sigma**2 + env.tau**2
+    offsets = starts[first:end] - r0
+    size = rows["match_size"][first:end]
+    c = np.sqrt(np.add.reduceat(variance, offsets) + size * env.beta**2)
+    diff = np.add.reduceat(sign * old_mu, offsets)
+    # v_win and w_win, as in ts.TrueSkill
+    x = (diff - rows["match_draw_margin"][first:end]) / c
+    denom = batch.cdf(x)
+    pdf = np.exp(-(x**2) / 2) / np.sqrt(2 * np.pi)
+    v = np.divide(pdf, denom, out=-x, where=denom > 0)
+    w = v * (v + x)
+    if not np.all((0 < w) & (w < 1)):
+        raise FloatingPointError("winners rated far below losers")
+    match = rows["slot"][r0:r1] - first
+    c, v, w = c[match], v[match], w[match]
+    weight = rows["match_weight"][first:end][match]
+    new_mu = old_mu + sign * variance / c * v * weight
+    new_sigma = np.sqrt(variance * (1 - variance / c**2 * w))
+    rows["old_mu"][r0:r1], rows["old_sigma"][r0:r1] = old_mu, old_sigma
+    rows["new_mu"][r0:r1], rows["new_sigma"][r0:r1] = new_mu, new_sigma
+    rows["prev_sigma"][r0:r1] = prev_sigma
+    mu[i], sigma[i] = new_mu, new_sigma
+
+
+def rate_single(rows, r0, r1, draw_margin, weight, mu, sigma, env):
+    """rate_rows for a level of one match, rows r0 to r1, in floats rather than arrays.
+
+    Most levels of a guild with few players hold a single match, where a handful of
+    array calls would cost more than the arithmetic.
+    """
+    i = rows["player"][r0:r1]
+    prev_sigma = sigma[i].tolist()
+    old_sigma = [
+        min(s + g, env.sigma)
+        for s, g in zip(prev_sigma, rows["growth"][r0:r1].tolist())
+    ]
+    old_mu = mu[i].tolist()
+    sign = rows["sign"][r0:r1].tolist()
+    tau_sq, beta_sq = env.tau**2, env.beta**2
+    variance = [s * s + tau_sq for s in old_sigma]
+    c = math.sqrt(sum(variance) + (r1 - r0) * beta_sq)
+    diff = sum(d * m for d, m in zip(sign, old_mu))
+    x = (diff - draw_margin) / c
+    # v_win and w_win, as in ts.TrueSkill
+    v = env.v_win(x, 0)
+    w = v * (v + x)
+    if not 0 < w < 1:
+        raise FloatingPointError("winners rated far below losers")
+    step = v / c * weight
+    shrink = w / c**2
+    new_mu = [m + d * var * step for m, d, var in zip(old_mu, sign, variance)]
+    new_sigma = [math.sqrt(var * (1 - var * shrink)) for var in variance]
+    rows["old_mu"][r0:r1], rows["old_sigma"][r0:r1] = old_mu, old_sigma
+    rows["new_mu"][r0:r1], rows["new_sigma"][r0:r1] = new_mu, new_sigma
+    rows["prev_sigma"][r0:r1] = prev_sigma
+    mu[i], sigma[i] = new_mu, new_sigma
+
+
+def rate_rows_scalar(rows, first, end, mu, sigma, factor, env):
+    """rate_rows one match at a time with rate_match, for levels the arrays can't rate."""
+    starts = rows["match_starts"]
+    for match in range(first, end):
+        r0, r1 = starts[match], starts[match + 1]
+        i = rows["player"][r0:r1]
+        prev_sigma = sigma[i]
+        old_sigma = np.minimum(prev_sigma + rows["growth"][r0:r1], env.sigma)
+        old_mu = mu[i]
+        # row numbers within the match stand in for user ids
+        teams = {TEAM_A: {}, TEAM_B: {}}
+        for row, team in enumerate(rows["team"][r0:r1].tolist()):
+            teams[team][row] = ts.Rating(float(old_mu[row]), float(old_sigma[row]))
+        team_a_new, team_b_new = rate_match(
+            teams[TEAM_A],
+            teams[TEAM_B],
+            rows["match_a_score"][match],
+            rows["match_b_score"][match],
+            factor,
+            env,
+        )
+        new = {**team_a_new, **team_b_new}
+        new_mu = np.array([new[row].mu for row in range(r1 - r0)])
+        new_sigma = np.array([new[row].sigma for row in range(r1 - r0)])
+        rows["old_mu"][r0:r1], rows["old_sigma"][r0:r1] = old_mu, old_sigma
+        rows["new_mu"][r0:r1], rows["new_sigma"][r0:r1] = new_mu, new_sigma
+        rows["prev_sigma"][r0:r1] = prev_sigma
+        mu[i], sigma[i] = new_mu, new_sigma
+
+
+def rerate_after(db, match_id, users, factor=0.7, env=None, decay=decay_curve):
+    """Re-rate the matches after match_id whose ratings depend on users.
+
+    Call inside an open transaction once users' stored ratings reflect the change (e.g.
+    after storage.delete_match). A later match is re-rated only if one of its players
+    is affected, which then makes all of its players affected; other matches are read
+    but left untouched.
+
+    Returns:
+        int: number of matches re-rated.
+    """
+    if env is None:
+        env = ts.global_env()
+    # affected userid : (mu, stored sigma, last match time)
+    state = {}
+    for userid in users:
+        state[userid] = db.execute(
+            "SELECT mu, sigma, last_match_time FROM ratings WHERE user_id = ?",
+            (userid,),
+        ).fetchone()
+    count = 0
+    for batch in iter_matches(db, after=match_id):
+        updates = []
+        for later_id, match_time, team_a_score, team_b_score, players in batch:
+            if not any(userid in state for userid, *_ in players):
+                continue
+            team_a, team_b = {}, {}
+            before = {}
+            for userid, team, old_mu, prev_sigma, prev_last_match_time in players:
+                before[userid] = state.get(
+                    userid, (old_mu, prev_sigma, prev_last_match_time)
+                )
+                (team_a if team == TEAM_A else team_b)[userid] = decayed_rating(
+                    *before[userid], match_time, decay, env
+                )
+            team_a_new, team_b_new = rate_match(
+                team_a, team_b, team_a_score, team_b_score, factor, env
+            )
+            for old, new in ((team_a, team_a_new), (team_b, team_b_new)):
+                for userid, rating in new.items():
+                    _, prev_sigma, prev_last_match_time = before[userid]
+                    updates.append(
+                        (
+                            old[userid].mu,
+                            old[userid].sigma,
+                            rating.mu,
+                            rating.sigma,
+                            prev_sigma,
+                            prev_last_match_time,
+                            later_id,
+                            userid,
+                        )
+                    )
+                    state[userid] = rating.mu, rating.sigma, match_time
+            count += 1
+        db.executemany(UPDATE_PLAYER, updates)
+    db.executemany(
+        "UPDATE ratings SET mu = ?, sigma = ?, last_match_time = ? WHERE user_id = ?",
+        [(*values, userid) for userid, values in state.items()],
+    )
+    rebuild_series(db, users=state)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute a guild's ratings from history."
+    )
+    parser.add_argument("guildid")
+    parser.add_argument("--factor", type=float, default=0.7)
+    parser.add_argument(
+        "--draw-probability", type=float, default=config.draw_probability
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="report deltas only")
+    parser.add_argument(
+        "--start",
+        type=int,
+        help="only replay from the nearest checkpoint at or before this match id",
+    )
+    parser.add_argument("--top", type=int, default=10, help="largest changes to list")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    count, deltas = replay(
+        args.guildid,
+        factor=args.factor,
+        draw_probability=args.draw_probability,
+        batch_size=args.batch_size,
+        dry_run=args.dry_run,
+        start=args.start,
+    )
+    elapsed = time.perf_counter() - start
+    print(f"replayed {count} matches for {len(deltas)} players in {elapsed:.2f}s")
+    movers = sorted(deltas.items(), key=lambda x: -abs(x[1][1].mu - x[1][0].mu))
+    for uid, (old, new) in movers[: args.top]:
+        print(
+            f"{uid}: {old.mu:.2f} ± {old.sigma:.2f} -> {new.mu:.2f} ± {new.sigma:.2f}"
+        )
+    if args.dry_run:
+        print("dry run, nothing written")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+from array import array
+
+# each point in a player's rating series, stored as consecutive doubles
+POINT_FIELDS = ("match_id", "time", "old_mu", "mu", "sigma")
+POINT_SIZE = len(POINT_FIELDS)
+# points per rating_series row. Appends rewrite one row, so this bounds their cost.
+CHUNK_POINTS = 256
+
+
+def pack(points):
+    """Pack an iterable of point tuples into a blob."""
+    return array("d", [value for point in points for value in point]).tobytes()
+
+
+def unpack(blob):
+    """Unpack a blob into a flat array of doubles, POINT_SIZE per point."""
+    values = array("d")
+    values.frombytes(blob)
+    return values
+
+
+def append_points(conn, points):
+    """Append points, given as (userid, (match_id, time, old_mu, mu, sigma)) pairs."""
+    for userid, point in points:
+        row = conn.execute(
+            "SELECT chunk, points FROM rating_series WHERE user_id = ?"
+            " ORDER BY chunk DESC LIMIT 1",
+            (userid,),
+        ).fetchone()
+        if row and len(row[1]) < CHUNK_POINTS * POINT_SIZE * 8:
+            conn.execute(
+                "UPDATE rating_series SET points = ? WHERE user_id = ? AND chunk = ?",
+                (row[1] + pack([point]), userid, row[0]),
+            )
+        else:
+            conn.execute(
+                "INSERT INTO rating_series (user_id, chunk, first_time, points)"
+                " VALUES (?, ?, ?, ?)",
+                (userid, row[0] + 1 if row else 0, point[1], pack([point])),
+            )
+
+
+def remove_point(conn, userid, match_id):
+    """Remove a match's point from a user's series, searching from the newest chunk."""
+    chunks = conn.execute(
+        "SELECT chunk, points FROM rating_series WHERE user_id = ? ORDER BY chunk DESC",
+        (userid,),
+    )
+    for chunk, blob in chunks.fetchall():
+        values = unpack(blob)
+        for start in range(len(values) - POINT_SIZE, -1, -POINT_SIZE):
+            if values[start] == match_id:
+                del values[start : start + POINT_SIZE]
+                if values:
+                    conn.execute(
+                        "UPDATE rating_series SET first_time = ?, points = ?"
+                        " WHERE user_id = ? AND chunk = ?",
+                        (values[1], values.tobytes(), userid, chunk),
+                    )
+                else:
+                    conn.execute(
+                        "DELETE FROM rating_series WHERE user_id = ? AND chunk = ?",
+                        (userid, chunk),
+                    )
+                return
+            if values[start] < match_id:
+                return
+
+
+def read_series(conn, userid, start=None, end=None):
+    """Read a user's points with start <= time <= end, oldest first, as a flat array."""
+    query = "SELECT points FROM rating_series WHERE user_id = ?"
+    params = [userid]
+    if start is not None:
+        # the chunk holding start may begin before it
+        query += (
+            " AND chunk >= (SELECT COALESCE(MAX(chunk), 0) FROM rating_series"
+            " WHERE user_id = ? AND first_time <= ?)"
+        )
+        params += [userid, start]
+    if end is not None:
+        query += " AND first_time <= ?"
+        params.append(end)
+    values = array("d")
+    for (blob,) in conn.execute(query + " ORDER BY chunk", params):
+        values.frombytes(blob)
+    if start is None and end is None:
+        return values
+    output = array("d")
+    for i in range(0, len(values), POINT_SIZE):
+        time = values[i + 1]
+        if (start is None or time >= start) and (end is None or time <= end):
+            output.extend(values[i : i + POINT_SIZE])
+    return output
+
+
+def rebuild_series(conn, users=None):
+    """Rebuild the rating series of every user, or only of users, from match history.
+
+    Points of archived matches aren't in match_players, so they are kept as they are.
+    """
+    archived = archived_points(conn, users)
+    if users is None:
+        conn.execute("DELETE FROM rating_series")
+        rows = conn.execute(
+            "SELECT mp.user_id, mp.match_id, m.time, mp.old_mu, mp.new_mu, mp.new_sigma"
+            " FROM match_players mp JOIN matches m ON m.id = mp.match_id"
+            " ORDER BY mp.user_id, mp.match_id"
+        )
+        write_series(conn, with_archived(archived, rows))
+        return
+    for userid in users:
+        conn.execute("DELETE FROM rating_series WHERE user_id = ?", (userid,))
+        rows = conn.execute(
+            "SELECT mp.user_id, mp.match_id, m.time, mp.old_mu, mp.new_mu, mp.new_sigma"
+            " FROM match_players mp JOIN matches m ON m.id = mp.match_id"
+            " WHERE mp.user_id = ? ORDER BY mp.match_id",
+            (userid,),
+        )
+        write_series(conn, with_archived({userid: archived.get(userid, [])}, rows))
+
+
+def archived_points(conn, users=None):
+    """{userid: [point]} of the points of archived matches, for every user or only users."""
+    (boundary,) = conn.execute(
+        "SELECT COALESCE(MAX(last_match), 0) FROM archive_segments"
+    ).fetchone()
+    if not boundary:
+        return {}
+    if users is None:
+        rows = conn.execute("SELECT user_id, points FROM rating_series ORDER BY chunk")
+    else:
+        rows = (
+            row
+            for userid in users
+            for row in conn.execute(
+                "SELECT user_id, points FROM rating_series WHERE user_id = ?"
+                " ORDER BY chunk",
+                (userid,),
+            )
+        )
+    output = {}
+    for userid, blob in rows:
+        values = unpack(blob)
+        for i in range(0, len(values), POINT_SIZE):
+            if values[i] > boundary:
+                break
+            output.setdefault(userid, []).append(tuple(values[i : i + POINT_SIZE]))
+    return output
+
+
+def with_archived(archived, rows):
+    """Yield (userid, *point) rows with each user's archived points ahead of their own.
+
+    rows and the result are sorted by user then match, as write_series needs.
+    """
+    pending = sorted(archived)
+    i = 0
+    for row in rows:
+        while i < len(pending) and pending[i] <= row[0]:
+            yield from ((pending[i], *point) for point in archived[pending[i]])
+            i += 1
+        yield row
+    for userid in pending[i:]:
+        yield from ((userid, *point) for point in archived[userid])
+
+
+def write_series(conn, rows):
+    """Write (userid, match_id, time, old_mu, mu, sigma) rows, sorted by user then match."""
+    userid, chunk, points = None, 0, []
+    for row_userid, *point in rows:
+        if points and (row_userid != userid or len(points) == CHUNK_POINTS):
+            write_chunk(conn, userid, chunk, points)
+            chunk = chunk + 1 if row_userid == userid else 0
+            points = []
+        userid = row_userid
+        points.append(point)
+    if points:
+        write_chunk(conn, userid, chunk, points)
+
+
+def write_chunk(conn, userid, chunk, points):
+    """Insert one full rating_series row."""
+    conn.execute(
+        "INSERT INTO rating_series (user_id, chunk, first_time, points) VALUES (?, ?, ?, ?)",
+        (userid, chunk, points[0][1], pack(points)),
+    )
@@ -0,0 +1,345 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import trueskill as ts
+from trueskill.backends import cdf
+
+import backend
+import storage
+from config import draw_probability
+from CustomTrueSkill import win_probability
+
+DEFAULT_PLAYERS = 1000
+DEFAULT_MATCHES = 100000
+TEAM_SIZE = 5
+# rounds the winning team needs, as in the matches /start records
+ROUNDS_TO_WIN = 13
+# synthetic user ids are ID_BASE + the player's index
+ID_BASE = 10**17
+# equal-width bins of predicted team A win probability
+CALIBRATION_BINS = 10
+# share of matches played with random teams instead of make_teams'. Balanced teams are all
+# predicted near 50%, so these spread the predictions that calibration is measured on.
+RANDOM_TEAMS = 0.2
+
+
+class Calibration:
+    """Predicted win probabilities against actual results, binned by prediction."""
+
+    def __init__(self, bins=CALIBRATION_BINS):
+        self.predicted = np.zeros(bins)  # sum of predictions per bin
+        self.wins = np.zeros(bins)
+        self.count = np.zeros(bins, dtype=int)
+        self.brier = 0.0  # sums over every match
+        self.log_loss = 0.0
+
+    def add(self, probability, won):
+        """Record one match: team A's predicted win probability and whether it won."""
+        slot = min(int(probability * len(self.count)), len(self.count) - 1)
+        self.predicted[slot] += probability
+        self.wins[slot] += won
+        self.count[slot] += 1
+        self.brier += (probability - won) ** 2
+        clipped = min(max(probability, 1e-12), 1 - 1e-12)
+        self.log_loss -= np.log(clipped if won else 1 - clipped)
+
+    def merge(self, other):
+        """Add another Calibration's matches to this one."""
+        self.predicted += other.predicted
+        self.wins += other.wins
+        self.count += other.count
+        self.brier += other.brier
+        self.log_loss += other.log_loss
+
+    def summary(self):
+        """Brier score, log loss, expected calibration error and the non-empty bins."""
+        total = int(self.count.sum())
+        seen = self.count > 0
+        predicted = self.predicted[seen] / self.count[seen]
+        actual = self.wins[seen] / self.count[seen]
+        return {
+            "matches": total,
+            "brier": self.brier / max(total, 1),
+            "log_loss": self.log_loss / max(total, 1),
+            # gap between predicted and actual win rate, weighted by matches per bin
+            "calibration_error": float(
+                np.sum(np.abs(predicted - actual) * self.count[seen]) / max(total, 1)
+            ),
+            "bins": [
+                {"predicted": float(p), "actual": float(a), "matches": int(n)}
+                for p, a, n in zip(predicted, actual, self.count[seen])
+            ],
+        }
+
+
+def play(rng, skill_a, skill_b, env=None):
+    """Scores of a match between teams with the given hidden skills.
+
+    The winner is drawn the way TrueSkill assumes: each player performs around their
+    skill with deviation beta, and the team with the higher total wins. The loser then
+    takes rounds at a rate that falls as the performance gap grows.
+
+    Returns:
+        Tuple[int, int]: team A and team B scores.
+    """
+    if env is None:
+        env = ts.global_env()
+    gap = rng.normal(skill_a, env.beta).sum() - rng.normal(skill_b, env.beta).sum()
+    # chance of the losing team taking any one round
+    upset = cdf(-abs(gap) / (env.beta * np.sqrt(len(skill_a) + len(skill_b))))
+    loser = min(int(rng.negative_binomial(ROUNDS_TO_WIN, 1 - upset)), ROUNDS_TO_WIN - 2)
+    return (ROUNDS_TO_WIN, loser) if gap > 0 else (loser, ROUNDS_TO_WIN)
+
+
+def convergence(guildid, ids, skill):
+    """How closely the guild's ratings track hidden skill.
+
+    Returns:
+        Dict: Spearman correlation of mu with skill, RMS error of mu against skill and
+            mean sigma, over every player.
+    """
+    ratings = backend.get_ratings(ids, guildid)
+    mu = np.array([ratings[userid].mu for userid in ids])
+    sigma = np.array([ratings[userid].sigma for userid in ids])
+    mu_ranks = np.argsort(np.argsort(mu))
+    skill_ranks = np.argsort(np.argsort(skill))
+    return {
+        "skill_correlation": float(np.corrcoef(mu_ranks, skill_ranks)[0, 1]),
+        "mu_error": float(np.sqrt(np.mean((mu - skill) ** 2))),
+        "mean_sigma": float(sigma.mean()),
+    }
+
+
+def simulate_guild(
+    guildid,
+    players,
+    matches,
+    seed=0,
+    team_size=TEAM_SIZE,
+    reports=10,
+    random_teams=RANDOM_TEAMS,
+):
+    """Play matches between synthetic players through make_teams and record_result.
+
+    Players get a hidden skill drawn from the default rating. Every match takes a random
+    lobby of 2 * team_size of them, splits it with make_teams (or at random, for a
+    random_teams share of matches) and records the result.
+
+    Args:
+        guildid: guild to simulate in, whose db should start empty.
+        players (int): number of synthetic players.
+        matches (int): number of matches to play.
+        seed (int, optional): seed for skills, lobbies and results.
+        team_size (int, optional): players per team.
+        reports (int, optional): times to measure convergence along the way.
+        random_teams (float, optional): share of matches with random teams.
+
+    Returns:
+        Dict: throughput, convergence after every report, and a Calibration of
+            predicted win probability against results.
+    """
+    env = ts.global_env()
+    rng = np.random.default_rng(seed)
+    ids = [str(ID_BASE + i) for i in range(players)]
+    skill = rng.normal(env.mu, env.sigma, players)
+    calibration = Calibration()
+    progress = []
+    report_every = max(matches // max(reports, 1), 1)
+    start = time.perf_counter()
+    for played in range(1, matches + 1):
+        lobby = [ids[i] for i in rng.choice(players, 2 * team_size, replace=False)]
+        if rng.random() < random_teams:
+            team_a, team_b = lobby[:team_size], lobby[team_size:]
+            ratings = backend.get_ratings(lobby, guildid)
+            a_win_prob = win_probability(
+                [ratings[userid] for userid in team_a],
+                [ratings[userid] for userid in team_b],
+            )
+        else:
+            team_a, team_b, _, a_win_prob, _, _ = backend.make_teams(lobby, guildid)
+        a_score, b_score = play(
+            rng,
+            skill[[int(userid) - ID_BASE for userid in team_a]],
+            skill[[int(userid) - ID_BASE for userid in team_b]],
+            env,
+        )
+        backend.record_result(team_a, team_b, a_score, b_score, guildid)
+        calibration.add(a_win_prob, a_score > b_score)
+        if played % report_every == 0 or played == matches:
+            seconds = time.perf_counter() - start
+            report = {
+                "matches": played,
+                "seconds": seconds,
+                **convergence(guildid, ids, skill),
+            }
+            progress.append(report)
+            print(
+                f"{guildid}: {played} matches, {played / seconds:.0f}/s,"
+                f" correlation {report['skill_correlation']:.3f},"
+                f" mean sigma {report['mean_sigma']:.2f}",
+                file=sys.stderr,
+            )
+    seconds = time.perf_counter() - start
+    return {
+        "guild": str(guildid),
+        "players": players,
+        "matches": matches,
+        "seconds": seconds,
+        "matches_per_second": matches / seconds if seconds else 0.0,
+        "progress": progress,
+        "calibration": calibration,
+    }
+
+
+def simulate_in(directory, *args, **kwargs):
+    """simulate_guild with guild dbs in directory, as run by each worker process."""
+    # guild dbs are opened relative to the working directory
+    os.chdir(directory)
+    ts.TrueSkill(draw_probability=draw_probability).make_as_global()
+    try:
+        return simulate_guild(*args, **kwargs)
+    finally:
+        storage.pool.close_all()
+
+
+def run(
+    players=DEFAULT_PLAYERS,
+    matches=DEFAULT_MATCHES,
+    workers=1,
+    seed=0,
+    team_size=TEAM_SIZE,
+    reports=10,
+    random_teams=RANDOM_TEAMS,
+    workdir=None,
+):
+    """Simulate in a scratch directory, one guild per worker, and return the results.
+
+    Matches are split evenly across workers, each with its own players and seed.
+    """
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "players": players,
+            "matches": matches,
+            "workers": workers,
+            "team_size": team_size,
+            "random_teams": random_teams,
+            "seed": seed,
+        },
+        "guilds": [],
+    }
+    # simulate_in arguments of each worker, after the scratch directory
+    jobs = [
+        (
+            f"sim_{worker}",
+            players,
+            matches // workers + (worker < matches % workers),
+            seed + worker,
+            team_size,
+            reports,
+            random_teams,
+        )
+        for worker in range(workers)
+    ]
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=workdir) as scratch:
+        if workers == 1:
+            try:
+                guilds = [simulate_in(scratch, *jobs[0])]
+            finally:
+                os.chdir(cwd)
+        else:
+            # spawn, so workers start without the parent's open connections
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(workers) as pool:
+                guilds = pool.starmap(simulate_in, [(scratch, *job) for job in jobs])
+    seconds = time.perf_counter() - start
+    calibration = Calibration()
+    for guild in guilds:
+        calibration.merge(guild["calibration"])
+        guild["calibration"] = guild["calibration"].summary()
+        results["guilds"].append(guild)
+    results["total"] = {
+        "matches": matches,
+        "seconds": seconds,
+        "matches_per_second": matches / seconds if seconds else 0.0,
+        "calibration": calibration.summary(),
+    }
+    return results
+
+
+def report(results):
+    """Print throughput, final convergence and the calibration table."""
+    total = results["total"]
+    print(
+        f"{total['matches']} matches in {total['seconds']:.1f}s"
+        f" ({total['matches_per_second']:.0f}/s"
+        f" over {results['meta']['workers']} workers)"
+    )
+    for guild in results["guilds"]:
+        final = guild["progress"][-1]
+        print(
+            f"{guild['guild']}: {guild['matches_per_second']:.0f} matches/s,"
+            f" skill correlation {final['skill_correlation']:.3f},"
+            f" mu error {final['mu_error']:.2f}, mean sigma {final['mean_sigma']:.2f}"
+        )
+    calibration = total["calibration"]
+    print(
+        f"brier {calibration['brier']:.4f}, log loss {calibration['log_loss']:.4f},"
+        f" calibration error {calibration['calibration_error']:.4f}"
+    )
+    print("predicted  actual  matches")
+    for row in calibration["bins"]:
+        print(f"{row['predicted']:9.3f} {row['actual']:7.3f} {row['matches']:8d}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate matches between synthetic players, without Discord."
+    )
+    parser.add_argument("--players", type=int, default=DEFAULT_PLAYERS)
+    parser.add_argument("--matches", type=int, default=DEFAULT_MATCHES)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="processes, each with its own guild"
+    )
+    parser.add_argument("--team-size", type=int, default=TEAM_SIZE)
+    parser.add_argument(
+        "--reports", type=int, default=10, help="convergence measurements per guild"
+    )
+    parser.add_argument(
+        "--random-teams",
+        type=float,
+        default=RANDOM_TEAMS,
+        help="share of matches with random teams instead of make_teams'",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--workdir", help="directory for the scratch guild dbs")
+    args = parser.parse_args()
+
+    results = run(
+        args.players,
+        args.matches,
+        args.workers,
+        args.seed,
+        args.team_size,
+        args.reports,
+        args.random_teams,
+        args.workdir,
+    )
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,533 @@
+import atexit
+import glob
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlitedict import decode
+
+from config import storage_busy_timeout, storage_idle_timeout, storage_max_connections
+from series import append_points, rebuild_series, remove_point
+
+# schema migrations, applied in order. PRAGMA user_version holds the number applied.
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS ratings (
+        user_id TEXT PRIMARY KEY,
+        mu REAL NOT NULL,
+        sigma REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS matches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        time REAL NOT NULL,
+        team_a_score INTEGER NOT NULL,
+        team_b_score INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS matches_time ON matches (time);
+    CREATE TABLE IF NOT EXISTS match_players (
+        match_id INTEGER NOT NULL REFERENCES matches (id) ON DELETE CASCADE,
+        user_id TEXT NOT NULL,
+        team INTEGER NOT NULL,
+        old_mu REAL NOT NULL,
+        old_sigma REAL NOT NULL,
+        new_mu REAL NOT NULL,
+        new_sigma REAL NOT NULL,
+        UNIQUE (match_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS match_players_user ON match_players (user_id, match_id);
+    """,
+    """
+    ALTER TABLE ratings ADD COLUMN last_match_time REAL;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS player_stats (
+        user_id TEXT PRIMARY KEY,
+        wins INTEGER NOT NULL DEFAULT 0,
+        losses INTEGER NOT NULL DEFAULT 0,
+        draws INTEGER NOT NULL DEFAULT 0,
+        games INTEGER NOT NULL DEFAULT 0,
+        rounds_for INTEGER NOT NULL DEFAULT 0,
+        rounds_against INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rating_series (
+        user_id TEXT NOT NULL,
+        chunk INTEGER NOT NULL,
+        first_time REAL NOT NULL,
+        points BLOB NOT NULL,
+        PRIMARY KEY (user_id, chunk)
+    ) WITHOUT ROWID;
+    """,
+    """
+    ALTER TABLE match_players ADD COLUMN prev_sigma REAL;
+    ALTER TABLE match_players ADD COLUMN prev_last_match_time REAL;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        match_id INTEGER PRIMARY KEY,
+        time REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS checkpoint_players (
+        match_id INTEGER NOT NULL REFERENCES checkpoints (match_id) ON DELETE CASCADE,
+        user_id TEXT NOT NULL,
+        mu REAL NOT NULL,
+        sigma REAL NOT NULL,
+        last_match_time REAL,
+        wins INTEGER NOT NULL,
+        losses INTEGER NOT NULL,
+        draws INTEGER NOT NULL,
+        games INTEGER NOT NULL,
+        rounds_for INTEGER NOT NULL,
+        rounds_against INTEGER NOT NULL,
+        PRIMARY KEY (match_id, user_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS archive_segments (
+        first_match INTEGER PRIMARY KEY,
+        last_match INTEGER NOT NULL,
+        first_time REAL NOT NULL,
+        last_time REAL NOT NULL,
+        match_count INTEGER NOT NULL,
+        data BLOB NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive_segment_players (
+        user_id TEXT NOT NULL,
+        first_match INTEGER NOT NULL
+            REFERENCES archive_segments (first_match) ON DELETE CASCADE,
+        PRIMARY KEY (user_id, first_match)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS data_version (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        epoch INTEGER NOT NULL,
+        version INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO data_version (id, epoch, version) VALUES (0, random(), 0);
+    """,
+]
+
+TEAM_A, TEAM_B = 0, 1
+
+# recompute ratings.last_match_time from match_players, optionally for some users only.
+# users whose matches are all archived keep the time from the latest checkpoint.
+REFRESH_LAST_MATCH_TIME = """
+    UPDATE ratings SET last_match_time = COALESCE(
+        (
+            SELECT m.time FROM match_players mp JOIN matches m ON m.id = mp.match_id
+            WHERE mp.user_id = ratings.user_id ORDER BY mp.match_id DESC LIMIT 1
+        ),
+        (
+            SELECT c.last_match_time FROM checkpoint_players c
+            WHERE c.user_id = ratings.user_id
+            AND c.match_id = (SELECT MAX(match_id) FROM checkpoints)
+        )
+    )
+"""
+
+# table used by SqliteDict for the old pickled {"ratings": ..., "history": ...} layout
+LEGACY_TABLE = "unnamed"
+
+
+def db_path(guildid):
+    """Path of the sqlite file belonging to guildid."""
+    return f"{guildid}.db"
+
+
+class GuildDB(sqlite3.Connection):
+    """A guild's sqlite connection, also holding its in-memory model (see model.py)."""
+
+    model = None
+
+
+class GuildConnection:
+    """A guild's open sqlite connection, used by one thread at a time."""
+
+    def __init__(self, guildid):
+        self.conn = sqlite3.connect(
+            db_path(guildid),
+            timeout=storage_busy_timeout,
+            check_same_thread=False,
+            factory=GuildDB,
+        )
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        migrate(self.conn)
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.closed = False
+
+    def close(self):
+        """Close the connection. Call with lock held."""
+        self.conn.close()
+        self.closed = True
+
+
+class ConnectionPool:
+    """Long-lived per-guild connections, evicted least recently used first."""
+
+    def __init__(
+        self, max_connections=storage_max_connections, idle_timeout=storage_idle_timeout
+    ):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = OrderedDict()  # guildid : GuildConnection, oldest first
+        self.lock = threading.Lock()
+
+    def acquire(self, guildid):
+        """Get the guild's connection, opening it if needed, and lock it for this thread."""
+        while True:
+            with self.lock:
+                entry = self.connections.get(guildid)
+                if entry is None:
+                    entry = self.connections[guildid] = GuildConnection(guildid)
+                self.connections.move_to_end(guildid)
+                entry.last_used = time.monotonic()
+                self.evict(keep=guildid)
+            # wait outside the pool lock so a busy guild doesn't block the others
+            entry.lock.acquire()
+            if not entry.closed:
+                return entry
+            entry.lock.release()
+
+    def evict(self, keep=None):
+        """Close idle connections and any beyond max_connections. Busy ones are skipped."""
+        now = time.monotonic()
+        for guildid, entry in list(self.connections.items()):
+            over_limit = len(self.connections) > self.max_connections
+            if not over_limit and now - entry.last_used < self.idle_timeout:
+                break
+            if guildid == keep:
+                continue
+            if entry.lock.acquire(blocking=False):
+                try:
+                    entry.close()
+                    del self.connections[guildid]
+                finally:
+                    entry.lock.release()
+
+    def close(self, guildid):
+        """Close the guild's connection if one is open."""
+        with self.lock:
+            entry = self.connections.pop(guildid, None)
+        if entry is not None:
+            with entry.lock:
+                entry.close()
+
+    def close_all(self):
+        """Close every connection, e.g. when the bot shuts down."""
+        with self.lock:
+            entries = list(self.connections.values())
+            self.connections.clear()
+        for entry in entries:
+            with entry.lock:
+                entry.close()
+
+
+pool = ConnectionPool()
+atexit.register(pool.close_all)
+
+
+@contextmanager
+def connect(guildid):
+    """Use the guild's pooled connection as a single transaction."""
+    entry = pool.acquire(str(guildid))
+    try:
+        with entry.conn:
+            yield entry.conn
+    except BaseException:
+        # the transaction rolled back, so the model may hold changes that never happened
+        entry.conn.model = None
+        raise
+    finally:
+        entry.lock.release()
+
+
+def remove_db(guildid):
+    """Close the guild's connection and delete its db files."""
+    guildid = str(guildid)
+    pool.close(guildid)
+    os.remove(db_path(guildid))
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path(guildid) + suffix):
+            os.remove(db_path(guildid) + suffix)
+
+
+def migrate(conn):
+    """Bring the schema up to date, importing legacy SqliteDict data on first run."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    with conn:
+        # IMMEDIATE so processes opening the same new db migrate it one at a time
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        for script in MIGRATIONS[version:]:
+            for statement in script.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+        if version == 0:
+            import_legacy(conn)
+        if version < 2:
+            rebuild_last_match_times(conn)
+        if version < 3:
+            rebuild_stats(conn)
+        if version < 4:
+            rebuild_series(conn)
+        if version < 5:
+            backfill_previous_state(conn)
+        if version < 7:
+            # archive imports this module
+            from archive import index_segments
+
+            index_segments(conn)
+        conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+
+def data_version(conn):
+    """(epoch, counter) identifying the guild's data, for caching anything rendered from it.
+
+    Every write bumps the counter in its own transaction, whichever process makes it. The
+    epoch is random per db file, so a deleted and recreated guild never reuses a version.
+    """
+    return conn.execute("SELECT epoch, version FROM data_version").fetchone()
+
+
+def bump_data_version(conn):
+    """Give the guild a new data version. Call inside the transaction of a write."""
+    conn.execute("UPDATE data_version SET version = version + 1")
+
+
+_OWN_SCORE = "CASE WHEN mp.team = 0 THEN m.team_a_score ELSE m.team_b_score END"
+_OTHER_SCORE = "CASE WHEN mp.team = 0 THEN m.team_b_score ELSE m.team_a_score END"
+
+# add (:sign = 1) or remove (:sign = -1) the matches selected by {where} from player_stats
+ACCUMULATE_STATS = f"""
+    INSERT INTO player_stats
+        (user_id, wins, losses, draws, games, rounds_for, rounds_against)
+    SELECT
+        mp.user_id,
+        :sign * SUM({_OWN_SCORE} > {_OTHER_SCORE}),
+        :sign * SUM({_OWN_SCORE} < {_OTHER_SCORE}),
+        :sign * SUM({_OWN_SCORE} = {_OTHER_SCORE}),
+        :sign * COUNT(*),
+        :sign * SUM({_OWN_SCORE}),
+        :sign * SUM({_OTHER_SCORE})
+    FROM match_players mp JOIN matches m ON m.id = mp.match_id
+    WHERE {{where}}
+    GROUP BY mp.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        wins = wins + excluded.wins,
+        losses = losses + excluded.losses,
+        draws = draws + excluded.draws,
+        games = games + excluded.games,
+        rounds_for = rounds_for + excluded.rounds_for,
+        rounds_against = rounds_against + excluded.rounds_against
+"""
+
+# per-user counters of the matches selected by {where}, in STATS_COLUMNS order
+SUM_STATS = f"""
+    SELECT
+        mp.user_id,
+        SUM({_OWN_SCORE} > {_OTHER_SCORE}),
+        SUM({_OWN_SCORE} < {_OTHER_SCORE}),
+        SUM({_OWN_SCORE} = {_OTHER_SCORE}),
+        COUNT(*),
+        SUM({_OWN_SCORE}),
+        SUM({_OTHER_SCORE})
+    FROM match_players mp JOIN matches m ON m.id = mp.match_id
+    WHERE {{where}}
+    GROUP BY mp.user_id
+"""
+
+STATS_COLUMNS = ("wins", "losses", "draws", "games", "rounds_for", "rounds_against")
+
+
+def rebuild_stats(conn):
+    """Recompute every player's win/loss/draw counters from the latest checkpoint on."""
+    conn.execute("DELETE FROM player_stats")
+    start = conn.execute(
+        "SELECT COALESCE(MAX(match_id), 0) FROM checkpoints"
+    ).fetchone()[0]
+    columns = ", ".join(STATS_COLUMNS)
+    conn.execute(
+        f"INSERT INTO player_stats (user_id, {columns})"
+        f" SELECT user_id, {columns} FROM checkpoint_players WHERE match_id = ?",
+        (start,),
+    )
+    conn.execute(
+        ACCUMULATE_STATS.format(where="mp.match_id > :start"),
+        {"sign": 1, "start": start},
+    )
+
+
+# each match_players row's user, as of their previous match
+_PREVIOUS_ROW = """
+    FROM match_players p JOIN matches m ON m.id = p.match_id
+    WHERE p.user_id = match_players.user_id AND p.match_id < match_players.match_id
+    ORDER BY p.match_id DESC LIMIT 1
+"""
+
+
+def backfill_previous_state(conn):
+    """Fill in each player's stored state before every match, from their previous match."""
+    conn.execute(f"""
+        UPDATE match_players SET
+            prev_sigma = COALESCE((SELECT p.new_sigma {_PREVIOUS_ROW}), old_sigma),
+            prev_last_match_time = (SELECT m.time {_PREVIOUS_ROW})
+        """)
+
+
+def rebuild_last_match_times(conn, users=None):
+    """Recompute the last-played index from history, for all users or only some."""
+    if users is None:
+        conn.execute(REFRESH_LAST_MATCH_TIME)
+    else:
+        conn.executemany(
+            REFRESH_LAST_MATCH_TIME + " WHERE user_id = ?",
+            [(str(uid),) for uid in users],
+        )
+
+
+def import_legacy(conn):
+    """Copy ratings and history out of the SqliteDict table, if the file has one."""
+    found = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (LEGACY_TABLE,),
+    ).fetchone()
+    if not found:
+        return
+    legacy = {
+        key: decode(value)
+        for key, value in conn.execute(f"SELECT key, value FROM {LEGACY_TABLE}")
+    }
+    conn.executemany(
+        "INSERT OR REPLACE INTO ratings (user_id, mu, sigma) VALUES (?, ?, ?)",
+        [
+            (str(uid), float(mu), float(sigma))
+            for uid, (mu, sigma) in legacy.get("ratings", {}).items()
+        ],
+    )
+    for match in legacy.get("history", []):
+        insert_match(
+            conn,
+            match["time"].timestamp(),
+            match["team_a_score"],
+            match["team_b_score"],
+            match["team_a"],
+            match["team_b"],
+            match["old_ratings"],
+        )
+
+
+def insert_match(conn, time, team_a_score, team_b_score, team_a, team_b, old_ratings):
+    """Append a match and its participants, updating their counters, last match and series.
+
+    Teams are {userid: new rating} dicts and old_ratings holds the (decayed) ratings the
+    match was rated from. Call this before writing the new ratings: each participant's
+    stored rating and last match time are kept on their match_players row so the match
+    can be undone exactly.
+    """
+    users = [str(uid) for players in (team_a, team_b) for uid in players]
+    previous = dict.fromkeys(users, (None, None))
+    for userid in users:
+        row = conn.execute(
+            "SELECT sigma, last_match_time FROM ratings WHERE user_id = ?", (userid,)
+        ).fetchone()
+        if row:
+            previous[userid] = row
+    match_id = conn.execute(
+        "INSERT INTO matches (time, team_a_score, team_b_score) VALUES (?, ?, ?)",
+        (time, team_a_score, team_b_score),
+    ).lastrowid
+    conn.executemany(
+        "UPDATE ratings SET last_match_time = ? WHERE user_id = ?",
+        [(time, userid) for userid in users],
+    )
+    conn.executemany(
+        "INSERT INTO match_players (match_id, user_id, team, old_mu, old_sigma,"
+        " new_mu, new_sigma, prev_sigma, prev_last_match_time)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                match_id,
+                str(uid),
+                team,
+                old_ratings[uid].mu,
+                old_ratings[uid].sigma,
+                new.mu,
+                new.sigma,
+                # a user without a stored rating started from old_ratings
+                previous[str(uid)][0] or old_ratings[uid].sigma,
+                previous[str(uid)][1],
+            )
+            for team, players in ((TEAM_A, team_a), (TEAM_B, team_b))
+            for uid, new in players.items()
+        ],
+    )
+    conn.execute(
+        ACCUMULATE_STATS.format(where="mp.match_id = :match_id"),
+        {"sign": 1, "match_id": match_id},
+    )
+    append_points(
+        conn,
+        [
+            (str(uid), (match_id, time, old_ratings[uid].mu, new.mu, new.sigma))
+            for players in (team_a, team_b)
+            for uid, new in players.items()
+        ],
+    )
+    return match_id
+
+
+def delete_match(conn, match_id):
+    """Remove a match and put its players back as they were before it.
+
+    Counters and rating series lose the match, and each player's rating and last match
+    time are restored from their match_players row in O(players). Checkpoints from the
+    match on no longer describe history, so they are dropped.
+    """
+    conn.execute(
+        ACCUMULATE_STATS.format(where="mp.match_id = :match_id"),
+        {"sign": -1, "match_id": match_id},
+    )
+    rows = conn.execute(
+        "SELECT user_id, old_mu, prev_sigma, prev_last_match_time FROM match_players"
+        " WHERE match_id = ?",
+        (match_id,),
+    ).fetchall()
+    conn.executemany(
+        "UPDATE ratings SET mu = ?, sigma = ?, last_match_time = ? WHERE user_id = ?",
+        [
+            (mu, sigma, last_match_time, userid)
+            for userid, mu, sigma, last_match_time in rows
+        ],
+    )
+    conn.execute("DELETE FROM matches WHERE id = ?", (match_id,))
+    conn.execute("DELETE FROM checkpoints WHERE match_id >= ?", (match_id,))
+    for userid, *_ in rows:
+        remove_point(conn, userid, match_id)
+    return [userid for userid, *_ in rows]
+
+
+def migrate_all(pattern="*.db"):
+    """One-shot migration of every guild db in the working directory."""
+    paths = sorted(glob.glob(pattern))
+    for path in paths:
+        with connect(path[: -len(".db")]):
+            print(f"migrated {path}")
+    pool.close_all()
+    return paths
+
+
+if __name__ == "__main__":
+    migrate_all(*sys.argv[1:])
@@ -0,0 +1,105 @@
+import multiprocessing
+import signal
+import time
+
+from config import worker_restart_reset
+
+# seconds before restarting a worker that exited, doubled on each quick exit up to the max
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+
+def shard_groups(shard_count, workers):
+    """Deal shard ids round robin into one list per worker."""
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+
+class Worker:
+    """A process running one group of shards."""
+
+    def __init__(self, context, target, number, shard_ids, shard_count):
+        self.context = context
+        self.target = target
+        self.number = number
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process = None
+        self.started = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at = None  # monotonic time of the pending restart, if any
+
+    def start(self):
+        """Start the worker process."""
+        self.process = self.context.Process(
+            target=self.target,
+            kwargs={
+                "shard_ids": self.shard_ids,
+                "shard_count": self.shard_count,
+                "worker": self.number,
+            },
+            name=f"worker-{self.number}",
+        )
+        self.process.start()
+        self.started = time.monotonic()
+        self.restart_at = None
+        print(f"worker {self.number} started with shards {self.shard_ids}", flush=True)
+
+    def check(self, now):
+        """Schedule a restart if the process exited, and start it once it's due."""
+        if self.restart_at is None and not self.process.is_alive():
+            if now - self.started >= worker_restart_reset:
+                self.delay = RESTART_DELAY
+            self.restart_at = now + self.delay
+            print(
+                f"worker {self.number} exited with code {self.process.exitcode},"
+                f" restarting in {self.delay}s",
+                flush=True,
+            )
+            self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+        if self.restart_at is not None and now >= self.restart_at:
+            self.start()
+
+    def stop(self, timeout=10):
+        """Ask the process to shut down, killing it if it doesn't within timeout."""
+        if self.process is None or not self.process.is_alive():
+            return
+        self.process.terminate()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+def supervise(target, workers, shard_count):
+    """Run target(shard_ids=..., shard_count=..., worker=...) in one process per worker.
+
+    Each worker gets a round robin share of the shards. Discord sends a guild's events
+    to a single shard, so each guild is handled by exactly one worker. Workers that exit
+    are restarted with backoff until the supervisor receives SIGINT or SIGTERM.
+    """
+    if not 0 < workers <= shard_count:
+        raise ValueError(f"cannot split {shard_count} shards between {workers} workers")
+    # spawn, so workers don't inherit the supervisor's threads or open connections
+    context = multiprocessing.get_context("spawn")
+    pool = [
+        Worker(context, target, number, shard_ids, shard_count)
+        for number, shard_ids in enumerate(shard_groups(shard_count, workers))
+    ]
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker in pool:
+        worker.start()
+    while not stopping:
+        time.sleep(1)
+        now = time.monotonic()
+        for worker in pool:
+            if not stopping:
+                worker.check(now)
+    for worker in pool:
+        worker.stop()
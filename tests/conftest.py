@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+import trueskill as ts
+
+import backend
+import storage
+from config import draw_probability
+
+
+class Clock(datetime):
+    """datetime whose now() is set by the test rather than read from the system."""
+
+    current = datetime(2024, 1, 1)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.current
+
+
+@pytest.fixture
+def guild_dir(tmp_path, monkeypatch):
+    """Run in an empty directory for guild dbs, closing pooled connections after."""
+    monkeypatch.chdir(tmp_path)
+    previous = ts.global_env()
+    # the env main.py runs the bot with
+    ts.TrueSkill(draw_probability=draw_probability).make_as_global()
+    yield tmp_path
+    storage.pool.close_all()
+    previous.make_as_global()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freeze backend's clock. Advance it by assigning a datetime to clock.current."""
+    monkeypatch.setattr(Clock, "current", datetime(2024, 1, 1))
+    monkeypatch.setattr(backend, "datetime", Clock)
+    return Clock
+
+
+@pytest.fixture
+def play(guild_dir, clock):
+    """Record random matches in a guild through backend.record_result.
+
+    Returns a function play(guildid, players, matches, seed=0, skip=()) giving the
+    guild's match ids. Matches are up to two days apart, so sigma decays between them.
+    The matches numbered in skip, counting from 1, are drawn but not recorded.
+    """
+
+    def play(guildid, players, matches, seed=0, skip=()):
+        rng = np.random.default_rng(seed)
+        ids = [str(10**17 + i) for i in range(players)]
+        for number in range(1, matches + 1):
+            clock.current += timedelta(seconds=int(rng.integers(1, 48 * 3600)))
+            size = int(rng.integers(1, min(5, players // 2) + 1))
+            lobby = rng.choice(ids, 2 * size, replace=False).tolist()
+            loser_score = int(rng.integers(0, 13))
+            scores = (13, loser_score) if rng.integers(0, 2) else (loser_score, 13)
+            if number not in skip:
+                backend.record_result(lobby[:size], lobby[size:], *scores, guildid)
+        with storage.connect(guildid) as db:
+            return [match_id for match_id, in db.execute("SELECT id FROM matches")]
+
+    return play
@@ -0,0 +1,164 @@
+from datetime import datetime
+
+import pytest
+
+import archive
+import backend
+import replay
+import storage
+from storage import STATS_COLUMNS
+
+START = datetime(2024, 1, 1)
+
+
+def state(guildid):
+    """{userid: (mu, sigma, last_match_time, *STATS_COLUMNS)}, like a checkpoint."""
+    with storage.connect(guildid) as db:
+        stats = {
+            userid: tuple(values)
+            for userid, *values in db.execute(
+                f"SELECT user_id, {', '.join(STATS_COLUMNS)} FROM player_stats"
+            )
+        }
+        return {
+            userid: (mu, sigma, last, *stats.get(userid, (0,) * len(STATS_COLUMNS)))
+            for userid, mu, sigma, last in db.execute(
+                "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+            )
+        }
+
+
+def tables(guildid):
+    """Ratings, counters, rating series and live history of a guild."""
+    with storage.connect(guildid) as db:
+        return {
+            table: db.execute(query).fetchall()
+            for table, query in {
+                "ratings": "SELECT * FROM ratings ORDER BY user_id",
+                "player_stats": "SELECT * FROM player_stats ORDER BY user_id",
+                "rating_series": "SELECT * FROM rating_series ORDER BY user_id, chunk",
+                "matches": "SELECT * FROM matches ORDER BY id",
+                "match_players": "SELECT * FROM match_players ORDER BY match_id, user_id",
+            }.items()
+        }
+
+
+def compact_to(guildid, match_id):
+    """Archive the guild's matches up to match_id."""
+    with storage.connect(guildid) as db:
+        (match_time,) = db.execute(
+            "SELECT time FROM matches WHERE id = ?", (match_id,)
+        ).fetchone()
+        return archive.compact(db, match_time + 0.5)
+
+
+@pytest.fixture
+def twins(play, clock):
+    """Guilds "a" and "b" with the same 120 matches."""
+
+    def twins():
+        for guildid in ("a", "b"):
+            clock.current = START
+            play(guildid, 30, 120)
+
+    return twins
+
+
+@pytest.mark.parametrize("walk_from", [None, 25])
+def test_create_checkpoint_matches_a_shorter_history(play, clock, walk_from):
+    play("full", 30, 120)
+    clock.current = START
+    play("prefix", 30, 60)
+    with storage.connect("full") as db:
+        if walk_from:
+            archive.create_checkpoint(db, walk_from)
+        assert archive.create_checkpoint(db, 60) == 60
+        checkpoint = archive.read_checkpoint(db, 60)
+    expected = state("prefix")
+    assert {uid: checkpoint[uid] for uid in expected} == expected
+    # players yet to play are checkpointed as new
+    for uid in checkpoint.keys() - expected.keys():
+        assert checkpoint[uid] == (25.0, 25 / 3, None, *(0,) * len(STATS_COLUMNS))
+
+
+def test_create_checkpoint_at_head_copies_current_state(play):
+    play("guild", 30, 50)
+    with storage.connect("guild") as db:
+        assert archive.create_checkpoint(db) == 50
+        assert archive.read_checkpoint(db, 50) == state("guild")
+        with pytest.raises(ValueError):
+            archive.create_checkpoint(db, 51)
+
+
+def test_maintain_checkpoints_every_interval(play, monkeypatch):
+    monkeypatch.setattr(archive, "checkpoint_interval", 10)
+    play("guild", 30, 65)
+    with storage.connect("guild") as db:
+        kept = [
+            match_id for match_id, in db.execute("SELECT match_id FROM checkpoints")
+        ]
+        assert kept == [30, 40, 50, 60]
+        recorded = archive.read_checkpoint(db, 40)
+        db.execute("DELETE FROM checkpoints")
+        archive.create_checkpoint(db, 40)
+        assert archive.read_checkpoint(db, 40) == recorded
+
+
+def test_compact_keeps_state_and_archives_history(twins):
+    twins()
+    with storage.connect("a") as db:
+        matches = {
+            row[0]: (
+                row,
+                db.execute(
+                    "SELECT user_id, team, old_mu, old_sigma, new_mu, new_sigma"
+                    " FROM match_players WHERE match_id = ? ORDER BY rowid",
+                    (row[0],),
+                ).fetchall(),
+            )
+            for row in db.execute("SELECT * FROM matches WHERE id <= 60")
+        }
+    before = tables("a")
+    assert compact_to("a", 60) == 60
+    after = tables("a")
+    for table in ("ratings", "player_stats", "rating_series"):
+        assert after[table] == before[table]
+    assert [row[0] for row in after["matches"]] == list(range(61, 121))
+    with storage.connect("a") as db:
+        assert archive.archived_until(db) == 60
+        assert archive.count_archived(db) == 60
+        assert archive.archived_matches(db, range(1, 121)) == matches
+        assert list(archive.iter_archived_ids(db)) == list(range(60, 0, -1))
+        # a second pass has nothing older left to archive
+        assert archive.compact(db, after["matches"][0][1]) == 0
+    history = backend.get_history("a")
+    assert [match.id for match in history] == list(range(120, 0, -1))
+
+
+def test_compacted_guild_undoes_and_replays_like_a_live_one(twins):
+    twins()
+    compact_to("a", 60)
+    # archived matches can't be undone
+    assert backend.undo_match("a", 30) == (None, 0)
+    for guildid in ("a", "b"):
+        match, _ = backend.undo_match(guildid, 90)
+        assert match.id == 90
+        assert [match.id for match in backend.undo_last_matches(guildid, 5)] == [
+            120,
+            119,
+            118,
+            117,
+            116,
+        ]
+    compacted, live = tables("a"), tables("b")
+    for table in ("ratings", "player_stats", "rating_series"):
+        assert compacted[table] == live[table]
+    assert compacted["match_players"] == [
+        row for row in live["match_players"] if row[0] > 60
+    ]
+    # replay starts at the archive boundary and reproduces the live history
+    count, deltas = replay.replay("a", dry_run=True)
+    assert count == 54
+    for stored, replayed in deltas.values():
+        assert replayed.mu == pytest.approx(stored.mu, rel=0, abs=1e-9)
+        assert replayed.sigma == pytest.approx(stored.sigma, rel=0, abs=1e-9)
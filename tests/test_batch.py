@@ -0,0 +1,75 @@
+import itertools
+
+import numpy as np
+import pytest
+import trueskill as ts
+from trueskill.backends import cdf
+
+import batch
+from CustomTrueSkill import win_probability
+
+
+def splits(n):
+    """Every assignment of n players to two non-empty teams, True for team A."""
+    return np.array(
+        [
+            assignment
+            for assignment in itertools.product((True, False), repeat=n)
+            if any(assignment) and not all(assignment)
+        ]
+    )
+
+
+def random_ratings(rng, n):
+    """mu and sigma arrays of n random players, and the same players as ts.Ratings."""
+    mu = rng.normal(25, 8, n)
+    sigma = rng.uniform(1, 8.5, n)
+    return mu, sigma, [ts.Rating(m, s) for m, s in zip(mu, sigma)]
+
+
+@pytest.mark.parametrize("n", range(2, 13))
+def test_match_quality_matches_trueskill(n):
+    mu, sigma, ratings = random_ratings(np.random.default_rng(n), n)
+    assignment = splits(n)
+    quality = batch.match_quality(mu, sigma, assignment)
+    expected = [
+        ts.quality(
+            [
+                [r for r, a in zip(ratings, row) if a],
+                [r for r, a in zip(ratings, row) if not a],
+            ]
+        )
+        for row in assignment
+    ]
+    np.testing.assert_allclose(quality, expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("n", range(2, 13))
+def test_win_probability_matches_scalar(n):
+    mu, sigma, ratings = random_ratings(np.random.default_rng(100 + n), n)
+    assignment = splits(n)
+    probability = batch.win_probability(mu, sigma, assignment)
+    expected = [
+        win_probability(
+            [r for r, a in zip(ratings, row) if a],
+            [r for r, a in zip(ratings, row) if not a],
+        )
+        for row in assignment
+    ]
+    np.testing.assert_allclose(probability, expected, rtol=0, atol=1e-9)
+
+
+def test_quality_from_sums_matches_match_quality():
+    mu, sigma, _ = random_ratings(np.random.default_rng(0), 10)
+    assignment = splits(10)
+    delta_mu, variance, n = batch.team_sums(mu, sigma, assignment)
+    np.testing.assert_array_equal(
+        batch.quality_from_sums(delta_mu, variance, n),
+        batch.match_quality(mu, sigma, assignment),
+    )
+
+
+def test_cdf_matches_trueskill():
+    x = np.linspace(-40, 40, 8001)
+    expected = [cdf(value) for value in x]
+    np.testing.assert_allclose(batch.cdf(x), expected, rtol=1e-12, atol=1e-15)
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+import archive
+import backend
+import export
+import replay
+import storage
+
+
+def test_every_writer_changes_the_version(play, tmp_path):
+    play("guild", 12, 30)
+    seen = [backend.get_data_version("guild")]
+
+    def changed():
+        version = backend.get_data_version("guild")
+        assert version not in seen
+        seen.append(version)
+
+    backend.record_result(["1", "2"], ["3", "4"], 13, 7, "guild")
+    changed()
+    backend.undo_match("guild", 10)
+    changed()
+    backend.undo_last_match("guild")
+    changed()
+    replay.replay("guild")
+    changed()
+    replay.replay("guild", dry_run=True)
+    assert backend.get_data_version("guild") == seen[-1]
+    with storage.connect("guild") as db:
+        archive.compact(db, float("inf"), limit=5)
+    changed()
+    export.export_guild("guild", tmp_path / "guild.npz")
+    backend.delete_db("guild")
+    changed()
+    export.import_guild("guild", tmp_path / "guild.npz")
+    changed()
+
+
+def test_writes_from_another_process_change_the_version(play, guild_dir):
+    play("guild", 12, 30)
+    before = backend.get_data_version("guild")
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.join(os.path.dirname(storage.__file__), "replay.py"),
+            "guild",
+        ],
+        cwd=guild_dir,
+        check=True,
+        capture_output=True,
+    )
+    assert backend.get_data_version("guild") != before
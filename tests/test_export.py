@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+import archive
+import export
+import storage
+
+# every table an import fills, in an order independent of rowids
+TABLES = {
+    "ratings": "SELECT * FROM ratings ORDER BY user_id",
+    "matches": "SELECT * FROM matches ORDER BY id",
+    "match_players": "SELECT * FROM match_players ORDER BY match_id, user_id",
+    "player_stats": "SELECT * FROM player_stats ORDER BY user_id",
+    "rating_series": "SELECT * FROM rating_series ORDER BY user_id, chunk",
+}
+
+
+def dump(guildid):
+    """{table: rows} of the tables an import fills."""
+    with storage.connect(guildid) as db:
+        return {table: db.execute(query).fetchall() for table, query in TABLES.items()}
+
+
+def test_round_trip(play, tmp_path):
+    play("source", 30, 200)
+    counts = export.export_guild("source", tmp_path / "guild.npz", chunk_size=64)
+    assert counts == export.import_guild("copy", tmp_path / "guild.npz")
+    assert export.read_meta(tmp_path / "guild.npz")["rows"] == counts
+    assert dump("copy") == dump("source")
+
+
+def test_round_trip_brings_archived_matches_back_live(play, tmp_path):
+    play("source", 30, 200)
+    expected = dump("source")
+    with storage.connect("source") as db:
+        assert archive.compact(db, time.time()) == 200
+        assert not db.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+    export.export_guild("source", tmp_path / "guild.npz", chunk_size=64)
+    export.import_guild("copy", tmp_path / "guild.npz")
+    assert dump("copy") == expected
+
+
+def test_import_refuses_a_played_guild(play, tmp_path):
+    play("source", 10, 5)
+    export.export_guild("source", tmp_path / "guild.npz")
+    with pytest.raises(ValueError):
+        export.import_guild("source", tmp_path / "guild.npz")
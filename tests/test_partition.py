@@ -0,0 +1,87 @@
+import time
+
+import numpy as np
+import pytest
+import trueskill as ts
+
+import partition
+
+
+def random_ratings(rng, n):
+    return [ts.Rating(rng.normal(25, 5), rng.uniform(1, 8.3)) for _ in range(n)]
+
+
+def qualities(ratings, team, match_count):
+    """ts.quality of each match of a team array (teams 2k and 2k + 1 play match k)."""
+    return [
+        ts.quality(
+            [
+                [r for r, t in zip(ratings, team) if t == 2 * match],
+                [r for r, t in zip(ratings, team) if t == 2 * match + 1],
+            ]
+        )
+        for match in range(match_count)
+    ]
+
+
+def no_worse(after, before, objective):
+    """Whether the qualities after are at least as good as before under objective.
+
+    "worst" compares the lowest quality, then the total on ties. Each swap may lose up
+    to swap_search's 1e-12 tolerance.
+    """
+    if objective == "worst" and not np.isclose(min(after), min(before), 0, 1e-9):
+        return min(after) > min(before)
+    return sum(after) >= sum(before) - 1e-9
+
+
+@pytest.mark.parametrize("objective", ["worst", "total"])
+@pytest.mark.parametrize("seed", range(20))
+def test_swap_search_never_worsens_the_objective(objective, seed):
+    rng = np.random.default_rng(seed)
+    match_count = int(rng.integers(2, 5))
+    ratings = random_ratings(rng, int(rng.integers(2 * match_count, 31)))
+    # the snake draft, and a random split with the same team sizes
+    drafted = partition.snake_draft(ratings, 2 * match_count)
+    for start in (drafted, rng.permutation(drafted)):
+        before = qualities(ratings, start, match_count)
+        team, _ = partition.swap_search(
+            ratings,
+            start.copy(),
+            match_count,
+            objective,
+            10**6,
+            time.perf_counter() + 10,
+        )
+        after = qualities(ratings, team, match_count)
+        assert np.bincount(team).tolist() == np.bincount(start).tolist()
+        assert no_worse(after, before, objective)
+
+
+@pytest.mark.parametrize("n", range(2, 7))
+@pytest.mark.parametrize("seed", range(20))
+def test_local_search_matches_exhaustive_search_on_small_lobbies(n, seed):
+    ratings = random_ratings(np.random.default_rng(seed), n)
+    for team_size in range(1, n // 2 + 1):
+        deadline = time.perf_counter() + 10
+        _, _, exhaustive, _ = partition.exhaustive_search(ratings, team_size, deadline)
+        a, b, local, _ = partition.local_search(ratings, team_size, 10**6, deadline)
+        assert len(a) == team_size and sorted(a + b) == list(range(n))
+        assert local == pytest.approx(exhaustive, rel=0, abs=1e-12)
+
+
+@pytest.mark.parametrize("n", range(7, 11))
+@pytest.mark.parametrize("seed", range(10))
+def test_local_search_ends_at_a_swap_optimum(n, seed):
+    # past six players one swap at a time can get stuck below the best split
+    ratings = random_ratings(np.random.default_rng(seed), n)
+    team_size = n // 2
+    deadline = time.perf_counter() + 10
+    _, _, exhaustive, _ = partition.exhaustive_search(ratings, team_size, deadline)
+    a, b, local, _ = partition.local_search(ratings, team_size, 10**6, deadline)
+    assert local <= exhaustive + 1e-12
+    for x in a:
+        for y in b:
+            team_a = [ratings[i] for i in a if i != x] + [ratings[y]]
+            team_b = [ratings[i] for i in b if i != y] + [ratings[x]]
+            assert ts.quality([team_a, team_b]) <= local + 1e-12
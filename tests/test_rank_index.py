@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from math import isclose
+
+import numpy as np
+import pytest
+import trueskill as ts
+
+from model import GuildModel
+from rank_index import RANK_TOLERANCE, RankIndex
+
+START = datetime(2024, 1, 1)
+
+
+def random_model(rng, players):
+    """A GuildModel with decaying, tied, near-tied, default and unrated players."""
+    env = ts.global_env()
+    mu = rng.normal(env.mu, 4, players)
+    sigma = rng.uniform(1, env.sigma, players)
+    last = START.timestamp() - rng.uniform(0, 60 * 86400, players)
+    # runs of equal and of barely different values, whose ranks depend on the tolerance
+    for first in range(0, players // 3, 6):
+        mu[first : first + 6] = mu[first] + RANK_TOLERANCE * 0.4 * rng.integers(0, 3, 6)
+        sigma[first : first + 6] = sigma[first]
+        last[first : first + 6] = last[first]
+    kind = rng.integers(0, 8, players)
+    mu[kind == 0] = env.mu  # volatile: unranked once decay restores the default sigma
+    mu[kind == 1], sigma[kind == 1] = env.mu, env.sigma  # never ranked
+    mu[kind == 2] = sigma[kind == 2] = np.nan  # only seen in history
+    last[kind == 3] = np.nan  # rated, never played
+    ids = [str(i) for i in range(players)]
+    return GuildModel(ids, mu, sigma, last, None)
+
+
+def brute_force(model, metric, current_time):
+    """Leaderboard rows (player, mu, sigma, value) and ranks, sorting every player."""
+    env = ts.global_env()
+    players = model.rated()
+    mu, sigma, exposure = model.decayed(current_time, players)
+    rows = [
+        (i, m, s, e if metric == "exposure" else m)
+        for i, m, s, e in zip(players.tolist(), mu.tolist(), sigma.tolist(), exposure)
+        if m != env.mu or s != env.sigma
+    ]
+    if metric == "exposure":
+        rows.sort(key=lambda row: (-row[3], row[0]))
+    else:
+        rows.sort(key=lambda row: (-row[1], row[2], row[0]))
+    ranks = {}
+    leader, leader_rank = 0, 0
+    for p, (i, _, _, value) in enumerate(rows):
+        if not isclose(value, leader, abs_tol=RANK_TOLERANCE):
+            leader, leader_rank = value, p + 1
+        ranks[i] = leader_rank
+    return rows, ranks
+
+
+def check(index, model, metric, current_time):
+    rows, ranks = brute_force(model, metric, current_time)
+    assert index.ordered_all(current_time) == rows
+    for limit in (1, 5, 40, len(rows) + 3):
+        assert index.ordered(current_time, limit) == rows[:limit]
+    for i in range(len(model.ids)):
+        assert index.rank(i, current_time) == ranks.get(i)
+    assert index.ranks(list(range(len(model.ids))), current_time) == ranks
+
+
+@pytest.mark.parametrize("metric", ["exposure", "mean"])
+@pytest.mark.parametrize("seed", range(5))
+def test_rank_index_matches_brute_force(metric, seed):
+    rng = np.random.default_rng(seed)
+    env = ts.global_env()
+    model = random_model(rng, 150)
+    index = RankIndex(model, metric, START)
+    current_time = START
+    check(index, model, metric, current_time)
+    for _ in range(6):
+        # time passes without a re-key, so sigmas decay away from the keys
+        current_time += timedelta(seconds=int(rng.integers(0, 20 * 86400)))
+        check(index, model, metric, current_time)
+        # results for a few players, and a reset to the default rating
+        for i in rng.choice(len(model.ids), 10, replace=False).tolist():
+            model.mu[i] = rng.normal(env.mu, 4)
+            model.sigma[i] = rng.uniform(1, env.sigma)
+            model.last[i] = current_time.timestamp()
+            index.update(i, current_time)
+        reset = int(rng.integers(0, len(model.ids)))
+        model.mu[reset], model.sigma[reset] = env.mu, env.sigma
+        index.update(reset, current_time)
+        check(index, model, metric, current_time)
+
+
+def test_run_leader():
+    # values of candidates, all at or below safe = 10; two players rank above them
+    def candidates(*values):
+        return [((-v, p), p, 0, 0, v) for p, v in enumerate(values)]
+
+    tied = candidates(9, 9 - RANK_TOLERANCE / 2, 9 - RANK_TOLERANCE * 0.9)
+    assert RankIndex.run_leader(tied, 2, 2, 10) == 3
+    # the run may reach above the candidates
+    assert RankIndex.run_leader(candidates(10, 9), 0, 2, 10) is None
+    assert RankIndex.run_leader(candidates(10 - RANK_TOLERANCE / 2), 0, 2, 10) is None
+    # the top of the leaderboard
+    assert RankIndex.run_leader(candidates(9, 8), 1, 0, 10) == 2
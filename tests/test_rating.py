@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+import trueskill as ts
+
+import batch
+import CustomTrueSkill
+from config import draw_probability
+
+ENVS = [ts.TrueSkill(), ts.TrueSkill(draw_probability=draw_probability)]
+
+
+def random_team(rng, size, prefix, env):
+    """{userid: ts.Rating} of size players around env's default rating."""
+    return {
+        f"{prefix}{i}": env.create_rating(
+            rng.normal(env.mu, env.sigma), rng.uniform(0.5, 1) * env.sigma
+        )
+        for i in range(size)
+    }
+
+
+def assert_ratings_close(actual, expected):
+    """Same players, with mu and sigma within 1e-9."""
+    assert actual.keys() == expected.keys()
+    for userid, rating in expected.items():
+        assert actual[userid].mu == pytest.approx(rating.mu, rel=0, abs=1e-9)
+        assert actual[userid].sigma == pytest.approx(rating.sigma, rel=0, abs=1e-9)
+
+
+@pytest.mark.parametrize("env", ENVS)
+@pytest.mark.parametrize("seed", range(20))
+def test_rate_two_teams_matches_factor_graph(env, seed):
+    rng = np.random.default_rng(seed)
+    winners = random_team(rng, rng.integers(1, 7), "w", env)
+    losers = random_team(rng, rng.integers(1, 7), "l", env)
+    w_after, l_after = CustomTrueSkill.rate_two_teams(winners, losers, env)
+    w_expected, l_expected = env.rate([winners, losers], ranks=[0, 1])
+    assert_ratings_close(w_after, w_expected)
+    assert_ratings_close(l_after, l_expected)
+
+
+def test_rate_two_teams_empty_team_falls_back():
+    env = ts.TrueSkill()
+    losers = random_team(np.random.default_rng(0), 3, "l", env)
+    # env.rate rejects empty teams, and so does the closed form
+    with pytest.raises(ValueError):
+        env.rate([{}, losers], ranks=[0, 1])
+    with pytest.raises(ValueError):
+        CustomTrueSkill.rate_two_teams({}, losers, env)
+
+
+def test_rate_two_teams_dynamic_draw_probability_falls_back():
+    env = ts.TrueSkill(draw_probability=lambda a, b, env: 0.05)
+    rng = np.random.default_rng(0)
+    winners = random_team(rng, 3, "w", env)
+    losers = random_team(rng, 4, "l", env)
+    w_after, l_after = CustomTrueSkill.rate_two_teams(winners, losers, env)
+    w_expected, l_expected = env.rate([winners, losers], ranks=[0, 1])
+    assert w_after == w_expected
+    assert l_after == l_expected
+
+
+def test_batch_rate_two_teams_rejects_dynamic_draw_probability():
+    env = ts.TrueSkill(draw_probability=lambda a, b, env: 0.05)
+    with pytest.raises(ValueError):
+        batch.rate_two_teams([25, 25], [8, 8], [0, 0], [True, False], env)
+
+
+def test_rate_two_teams_far_below_raises():
+    env = ts.TrueSkill()
+    winners = {"w": env.create_rating(-200, 1)}
+    losers = {"l": env.create_rating(200, 1)}
+    with pytest.raises(FloatingPointError):
+        CustomTrueSkill.rate_two_teams(winners, losers, env)
+    with pytest.raises(FloatingPointError):
+        batch.rate_two_teams([-200, 200], [1, 1], [0, 0], [True, False], env)
+
+
+def random_matches(rng, count, env):
+    """count matches of random N v M teams with disjoint players and round scores.
+
+    Returns:
+        Tuple: (winners, losers, winner score, loser score) of each match, then the
+            mu, sigma, match and won arrays batch takes, with winners first per match.
+    """
+    matches = []
+    mu, sigma, match, won = [], [], [], []
+    for slot in range(count):
+        winners = random_team(rng, rng.integers(1, 7), f"{slot}w", env)
+        losers = random_team(rng, rng.integers(1, 7), f"{slot}l", env)
+        loser_score = int(rng.integers(0, 13))
+        matches.append((winners, losers, 13, loser_score))
+        for team, is_winner in ((winners, True), (losers, False)):
+            for rating in team.values():
+                mu.append(rating.mu)
+                sigma.append(rating.sigma)
+                match.append(slot)
+                won.append(is_winner)
+    return matches, np.array(mu), np.array(sigma), np.array(match), np.array(won)
+
+
+def flat_ratings(matches, rate):
+    """Rate each match with a scalar function and lay the results out like batch."""
+    mu, sigma = [], []
+    for winners, losers, winner_score, loser_score in matches:
+        for team in rate(winners, losers, winner_score, loser_score):
+            mu.extend(rating.mu for rating in team.values())
+            sigma.extend(rating.sigma for rating in team.values())
+    return np.array(mu), np.array(sigma)
+
+
+@pytest.mark.parametrize("env", ENVS)
+def test_batch_rate_two_teams_matches_scalar(env):
+    matches, mu, sigma, match, won = random_matches(np.random.default_rng(1), 50, env)
+    new_mu, new_sigma = batch.rate_two_teams(mu, sigma, match, won, env)
+    expected_mu, expected_sigma = flat_ratings(
+        matches, lambda w, l, *_: CustomTrueSkill.rate_two_teams(w, l, env)
+    )
+    np.testing.assert_allclose(new_mu, expected_mu, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(new_sigma, expected_sigma, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("env", ENVS)
+def test_batch_rate_with_round_score_matches_scalar(env):
+    matches, mu, sigma, match, won = random_matches(np.random.default_rng(2), 50, env)
+    winner_score = [winner_score for _, _, winner_score, _ in matches]
+    loser_score = [loser_score for _, _, _, loser_score in matches]
+    new_mu, new_sigma = batch.rate_with_round_score(
+        mu, sigma, match, won, winner_score, loser_score, env=env
+    )
+    expected_mu, expected_sigma = flat_ratings(
+        matches,
+        lambda w, l, ws, ls: CustomTrueSkill.rate_with_round_score(
+            w, l, ws, ls, env=env
+        ),
+    )
+    np.testing.assert_allclose(new_mu, expected_mu, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(new_sigma, expected_sigma, rtol=0, atol=1e-9)
@@ -0,0 +1,55 @@
+import pytest
+
+import replay
+import storage
+
+COLUMNS = (
+    "SELECT match_id, user_id, old_mu, old_sigma, new_mu, new_sigma, prev_sigma,"
+    " prev_last_match_time FROM match_players ORDER BY match_id, user_id"
+)
+
+
+def snapshot(guildid):
+    """(match_players rows, ratings rows) of a guild."""
+    with storage.connect(guildid) as db:
+        return (
+            db.execute(COLUMNS).fetchall(),
+            db.execute(
+                "SELECT user_id, mu, sigma FROM ratings ORDER BY user_id"
+            ).fetchall(),
+        )
+
+
+def assert_rows_close(actual, expected):
+    assert len(actual) == len(expected)
+    for got, want in zip(actual, expected):
+        assert got == pytest.approx(want, rel=0, abs=1e-9)
+
+
+# 12 players put most matches on a level of their own (the float path), 60 players
+# give levels of several matches (the numpy path)
+@pytest.mark.parametrize("players", [12, 60])
+def test_replay_reproduces_recorded_history(play, players):
+    play("guild", players, 150)
+    rows, ratings = snapshot("guild")
+    count, deltas = replay.replay("guild", batch_size=40)
+    assert count == 150
+    for stored, replayed in deltas.values():
+        assert replayed.mu == pytest.approx(stored.mu, rel=0, abs=1e-9)
+        assert replayed.sigma == pytest.approx(stored.sigma, rel=0, abs=1e-9)
+    replayed_rows, replayed_ratings = snapshot("guild")
+    assert_rows_close(replayed_rows, rows)
+    assert_rows_close(replayed_ratings, ratings)
+
+
+def test_replay_falls_back_to_scalar_rating(play, monkeypatch):
+    play("guild", 60, 150)
+    rows, _ = snapshot("guild")
+
+    def overflow(*args):
+        raise FloatingPointError("winners rated far below losers")
+
+    monkeypatch.setattr(replay, "rate_rows", overflow)
+    monkeypatch.setattr(replay, "rate_single", overflow)
+    replay.replay("guild", batch_size=40)
+    assert_rows_close(snapshot("guild")[0], rows)
@@ -0,0 +1,86 @@
+import pytest
+
+import backend
+import storage
+from storage import STATS_COLUMNS
+
+MATCHES = 80
+
+
+def history(guildid):
+    """[(match_id, user_id, old_mu, old_sigma, new_mu, new_sigma, prev_sigma,
+    prev_last_match_time)] in match order."""
+    with storage.connect(guildid) as db:
+        return db.execute(
+            "SELECT match_id, user_id, old_mu, old_sigma, new_mu, new_sigma, prev_sigma,"
+            " prev_last_match_time FROM match_players ORDER BY match_id, user_id"
+        ).fetchall()
+
+
+def ratings(guildid):
+    """{userid: (mu, sigma, last_match_time)}"""
+    with storage.connect(guildid) as db:
+        return {
+            userid: values
+            for userid, *values in db.execute(
+                "SELECT user_id, mu, sigma, last_match_time FROM ratings"
+            )
+        }
+
+
+def assert_close(actual, expected):
+    assert actual == pytest.approx(expected, rel=0, abs=1e-9)
+
+
+@pytest.mark.parametrize("position", [1, 37, MATCHES])
+def test_undo_match_rerates_like_it_never_happened(play, clock, position):
+    start = clock.current
+    play("undone", 16, MATCHES)
+    clock.current = start
+    play("never", 16, MATCHES, skip={position})
+
+    match, rerated = backend.undo_match("undone", position)
+    assert match.id == position
+    assert rerated <= MATCHES - position
+
+    # the same history, with match ids after the undone one shifted down
+    undone = [
+        (match_id - (match_id > position), *row) for match_id, *row in history("undone")
+    ]
+    expected = history("never")
+    assert len(undone) == len(expected)
+    for row, want in zip(undone, expected):
+        assert row[:2] == want[:2]
+        assert_close(row[2:], want[2:])
+
+    # players whose only matches were undone go back to a new rating
+    undone_ratings, expected_ratings = ratings("undone"), ratings("never")
+    for userid, values in undone_ratings.items():
+        assert_close(values, expected_ratings.get(userid, (25.0, 25 / 3, None)))
+    assert backend.get_stats(undone_ratings, "undone") == backend.get_stats(
+        undone_ratings, "never"
+    )
+    assert backend.count_matches("undone") == MATCHES - 1
+
+
+def test_undo_last_matches_restores_earlier_state(play, clock):
+    start = clock.current
+    play("undone", 16, MATCHES)
+    clock.current = start
+    play("never", 16, MATCHES - 5)
+    undone = backend.undo_last_matches("undone", 5)
+    assert [match.id for match in undone] == list(range(MATCHES, MATCHES - 5, -1))
+    assert history("undone") == history("never")
+    # restored from old_mu, which went through a ts.Rating and may be an ulp off
+    undone_ratings = ratings("undone")
+    for userid, values in ratings("never").items():
+        assert_close(undone_ratings[userid], values)
+    assert backend.get_stats(undone_ratings, "undone") == backend.get_stats(
+        undone_ratings, "never"
+    )
+
+
+def test_undo_without_history(guild_dir, capsys):
+    assert backend.undo_last_match("guild") is None
+    assert backend.undo_match("guild", 1) == (None, 0)
+    assert capsys.readouterr().out == ""